@@ -427,7 +427,7 @@ def main(arguments = None):
 
     coordinates_files = {}
 
-    miner = mining.LEMONdBMiner(diffphot_db_path)
+    miner = mining.LEMONdBMiner(diffphot_db_path, profile = 'read-mostly')
     for pfilter in miner.pfilters:
 
         # LEMONdBMiner.sort_by_curve() returns a list of two-element tuples,
@@ -584,7 +584,7 @@ def main(arguments = None):
             diff_args[2] = aper_diff_db_path
             check_run(diffphot.main, [str(a) for a in diff_args])
 
-            miner = mining.LEMONdBMiner(aper_diff_db_path)
+            miner = mining.LEMONdBMiner(aper_diff_db_path, profile = 'read-mostly')
 
             try:
                 kwargs = dict(minimum = options.min_images)
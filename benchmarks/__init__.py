@@ -0,0 +1,11 @@
+#! /usr/bin/env python
+
+"""
+Benchmarks and accuracy harnesses of LEMON. These are not unit tests, and are
+not run by run_tests.py: each module is a script that reports how fast (or how
+accurate) some part of LEMON is, and is run from the root directory of LEMON,
+for example:
+
+$ python -m benchmarks.ingest --stars 1000 --images 200
+
+"""
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the phase folding of light curves (see database.fold_phases). A
+synthetic light curve is folded at many trial periods, first one period at a
+time, looping over the points in Python (as LEMONdB.get_phase_diagram used to
+do), and then at all the periods at once, with LightCurve.fold. The time spent
+folding and binning by phase (LightCurve.phase_bins), and the trial period
+with the lowest phase dispersion, are also reported, for example:
+
+$ python -m benchmarks.folding --points 500 --periods 10000
+
+"""
+
+from __future__ import division
+
+import math
+import optparse
+import sys
+import time
+import numpy
+
+# LEMON modules
+import database
+import passband
+
+def fold_loop(unix_times, period):
+    """ Fold the Unix times at a period, one at a time """
+
+    zero_t = min(unix_times)
+    phases = []
+    for utime in unix_times:
+        phases.append(math.modf((utime - zero_t) / period)[0])
+    return phases
+
+def main(arguments = None):
+    """ Report the time needed to fold a light curve at many periods """
+
+    parser = optparse.OptionParser(description = __doc__)
+    parser.add_option('--points', type = 'int', dest = 'npoints', default = 500)
+    parser.add_option('--periods', type = 'int', dest = 'nperiods', default = 10000)
+    parser.add_option('--bins', type = 'int', dest = 'nbins', default = 10)
+    parser.add_option('--seed', type = 'int', dest = 'seed', default = None)
+    (options, args) = parser.parse_args(args = arguments)
+
+    rstate = numpy.random.RandomState(options.seed)
+    period = 3.5 * 3600 # the 'true' period of the synthetic curve, in seconds
+    unix_times = numpy.sort(rstate.uniform(0, 30 * 86400, options.npoints))
+    magnitudes = 0.3 * numpy.sin(2 * numpy.pi * unix_times / period)
+    magnitudes += rstate.normal(0, 0.02, options.npoints)
+    snrs = rstate.uniform(50, 500, options.npoints)
+
+    curve = database.LightCurve(passband.Passband('V'), [1], [1.0], [0.01])
+    curve.extend(unix_times, magnitudes, snrs)
+    periods = numpy.linspace(period / 2, period * 2, options.nperiods)
+
+    print "%d points, %d trial periods" % (options.npoints, options.nperiods)
+    utimes = unix_times.tolist()
+    start = time.time()
+    for trial in periods:
+        fold_loop(utimes, trial)
+    loop = time.time() - start
+    print "%-22s %10.1f ms" % ('fold (loop)', loop * 1e3)
+
+    start = time.time()
+    curve.fold(periods)
+    vectorized = time.time() - start
+    print "%-22s %10.1f ms  (%.0fx)" % ('fold (vectorized)', vectorized * 1e3,
+                                        loop / vectorized)
+
+    start = time.time()
+    theta = curve.phase_bins(periods, options.nbins).dispersion()
+    elapsed = time.time() - start
+    print "%-22s %10.1f ms" % ('fold, bin, dispersion', elapsed * 1e3)
+    print "best period: %.1f s (true: %.1f s)" % (periods[theta.argmin()], period)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
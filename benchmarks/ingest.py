@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Throughput benchmark for the storage of photometry in a LEMONdB. The same
+synthetic photometry (every star observed in every image) is stored in a new
+database on disk, first one record at a time, with LEMONdB.add_photometry,
+and then one image at a time, with LEMONdB.add_image_photometry, which looks
+up the ID of the image only once and inserts all its records with a single
+call to executemany(). The number of records stored per second is reported
+for each method, in both cases within a single transaction, for example:
+
+$ python -m benchmarks.ingest --stars 1000 --images 200
+
+"""
+
+from __future__ import division
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+
+# LEMON modules
+import database
+import passband
+
+def populate(db, nstars, nimages, pfilter):
+    """ Add 'nstars' stars and 'nimages' images to a LEMONdB.
+
+    Return a two-element tuple: the list with the IDs of the stars, and a
+    NumPy array with the Unix times of the images, all of them in the
+    'pfilter' photometric filter.
+
+    """
+
+    star_ids = range(1, nstars + 1)
+    for star_id in star_ids:
+        db.add_star(star_id, 0.0, 0.0, 0.0, 0.0, 2000, None, None, 15.0)
+
+    unix_times = 1.4e9 + numpy.arange(nimages) * 300.0
+    for index, unix_time in enumerate(unix_times):
+        path = "image_%06d.fits" % index
+        image = database.Image(path, pfilter, unix_time, 'field', 1.0,
+                               1.0, 0.0, 0.0)
+        db.add_image(image)
+    db.commit()
+    return star_ids, unix_times
+
+def ingest(method, nstars, nimages, seed = None):
+    """ Store synthetic photometry in a new LEMONdB; return rows per second.
+
+    The 'method' argument must be either 'row', to store the records one by one
+    (LEMONdB.add_photometry), or 'image', to store them image by image (with
+    LEMONdB.add_image_photometry). Only the time spent storing the photometry
+    and committing the transaction is measured.
+
+    """
+
+    rstate = numpy.random.RandomState(seed)
+    mags = rstate.uniform(10, 18, (nimages, nstars))
+    snrs = rstate.uniform(10, 1000, (nimages, nstars))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = database.LEMONdB(os.path.join(tmpdir, 'ingest.LEMONdB'))
+        pfilter = passband.Passband('V')
+        star_ids, unix_times = populate(db, nstars, nimages, pfilter)
+
+        start = time.time()
+        for unix_time, image_mags, image_snrs in zip(unix_times, mags, snrs):
+            if method == 'image':
+                db.add_image_photometry(star_ids, unix_time, pfilter,
+                                        image_mags, image_snrs)
+            else:
+                for args in zip(star_ids, image_mags, image_snrs):
+                    star_id, magnitude, snr = args
+                    db.add_photometry(star_id, unix_time, pfilter, magnitude, snr)
+        db.commit()
+        elapsed = time.time() - start
+        del db
+        return nstars * nimages / elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main(arguments = None):
+    """ Report the throughput of each method to store photometry """
+
+    parser = optparse.OptionParser(description = __doc__)
+    parser.add_option('--stars', type = 'int', dest = 'nstars', default = 1000)
+    parser.add_option('--images', type = 'int', dest = 'nimages', default = 100)
+    parser.add_option('--seed', type = 'int', dest = 'seed', default = None)
+    (options, args) = parser.parse_args(args = arguments)
+
+    nrows = options.nstars * options.nimages
+    print "%d stars, %d images, %d records" % \
+          (options.nstars, options.nimages, nrows)
+
+    for method, name in (('row', 'add_photometry'),
+                         ('image', 'add_image_photometry')):
+        rate = ingest(method, options.nstars, options.nimages, seed = options.seed)
+        print "%-22s %12.0f rows/s" % (name, rate)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the packed storage of a LEMONdB (see LEMONdB.pack). A database on
+disk is populated with synthetic photometry and light curves, for all the stars
+in all the images, and the size of the file and the time needed to read the
+photometry (LEMONdB.get_photometry) and light curve (get_light_curve) of a
+random star are reported, first with one row per record and then after the
+database is packed and vacuumed, for example:
+
+$ python -m benchmarks.packing --stars 1000 --images 200
+
+"""
+
+from __future__ import division
+
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+
+# LEMON modules
+import database
+import passband
+from benchmarks.ingest import populate
+
+def read_latency(path, pfilter, star_ids, nreads):
+    """ Return the mean time, in milliseconds, to read the data of a star.
+
+    Open the LEMONdB in 'path' and read the photometry and light curve of
+    'nreads' random stars, in the 'pfilter' filter, with get_photometry and
+    get_light_curve. Return a two-element tuple with the mean time that it
+    took to read the photometry and the light curve of each star.
+
+    """
+
+    db = database.LEMONdB(path)
+    db._get_time_axis(pfilter) # cached, as in any application reading stars
+    sample = [random.choice(star_ids) for _ in xrange(nreads)]
+    latencies = []
+    for method in (db.get_photometry, db.get_light_curve):
+        start = time.time()
+        for star_id in sample:
+            method(star_id, pfilter)
+        latencies.append((time.time() - start) / nreads * 1e3)
+    del db
+    return tuple(latencies)
+
+def main(arguments = None):
+    """ Report the file size and read latency, before and after packing """
+
+    parser = optparse.OptionParser(description = __doc__)
+    parser.add_option('--stars', type = 'int', dest = 'nstars', default = 1000)
+    parser.add_option('--images', type = 'int', dest = 'nimages', default = 200)
+    parser.add_option('--reads', type = 'int', dest = 'nreads', default = 500)
+    parser.add_option('--seed', type = 'int', dest = 'seed', default = None)
+    (options, args) = parser.parse_args(args = arguments)
+
+    random.seed(options.seed)
+    rstate = numpy.random.RandomState(options.seed)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'packing.LEMONdB')
+        db = database.LEMONdB(path)
+        pfilter = passband.Passband('V')
+        star_ids, unix_times = populate(db, options.nstars, options.nimages, pfilter)
+
+        for unix_time in unix_times:
+            mags = rstate.uniform(10, 18, options.nstars)
+            snrs = rstate.uniform(10, 1000, options.nstars)
+            db.add_image_photometry(star_ids, unix_time, pfilter, mags, snrs)
+
+        curves = []
+        for star_id in star_ids:
+            cstars = random.sample([x for x in star_ids if x != star_id], 5)
+            curve = database.LightCurve(pfilter, cstars, [0.2] * 5, [0.01] * 5)
+            for unix_time in unix_times:
+                curve.add(unix_time, rstate.normal(0, 0.01), rstate.uniform(10, 1000))
+            curves.append((star_id, curve))
+        db.add_light_curves(curves)
+        db.commit()
+
+        print "%d stars, %d images, %d records" % \
+              (options.nstars, options.nimages, options.nstars * options.nimages)
+        print "%-8s %12s %18s %18s" % ('storage', 'size (MiB)',
+                                      'photometry (ms)', 'light curve (ms)')
+
+        def report(name):
+            size = os.path.getsize(path) / 2 ** 20
+            latencies = read_latency(path, pfilter, star_ids, options.nreads)
+            print "%-8s %12.2f %18.3f %18.3f" % ((name, size) + latencies)
+
+        report('rows')
+        db.pack()
+        db.vacuum()
+        del db
+        report('packed')
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Accuracy harness for the floating-point precisions supported by diffphot (its
+--precision option). A synthetic campaign is generated, with stars of random
+magnitudes observed in images with different zero points and noise consistent
+with their signal-to-noise ratios, and the light curve of each star computed,
+using all the others as candidates to comparison stars, in each precision. The
+maximum deviation of the differential magnitudes and SNRs with respect to
+those obtained in the highest precision, numpy.longdouble, is then reported.
+
+When run as a script, the harness prints these deviations, for example:
+
+$ python -m benchmarks.precision --stars 100 --images 500
+
+"""
+
+from __future__ import division
+
+import optparse
+import sys
+import time
+import numpy
+
+# LEMON modules
+import database
+import passband
+from lightcurves import StarSet
+
+def synthetic_campaign(nstars, nimages, seed = None):
+    """ Return the photometry of a synthetic campaign.
+
+    The method returns a three-element tuple: the Unix times of the 'nimages'
+    images, and the (nstars x nimages) arrays of instrumental magnitudes and
+    signal-to-noise ratios. The magnitude of each star in each image is the
+    sum of its mean magnitude, the zero point of the image and random noise
+    consistent with its SNR, so that there are no variable stars. 'seed' is
+    used to seed the random number generator, so that the campaign can be
+    reproduced.
+
+    """
+
+    rstate = numpy.random.RandomState(seed)
+    unix_times = 1.4e9 + numpy.cumsum(rstate.uniform(60, 600, nimages))
+    mean_mags = rstate.uniform(10, 18, nstars)
+    zero_points = rstate.normal(0, 0.1, nimages)
+    # Fainter stars have lower signal-to-noise ratios
+    snrs = 10 ** ((20 - mean_mags) / 2.5)[:, numpy.newaxis]
+    snrs = snrs * rstate.uniform(0.5, 1.5, (nstars, nimages)) + 2
+    noise = rstate.normal(0, 1, (nstars, nimages)) * 1.0857 / snrs
+    mags = mean_mags[:, numpy.newaxis] + zero_points + noise
+    return unix_times, mags, snrs
+
+def light_curves(unix_times, mags, snrs, dtype, ncstars = 20, ntargets = None):
+    """ Compute the light curves of a synthetic campaign in a precision.
+
+    The light curve of each of the first 'ntargets' stars (all of them, by
+    default) is computed with the 'ncstars' most constant of the other stars
+    (StarSet.best) and their Broeg weights, working with the 'dtype' data
+    type. Return a list of LightCurve objects, one for each target.
+
+    """
+
+    pfilter = passband.Passband('V')
+    stars = []
+    for star_id, (star_mags, star_snrs) in enumerate(zip(mags, snrs)):
+        rows = zip(unix_times, star_mags, star_snrs)
+        stars.append(database.DBStar.make_star(star_id, pfilter, rows, dtype = dtype))
+
+    curves = []
+    for star in stars[:ntargets]:
+        candidates = StarSet(star.complete_for(stars), dtype = dtype)
+        comparison = candidates.best(min(ncstars, len(candidates)))
+        weights = comparison.broeg_weights()
+        curves.append(comparison.light_curve(weights, star))
+    return curves
+
+def max_deviations(reference, curves):
+    """ Return the maximum deviation of some light curves from others.
+
+    Compare each light curve in 'curves' to the corresponding one (i.e., that
+    at the same position) in 'reference', and return a two-element tuple with
+    the maximum absolute difference between their magnitudes, and the maximum
+    relative difference between their signal-to-noise ratios. ValueError is
+    raised if the curves were not computed with the same comparison stars,
+    as in that case their values cannot be compared.
+
+    """
+
+    max_mag, max_snr = 0.0, 0.0
+    for rcurve, curve in zip(reference, curves):
+        if sorted(rcurve.cstars) != sorted(curve.cstars):
+            raise ValueError("curves have different comparison stars")
+        rpoints = numpy.array(list(rcurve), dtype = numpy.float64)
+        points = numpy.array(list(curve), dtype = numpy.float64)
+        dmags = numpy.abs(points[:, 1] - rpoints[:, 1])
+        dsnrs = numpy.abs(points[:, 2] - rpoints[:, 2]) / rpoints[:, 2]
+        max_mag = max(max_mag, dmags.max())
+        max_snr = max(max_snr, dsnrs.max())
+    return max_mag, max_snr
+
+def main(arguments = None):
+    """ Report the deviation of each precision with respect to longdouble """
+
+    parser = optparse.OptionParser(description = __doc__)
+    parser.add_option('--stars', type = 'int', dest = 'nstars', default = 50)
+    parser.add_option('--images', type = 'int', dest = 'nimages', default = 200)
+    parser.add_option('--targets', type = 'int', dest = 'ntargets', default = 10)
+    parser.add_option('--seed', type = 'int', dest = 'seed', default = None)
+    (options, args) = parser.parse_args(args = arguments)
+
+    campaign = synthetic_campaign(options.nstars, options.nimages,
+                                  seed = options.seed)
+
+    print "%d stars, %d images, %d light curves" % \
+          (options.nstars, options.nimages, options.ntargets)
+
+    reference = None
+    for name, dtype in database.PRECISIONS.iteritems():
+        start = time.time()
+        curves = light_curves(*campaign, dtype = dtype, ntargets = options.ntargets)
+        elapsed = time.time() - start
+
+        if reference is None:
+            reference = curves
+        max_mag, max_snr = max_deviations(reference, curves)
+        print "%-10s  %8.3f s  max |dmag| = %.3e  max |dSNR| / SNR = %.3e" % \
+              (name, elapsed, max_mag, max_snr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
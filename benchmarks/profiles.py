@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the connection profiles of a LEMONdB (see database.PRAGMA_PROFILES).
+Synthetic photometry is stored in a new database on disk, image by image and
+committing every few images, as diffphot does with its --checkpoint option,
+first with the 'default' profile and then with 'bulk-write', and the number of
+records stored per second is reported. Then, the photometry of random stars is
+read (LEMONdB.get_photometry), as when browsing the database with juicer, with
+the 'default' and 'read-mostly' profiles, and the mean time per star reported.
+Note that the differences depend heavily on the file system, for example:
+
+$ python -m benchmarks.profiles --stars 100 --images 1000 --commit 1
+
+"""
+
+from __future__ import division
+
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+
+# LEMON modules
+import database
+import passband
+from benchmarks.ingest import populate
+
+def ingest(path, profile, nstars, nimages, ncommit, seed = None):
+    """ Store synthetic photometry in a new LEMONdB; return rows per second.
+
+    Create the LEMONdB in 'path', with the connection profile 'profile', and
+    store the photometry of 'nstars' stars in 'nimages' images, one image at a
+    time (LEMONdB.add_image_photometry), committing every 'ncommit' images.
+    Only the time spent storing the photometry and committing is measured.
+
+    """
+
+    rstate = numpy.random.RandomState(seed)
+    db = database.LEMONdB(path, profile = profile)
+    pfilter = passband.Passband('V')
+    star_ids, unix_times = populate(db, nstars, nimages, pfilter)
+
+    start = time.time()
+    for index, unix_time in enumerate(unix_times):
+        mags = rstate.uniform(10, 18, nstars)
+        snrs = rstate.uniform(10, 1000, nstars)
+        db.add_image_photometry(star_ids, unix_time, pfilter, mags, snrs)
+        if not (index + 1) % ncommit:
+            db.commit()
+    db.commit()
+    elapsed = time.time() - start
+    db.set_profile('default')
+    del db
+    return nstars * nimages / elapsed
+
+def read_latency(path, profile, nreads):
+    """ Return the mean time, in milliseconds, to read a star's photometry """
+
+    db = database.LEMONdB(path, profile = profile)
+    pfilter = passband.Passband('V')
+    star_ids = db.star_ids
+    db._get_time_axis(pfilter) # cached, as in any application reading stars
+    sample = [random.choice(star_ids) for _ in xrange(nreads)]
+    start = time.time()
+    for star_id in sample:
+        db.get_photometry(star_id, pfilter)
+    elapsed = time.time() - start
+    del db
+    return elapsed / nreads * 1e3
+
+def main(arguments = None):
+    """ Report the ingest and read performance of each profile """
+
+    parser = optparse.OptionParser(description = __doc__)
+    parser.add_option('--stars', type = 'int', dest = 'nstars', default = 100)
+    parser.add_option('--images', type = 'int', dest = 'nimages', default = 1000)
+    parser.add_option('--commit', type = 'int', dest = 'ncommit', default = 1)
+    parser.add_option('--reads', type = 'int', dest = 'nreads', default = 5000)
+    parser.add_option('--seed', type = 'int', dest = 'seed', default = None)
+    (options, args) = parser.parse_args(args = arguments)
+
+    random.seed(options.seed)
+    print "%d stars, %d images, commit every %d images" % \
+          (options.nstars, options.nimages, options.ncommit)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'profiles.LEMONdB')
+        for profile in ('default', 'bulk-write'):
+            if os.path.exists(path):
+                os.unlink(path)
+            rate = ingest(path, profile, options.nstars, options.nimages,
+                          options.ncommit, seed = options.seed)
+            print "store %-12s %12.0f rows/s" % (profile, rate)
+
+        for profile in ('default', 'read-mostly'):
+            latency = read_latency(path, profile, options.nreads)
+            print "read  %-12s %12.3f ms/star" % (profile, latency)
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the spatial index of a LEMONdB (see LEMONdB._get_sky_index). The
+stars of a database in memory are given random celestial coordinates, and the
+mean time needed to find the star closest to random coordinates is reported,
+computing the angular distance to every star in the database, as LEMONdB
+.star_closest_to_world_coords used to do (with astromatic.Coordinates.distance,
+which builds an astropy SkyCoord for each star), and with the spatial index.
+The time needed to build the index, only done once, and the mean time of the
+k-nearest neighbors and cone searches are also reported, for example:
+
+$ python -m benchmarks.skyindex --stars 5000 --lookups 1000
+
+"""
+
+from __future__ import division
+
+import optparse
+import random
+import sys
+import time
+
+# LEMON modules
+import astromatic
+import database
+from test.test_database import LEMONdBTest
+from test.test_astromatic import CoordinatesTest
+
+def linear_search(db, ra, dec):
+    """ Return the (ID, distance) of the star closest to the coordinates,
+    computing the angular distance from (ra, dec) to each star in the LEMONdB """
+
+    db._execute("SELECT id, ra, dec FROM stars")
+    closest_id = None
+    closest_distance = float('inf')
+    coordinates = astromatic.Coordinates(ra, dec)
+    for star_id, star_ra, star_dec in db._rows:
+        star_coords = astromatic.Coordinates(star_ra, star_dec)
+        star_distance = coordinates.distance(star_coords)
+        if star_distance < closest_distance:
+            closest_id = star_id
+            closest_distance = star_distance
+    return closest_id, closest_distance
+
+def mean_time(function, points):
+    """ Return the mean time, in microseconds, of calling function(ra, dec) """
+
+    start = time.time()
+    for ra, dec in points:
+        function(ra, dec)
+    return (time.time() - start) / len(points) * 1e6
+
+def main(arguments = None):
+    """ Report the time per lookup, with and without the spatial index """
+
+    parser = optparse.OptionParser(description = __doc__)
+    parser.add_option('--stars', type = 'int', dest = 'nstars', default = 5000)
+    parser.add_option('--lookups', type = 'int', dest = 'nlookups', default = 1000)
+    parser.add_option('--linear', type = 'int', dest = 'nlinear', default = 1,
+                      help = "lookups without the index, which are very slow")
+    parser.add_option('--k', type = 'int', dest = 'k', default = 10)
+    parser.add_option('--radius', type = 'float', dest = 'radius', default = 1.0)
+    parser.add_option('--seed', type = 'int', dest = 'seed', default = None)
+    (options, args) = parser.parse_args(args = arguments)
+
+    random.seed(options.seed)
+    db = database.LEMONdB(':memory:')
+    for star_id in xrange(1, options.nstars + 1):
+        star_info = list(LEMONdBTest.random_star_info(id_ = star_id))
+        coords = CoordinatesTest.random()
+        star_info[3:5] = coords.ra, coords.dec
+        db.add_star(*star_info)
+    db.commit()
+
+    points = []
+    for _ in xrange(options.nlookups):
+        coords = CoordinatesTest.random()
+        points.append((coords.ra, coords.dec))
+
+    print "%d stars, %d lookups" % (options.nstars, options.nlookups)
+    expected = []
+    linear = mean_time(lambda ra, dec: expected.append(linear_search(db, ra, dec)),
+                       points[:options.nlinear])
+    print "%-20s %14.1f us" % ('nearest (linear)', linear)
+
+    start = time.time()
+    db._get_sky_index()
+    print "%-20s %14.1f us" % ('build index', (time.time() - start) * 1e6)
+
+    nearest = mean_time(db.star_closest_to_world_coords, points)
+    print "%-20s %14.1f us  (%.0fx)" % ('nearest (index)', nearest, linear / nearest)
+
+    k = options.k
+    knn = mean_time(lambda ra, dec: db.stars_closest_to_world_coords(ra, dec, k), points)
+    print "%-20s %14.1f us" % ('%d-nearest' % k, knn)
+
+    radius = options.radius
+    cone = mean_time(lambda ra, dec: db.stars_within_world_coords(ra, dec, radius), points)
+    print "%-20s %14.1f us" % ('cone (%g deg)' % radius, cone)
+
+    for (ra, dec), (star_id, _) in zip(points, expected):
+        assert db.star_closest_to_world_coords(ra, dec)[0] == star_id
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
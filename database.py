@@ -36,16 +36,278 @@ import numbers
 import operator
 import os
 import random
+import scipy.spatial
 import string
 import sqlite3
 import tempfile
+import threading
+import zlib
 
 # LEMON modules
-import astromatic
 import json_parse
 import methods
 import passband
 
+# The floating-point data types in which photometry can be processed, mapped
+# to the names with which they can be selected (e.g., diffphot's --precision)
+PRECISIONS = collections.OrderedDict([('longdouble', numpy.longdouble),
+                                      ('float64', numpy.float64),
+                                      ('float32', numpy.float32)])
+
+# The connection profiles of a LEMONdB (see LEMONdB.set_profile), mapped to
+# their names: the pairs (pragma, value) set when a profile is selected, in
+# this order. 'bulk-write' is for the commands that store large amounts of
+# data (photometry, diffphot): the write-ahead log (WAL), where the changes of
+# a transaction are only appended, and synced to disk once, at commit, instead
+# of the rollback journal, which needs several syncs per transaction. The sync
+# at each commit (synchronous FULL) is kept, so committed data survives a power
+# failure: photometry cannot resume an interrupted ingest. Plus, a 256 MiB
+# page cache and temporary tables in memory. 'read-mostly' is for browsing
+# databases (juicer): they are memory-mapped (up to 1 GiB), with the same
+# cache, and any attempt to modify them fails ('query_only').
+PRAGMA_PROFILES = collections.OrderedDict([
+    ('default', ()),
+    ('bulk-write', (('journal_mode', 'WAL'),
+                    ('synchronous', 'FULL'),
+                    ('cache_size', -262144),
+                    ('temp_store', 'MEMORY'))),
+    ('read-mostly', (('mmap_size', 2 ** 30),
+                     ('cache_size', -262144),
+                     ('temp_store', 'MEMORY'),
+                     ('query_only', 'ON')))])
+
+def phot_info_dtype(dtype):
+    """ Return the data type of the arrays with Unix times for a precision.
+
+    Unix times (~1e9 seconds) need at least double precision: in single
+    precision, for example, they would be rounded to multiples of 64 seconds,
+    making different images indistinguishable. This function returns the
+    smallest data type that can hold both 'dtype' and double-precision Unix
+    times, so that arrays that store them next to magnitudes and SNRs (such
+    as that of DBStar) never use a lower precision than float64.
+
+    """
+
+    return numpy.promote_types(dtype, numpy.float64)
+
+def axis_index_dtype(size):
+    """ Return the smallest integer data type to index a time axis.
+
+    Return the smallest unsigned integer NumPy data type that can hold the
+    positions (from zero to size - 1) of the Unix times in a time axis of
+    'size' images. This is uint8 for up to 256 images, and uint16 for up to
+    65536: two bytes per photometric record, instead of the eight needed to
+    store the Unix time itself, and which is the same for all the stars.
+
+    """
+
+    return numpy.min_scalar_type(max(size - 1, 0))
+
+def pack_records(image_ids, magnitudes, snrs):
+    """ Encode the records of a star as a compressed, columnar string.
+
+    Return a zlib-compressed string with the IDs of the images, delta-encoded
+    (as they are stored sorted by Unix time, most of the differences are one),
+    and the magnitudes and SNRs of the records, as three little-endian 64-bit
+    columns. Each column is byte-shuffled before it is compressed: its bytes
+    are written grouped by their significance (first all the most significant
+    bytes, then the next ones, and so on), so that the exponents and leading
+    bits of the values, which barely change along the column, end up next to
+    each other and compress well. This is the format in which LEMONdB.pack
+    stores photometry and light curves. The values are stored exactly, in
+    double precision, the same as SQLite's REAL. See also unpack_records.
+
+    """
+
+    image_ids = numpy.asarray(image_ids, dtype = numpy.int64)
+    deltas = numpy.diff(numpy.concatenate([[0], image_ids]))
+    columns = numpy.empty((3, len(image_ids)), dtype = '<f8')
+    columns[0] = deltas.astype('<i8').view('<f8')
+    columns[1] = magnitudes
+    columns[2] = snrs
+    shuffled = columns.view(numpy.uint8).reshape(3, -1, 8).transpose(0, 2, 1)
+    return zlib.compress(numpy.ascontiguousarray(shuffled).tostring())
+
+def unpack_records(data):
+    """ Decode the records of a star encoded with pack_records.
+
+    Return a three-element tuple with the NumPy arrays of the IDs of the
+    images (int64), the magnitudes and the SNRs (float64) of the records,
+    in the same order in which they were given to pack_records.
+
+    """
+
+    shuffled = numpy.fromstring(zlib.decompress(data), dtype = numpy.uint8)
+    columns = shuffled.reshape(3, 8, -1).transpose(0, 2, 1)
+    columns = numpy.ascontiguousarray(columns).view('<f8')[..., 0]
+    image_ids = numpy.cumsum(columns[0].view('<i8')).astype(numpy.int64)
+    magnitudes = columns[1].astype(numpy.float64)
+    snrs = columns[2].astype(numpy.float64)
+    return image_ids, magnitudes, snrs
+
+def celestial_to_cartesian(ra, dec):
+    """ Convert celestial coordinates to unit vectors.
+
+    Return an array with the Cartesian coordinates (x, y, z) of the points of
+    the unit sphere with these right ascensions and declinations, in degrees.
+    Both 'ra' and 'dec' may be scalars or sequences, in which case the shape
+    of the array is (n, 3). The Euclidean distance between two unit vectors
+    (the chord) grows monotonically with the angle between them, so the k-d
+    tree of these points finds the nearest stars on the celestial sphere.
+
+    """
+
+    ra  = numpy.radians(numpy.asarray(ra, dtype = numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype = numpy.float64))
+    cos_dec = numpy.cos(dec)
+    # numpy.array(...).T, not numpy.stack(..., axis = -1), new in NumPy 1.10
+    return numpy.array([cos_dec * numpy.cos(ra),
+                        cos_dec * numpy.sin(ra),
+                        numpy.sin(dec)]).T
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """ Return the angular distance, in degrees, between celestial coordinates.
+
+    Use the Vincenty formula, which (unlike the law of cosines, which suffers
+    from rounding errors at small distances, or the haversine formula, which
+    does the same for antipodal points) is accurate for all distances. This is
+    also the formula used by astropy.coordinates, so the result is the same as
+    that of astromatic.Coordinates.distance. All the coordinates are in degrees
+    and may be scalars or sequences, which are broadcast against each other.
+
+    """
+
+    ra1, dec1, ra2, dec2 = (numpy.radians(x) for x in (ra1, dec1, ra2, dec2))
+    delta = ra2 - ra1
+    sin_dec1, cos_dec1 = numpy.sin(dec1), numpy.cos(dec1)
+    sin_dec2, cos_dec2 = numpy.sin(dec2), numpy.cos(dec2)
+    num1 = cos_dec2 * numpy.sin(delta)
+    num2 = cos_dec1 * sin_dec2 - sin_dec1 * cos_dec2 * numpy.cos(delta)
+    denominator = sin_dec1 * sin_dec2 + cos_dec1 * cos_dec2 * numpy.cos(delta)
+    return numpy.degrees(numpy.arctan2(numpy.hypot(num1, num2), denominator))
+
+def fold_phases(unix_times, periods, epoch = None):
+    """ Fold a series of Unix times at one or more periods.
+
+    Return the phase of each Unix time: how far into the cycle it is, that is,
+    the fractional part of the number of periods elapsed since 'epoch' (by
+    default, the earliest of the Unix times), a value in the range [0, 1).
+    'periods', in seconds, may be a scalar or an array of any shape, and the
+    Unix times are folded at all of them at once, in a single broadcast, so
+    the shape of the returned array is periods.shape + (len(unix_times),).
+    Raises ValueError if any of the periods is not a positive number.
+
+    """
+
+    unix_times = numpy.asarray(unix_times, dtype = numpy.float64)
+    periods = numpy.asarray(periods, dtype = numpy.float64)
+    if numpy.any(~(periods > 0)):
+        raise ValueError("periods must be positive numbers")
+    if epoch is None:
+        epoch = unix_times.min() if len(unix_times) else 0
+
+    elapsed = unix_times - epoch
+    cycles = elapsed / periods[..., numpy.newaxis]
+    # The fractional part (exact, as it is representable), in place
+    phases = numpy.subtract(cycles, numpy.floor(cycles), out = cycles)
+    # For a tiny negative number of cycles (a Unix time before the epoch),
+    # the fractional part is rounded to one, outside of the [0, 1) range.
+    phases[phases == 1] = 0
+    return phases
+
+# The phase-binned summary of a folded light curve (see bin_phases)
+typename = 'PhaseBins'
+field_names = "edges counts means stdevs"
+
+class PhaseBins(collections.namedtuple(typename, field_names)):
+    """ The magnitudes of one or more folded light curves, binned by phase.
+
+    A named tuple, as returned by bin_phases, with four fields: a NumPy array
+    with the nbins + 1 edges of the bins, evenly spaced from zero to one; and
+    three arrays, with a row for each folding and a column for each bin, with
+    the number of points whose phase falls in each bin and the mean and the
+    standard deviation of their magnitudes, NaN for the empty bins.
+
+    """
+
+    __slots__ = ()
+
+    def dispersion(self):
+        """ Return the phase dispersion of each folding.
+
+        This is the statistic of the Phase Dispersion Minimization method
+        (Stellingwerf, 1978, ApJ, 224, 953): the ratio of the pooled variance
+        of the magnitudes within the bins to their overall variance. It is
+        close to one if the magnitudes do not vary with the phase, and small
+        for the periods at which the folded light curve is coherent, so the
+        best period is the one for which the dispersion is the lowest.
+
+        """
+
+        counts = self.counts
+        observed = counts > 0
+        means = numpy.where(observed, self.means, 0)
+        stdevs = numpy.where(observed, self.stdevs, 0)
+        npoints = counts.sum(axis = -1)
+        total_mean = (counts * means).sum(axis = -1) / npoints
+        within = (counts * stdevs ** 2).sum(axis = -1)
+        offsets = means - total_mean[..., numpy.newaxis]
+        between = (counts * offsets ** 2).sum(axis = -1)
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            pooled = within / (npoints - observed.sum(axis = -1))
+            return pooled / ((within + between) / (npoints - 1))
+
+def bin_phases(phases, magnitudes, nbins):
+    """ Summarize one or more folded light curves in phase bins.
+
+    'phases' is an array as returned by fold_phases, with the phases of the
+    points of a light curve, folded at one or more periods, along the last
+    axis, and 'magnitudes' those of the points, in the same order. The phase
+    range [0, 1) is divided into 'nbins' bins of equal width, and a PhaseBins
+    named tuple returned, with the number of points in each bin, and the mean
+    and standard deviation of their magnitudes, for each period. As with the
+    folding itself, all the periods are binned at once: each of the bins of
+    each period is assigned a different index, and the points are counted and
+    summed with numpy.bincount, with no loop over the periods. Phases outside
+    the [0, 1) range (such as those of a repeated phase diagram, see LEMONdB.
+    get_phase_diagram) are first wrapped. Raises ValueError if 'nbins' < 1.
+
+    """
+
+    if nbins < 1:
+        raise ValueError("at least one bin is needed")
+
+    phases = numpy.asarray(phases, dtype = numpy.float64)
+    shape = phases.shape[:-1]
+    nrows = int(numpy.prod(shape))
+    # The magnitudes of the points, once for each of the folded light curves
+    magnitudes = numpy.asarray(magnitudes, dtype = numpy.float64)
+    magnitudes = numpy.tile(magnitudes, nrows)
+
+    # The wrapped phases are non-negative, so truncating them is flooring
+    wrapped = phases - numpy.floor(phases)
+    bins = numpy.multiply(wrapped, nbins, out = wrapped).astype(numpy.intp)
+    numpy.minimum(bins, nbins - 1, out = bins)
+    offsets = numpy.arange(nrows, dtype = numpy.intp)[:, numpy.newaxis] * nbins
+    bins = bins.reshape(nrows, phases.shape[-1])
+    indexes = numpy.add(bins, offsets).reshape(-1)
+
+    size = nrows * nbins
+    counts = numpy.bincount(indexes, minlength = size)
+    sums = numpy.bincount(indexes, weights = magnitudes, minlength = size)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = sums / counts
+        # Two passes, as the sum of squares would lose precision
+        deviations = magnitudes - means[indexes]
+        squares = numpy.bincount(indexes, weights = deviations ** 2,
+                                 minlength = size)
+        stdevs = numpy.sqrt(squares / counts)
+
+    edges = numpy.linspace(0, 1, nbins + 1)
+    shape += (nbins,)
+    return PhaseBins(edges, counts.reshape(shape), means.reshape(shape),
+                     stdevs.reshape(shape))
+
 class DBStar(object):
     """ Encapsulates the instrumental photometric information for a star.
 
@@ -54,10 +316,21 @@ class DBStar(object):
     high-level and low-level routines, the latter of which are fundamental for
     a scalable implementation of the differential photometry algorithms.
 
+    As there may be many thousands of DBStars in memory at the same time, their
+    representation is kept as compact as possible. The magnitudes and SNRs are
+    stored in a (2 x records) array of the data type of the DBStar, and, if the
+    star has a time axis, its Unix times as the positions in the axis (which is
+    shared among all the DBStars of the same filter), using the smallest
+    integer type that can index it (see axis_index_dtype). There are no
+    per-star dictionaries: Unix times are looked up on these arrays instead.
+    The '_phot_info' and '_time_indexes' attributes of previous versions are
+    still available, but built on demand, so they should be avoided in
+    performance-sensitive code.
+
     """
 
-    def __init__(self, id_, pfilter, phot_info, times_indexes,
-                 dtype = numpy.longdouble):
+    def __init__(self, id_, pfilter, phot_info, times_indexes = None,
+                 dtype = numpy.longdouble, time_axis = None):
         """ Instantiation method for the DBStar class.
 
         This is an abrupt descent in the abstraction ladder, but needed in
@@ -73,12 +346,27 @@ class DBStar(object):
                     photometric information. For example, in order to get the
                     magnitude of the third image, we would do phot_info[1][2]
         times_indexes - a dictionary mapping each Unix time for which the star
-                        was observed to its index in phot_info; this gives us
-                        O(1) lookups when 'trimming' an instance. See the
-                        BDStar.issubset and complete_for for further
-                        information. Note that the values in this dictionary
-                        are trusted blindly, so they better have the correct
-                        values for phot_info!
+                        was observed to its index in phot_info. It is no
+                        longer used, as the indexes are found on the arrays
+                        of Unix times, and may be None, but it is accepted
+                        for compatibility with existing callers.
+
+        Keyword arguments:
+        dtype - the floating-point data type in which the magnitudes and SNRs
+                are stored, also used by the DBStars derived from this one
+                (such as those returned by DBStar.complete_for). Note that,
+                since it also contains the Unix times, 'phot_info' has at
+                least double precision (see phot_info_dtype) even if 'dtype'
+                is lower, but the Unix times are stored separately.
+        time_axis - a sorted NumPy array with the Unix times of all the images
+                    of the campaign in this photometric filter, shared among
+                    all the DBStars in the filter (the same object, not just
+                    equal arrays). If given, the star is also assigned a
+                    bitmask, with a bit for each image along the time axis, set
+                    to one if the star was observed in it. This allows us to
+                    check whether a star is a subset of others (DBStar.issubset
+                    and complete_for) with vectorized bitwise operations. The
+                    Unix times in 'phot_info' must all be in the time axis.
 
         """
 
@@ -86,9 +374,71 @@ class DBStar(object):
         self.pfilter = pfilter
         if phot_info.shape[0] != 3: # number of rows
             raise ValueError("'phot_info' must have exactly three rows")
-        self._phot_info = phot_info
-        self._time_indexes = times_indexes
         self.dtype = dtype
+        # Magnitudes (first row) and SNRs (second row)
+        self._values = numpy.array(phot_info[1:], dtype = dtype)
+
+        self._time_axis = time_axis
+        if time_axis is not None:
+            indexes = numpy.searchsorted(time_axis, phot_info[0])
+            if not numpy.all(time_axis.take(indexes, mode = 'clip') == phot_info[0]):
+                raise ValueError("Unix times of 'phot_info' not in 'time_axis'")
+            self._axis_indexes = indexes.astype(axis_index_dtype(len(time_axis)))
+            self._times = None
+            observed = numpy.zeros(len(time_axis), dtype = bool)
+            observed[indexes] = True
+            self._mask = numpy.packbits(observed)
+        else:
+            self._axis_indexes = None
+            self._times = numpy.array(phot_info[0], dtype = numpy.float64)
+            self._mask = None
+
+    def _derive(self, values, other):
+        """ Return a DBStar with these records, at the Unix times of another.
+
+        The returned DBStar has the ID, filter and data type of 'self', the
+        magnitudes and SNRs in 'values', a (2 x records) array, and the same
+        Unix times as 'other', whose arrays (and bitmask) it shares, as they
+        are never modified. This is how DBStar._trim_to creates its DBStars,
+        without having to go through DBStar.__init__ and validate them again.
+
+        """
+
+        star = DBStar.__new__(DBStar)
+        star.id = self.id
+        star.pfilter = self.pfilter
+        star.dtype = self.dtype
+        star._values = values
+        star._time_axis = other._time_axis
+        star._axis_indexes = other._axis_indexes
+        star._times = other._times
+        star._mask = other._mask
+        return star
+
+    @staticmethod
+    def _on_time_axis(id_, pfilter, values, axis_indexes, mask, time_axis,
+                      dtype = numpy.longdouble):
+        """ Return a DBStar from its compact representation.
+
+        This is the inverse of what DBStar.__init__ does: the DBStar is built
+        directly from the (2 x records) array of magnitudes and SNRs, 'values',
+        the positions of its records in 'time_axis' and its bitmask over it,
+        without validating them again. It is used by PhotometryStore, which
+        keeps the photometry of all the stars in this form, so the returned
+        DBStar is identical to the one given by LEMONdB.get_photometry.
+
+        """
+
+        star = DBStar.__new__(DBStar)
+        star.id = id_
+        star.pfilter = pfilter
+        star.dtype = dtype
+        star._values = values
+        star._time_axis = time_axis
+        star._axis_indexes = axis_indexes
+        star._times = None
+        star._mask = mask
+        return star
 
     def __str__(self):
         """ The 'informal' string representation """
@@ -97,37 +447,108 @@ class DBStar(object):
 
     def __len__(self):
         """ Return the number of records for the star """
-        return self._phot_info.shape[1] # number of columns
+        return self._values.shape[1] # number of columns
 
     def time(self, index):
         """ Return the Unix time of the index-th record """
-        return self._phot_info[0][index]
+        if self._axis_indexes is not None:
+            return self._time_axis[self._axis_indexes[index]]
+        return self._times[index]
+
+    def _time_indexes_of(self, unix_times):
+        """ Return the indexes of the records of some Unix times.
+
+        The method returns a NumPy array with the index of the record of the
+        star for each Unix time in 'unix_times', looked up with a binary search
+        on its (sorted) Unix times. KeyError is raised if the star was not
+        observed at any of them.
+
+        """
+
+        msg = "Unix time not in star with ID = %d" % self.id
+        times = self._unix_times
+        unix_times = numpy.asarray(unix_times)
+        # An empty star has no records to look up: take() would raise
+        # IndexError, even in 'clip' mode, so check for this case first
+        if not len(times) and len(unix_times):
+            raise KeyError(msg)
+
+        order = numpy.argsort(times, kind = 'mergesort')
+        indexes = order.take(numpy.searchsorted(times, unix_times, sorter = order),
+                             mode = 'clip')
+        if not numpy.all(times[indexes] == unix_times):
+            raise KeyError(msg)
+        return indexes
 
     def _time_index(self, unix_time):
-        """ Return the index of the Unix time in '_phot_info' """
-        return self._time_indexes[unix_time]
+        """ Return the index of the record of the Unix time """
+        return int(self._time_indexes_of([unix_time])[0])
+
+    @property
+    def _time_indexes(self):
+        """ Return a dictionary mapping each Unix time to its index.
+
+        This dictionary is no longer stored in the DBStar, but built each time
+        the attribute is accessed, so DBStar._time_index should be used instead
+        in order to look up a few Unix times.
+
+        """
+
+        return dict((unix_time, index)
+                    for index, unix_time in enumerate(self._unix_times))
+
+    @property
+    def _phot_info(self):
+        """ Return the (3 x records) array of Unix times, magnitudes and SNRs.
+
+        This is the array given to DBStar.__init__, rebuilt, as a copy, each time
+        the attribute is accessed, as the Unix times are not stored next to the
+        magnitudes and SNRs. Its data type is phot_info_dtype(self.dtype).
+
+        """
+
+        phot_info = numpy.empty((3, len(self)), dtype = phot_info_dtype(self.dtype))
+        phot_info[0] = self._unix_times
+        phot_info[1:] = self._values
+        return phot_info
 
     def mag(self, index):
         """ Return the magnitude of the index-th record """
-        return self._phot_info[1][index]
+        return self._values[0][index]
 
     def snr(self, index):
         """ Return the SNR of the index-th record """
-        return self._phot_info[2][index]
+        return self._values[1][index]
 
     @property
     def _unix_times(self):
         """ Return the Unix times at which the star was observed """
-        return self._phot_info[0]
+        if self._axis_indexes is not None:
+            return self._time_axis[self._axis_indexes]
+        return self._times
+
+    @property
+    def _magnitudes(self):
+        """ Return the magnitudes of all the records of the star """
+        return self._values[0]
+
+    @property
+    def _snrs(self):
+        """ Return the SNRs of all the records of the star """
+        return self._values[1]
+
+    def _shares_time_axis(self, other):
+        """ Return True if both DBStars have a bitmask over the same time axis """
+        return self._time_axis is not None and \
+               self._time_axis is other._time_axis
 
     def issubset(self, other):
         """ Return True if for each Unix time at which 'self' was observed,
         there is also an observation for 'other'; False otherwise """
 
-        for unix_time in self._unix_times:
-            if unix_time not in other._time_indexes:
-                return False
-        return True
+        if self._shares_time_axis(other):
+            return not numpy.any(self._mask & ~other._mask)
+        return bool(numpy.all(numpy.in1d(self._unix_times, other._unix_times)))
 
     def _trim_to(self, other):
         """ Return a new DBStar which contains the records of 'self' that were
@@ -135,61 +556,282 @@ class DBStar(object):
         be raised if self if not a subset of other -- so you should check for
         that before trimming anything"""
 
-        phot_info = numpy.empty((3, len(other)), dtype = self.dtype)
-        for oindex, unix_time in enumerate(other._unix_times):
-            sindex = self._time_index(unix_time)
-            phot_info[0][oindex] = self.time(sindex)
-            phot_info[1][oindex] = self.mag(sindex)
-            phot_info[2][oindex] = self.snr(sindex)
-        return DBStar(self.id, self.pfilter, phot_info,
-                      other._time_indexes, dtype = self.dtype)
+        if self._shares_time_axis(other):
+            if not other.issubset(self):
+                msg = "star with ID = %d is not a subset" % other.id
+                raise KeyError(msg)
+            # Map each position in the time axis to the index of the record
+            # of 'self' for that Unix time, and look up those of 'other'.
+            lookup = numpy.empty(len(self._time_axis), dtype = int)
+            lookup[self._axis_indexes] = numpy.arange(len(self))
+            indexes = lookup[other._axis_indexes]
+        else:
+            indexes = self._time_indexes_of(other._unix_times)
+
+        return self._derive(self._values[:, indexes], other)
+
+    @staticmethod
+    def observation_masks(stars):
+        """ Return the observation bitmasks of a sequence of DBStars.
+
+        The method returns a two-dimensional NumPy array with a row for each
+        DBStar, containing its bitmask (see DBStar.__init__). All the DBStars
+        must share the same time axis; otherwise ValueError is raised. The
+        returned array can be passed to DBStar.complete_for, so that it does
+        not have to be computed for every star when all of them are checked
+        against the same sequence of DBStars.
+
+        """
+
+        if not stars:
+            return numpy.empty((0, 0), dtype = numpy.uint8)
+        axis = stars[0]._time_axis
+        if axis is None or not all(s._time_axis is axis for s in stars):
+            raise ValueError("DBStars must share the same time axis")
+        return numpy.array([s._mask for s in stars])
 
-    def complete_for(self, iterable):
+    def complete_for(self, iterable, masks = None):
         """ Iterate over the supplied DBStars and trim them.
 
         The method returns a list with the 'trimmed' version of those DBStars
         which are different than 'self' (i.e., a star instance will not be
         considered to be a subset of itself) and of which it it is a subset.
 
+        If all the DBStars have a bitmask over the same time axis, the subset
+        tests are done at once, with bitwise operations on the (stars x bytes)
+        array of bitmasks. This array, as returned by DBStar.observation_masks
+        for 'iterable', may be given in the 'masks' keyword argument, so that
+        it is not computed again every time the method is called. In that
+        case, if 'iterable' is a sequence, such as a PhotometryStore, only
+        the complete DBStars are read from it.
+
+        """
+
+        stars = iterable
+        if not isinstance(stars, collections.Sequence):
+            stars = list(stars)
+        if not stars:
+            return []
+
+        if masks is None:
+            try:
+                masks = self.observation_masks(stars)
+            except ValueError:
+                masks = None
+            else:
+                if not self._shares_time_axis(stars[0]):
+                    masks = None
+
+        if masks is not None:
+            # A star is complete if it was observed in all the images in which
+            # 'self' was (i.e., none of the bits of 'self' is zero in 'star')
+            complete = ~numpy.any(self._mask & ~masks, axis = 1)
+            candidates = (stars[index] for index in numpy.flatnonzero(complete))
+        else:
+            candidates = (star for star in stars if self.issubset(star))
+
+        return [star._trim_to(self) for star in candidates if star is not self]
+
+    def covered_for(self, iterable, coverage, masks = None):
+        """ Return the DBStars observed in most of the images of this one.
+
+        The method returns a list with those of the supplied DBStars, different
+        than 'self', that were observed in at least a fraction 'coverage', in
+        the range (0, 1], of the images in which 'self' was. Unlike those of
+        DBStar.complete_for, these stars are not trimmed, as they may lack some
+        of the images of 'self' (see lightcurves.StarSet.masked). A coverage of
+        one selects the same stars that DBStar.complete_for does.
+
+        All the DBStars must share the time axis of 'self', as the number of
+        images in common is counted at once, on the (stars x bytes) array of
+        bitmasks, and ValueError is raised otherwise. As in complete_for, the
+        array returned by DBStar.observation_masks for 'iterable' may be given
+        in the 'masks' keyword argument.
+
         """
 
-        complete_stars = []
-        for star in iterable:
-            if self is not star and self.issubset(star):
-                complete_stars.append(star._trim_to(self))
-        return complete_stars
+        if not 0 < coverage <= 1:
+            raise ValueError("'coverage' must be in the range (0,1]")
+
+        stars = iterable
+        if not isinstance(stars, collections.Sequence):
+            stars = list(stars)
+        if not stars:
+            return []
+
+        if masks is None:
+            if not self._shares_time_axis(stars[0]):
+                raise ValueError("DBStars must share the same time axis")
+            masks = self.observation_masks(stars)
+
+        shared = numpy.unpackbits(self._mask & masks, axis = 1).sum(axis = 1)
+        indexes = numpy.flatnonzero(shared >= coverage * len(self))
+        return [star for star in (stars[index] for index in indexes)
+                if star is not self]
 
     @staticmethod
-    def make_star(id_, pfilter, rows, dtype = numpy.longdouble):
+    def make_star(id_, pfilter, rows, dtype = numpy.longdouble, time_axis = None):
         """ Construct a DBstar instance for some photometric data.
 
         Feeding the class constructor with NumPy arrays and dictionaries is not
         particularly practical, so most of the time you may want to use instead
         this convenience function. It also receives the star ID and the filter
         of the star, but the photometric records are given as a sequence of
-        three-element tuples (Unix time, magnitude and SNR).
+        three-element tuples (Unix time, magnitude and SNR). The 'time_axis'
+        keyword argument is passed down to DBStar.__init__.
 
         """
 
-        # NumPy arrays are stored in contiguous blocks of memory, so adding
-        # rows or columns to an existing one would require to copy the entire
-        # array to a new block of memory. It is much better to first create an
-        # array as big as will be needed -- numpy.empty(), unlike zeros, does
-        # not initializes its entries and may therefore be marginally faster
+        # The rows become the columns of the (3 x records) array; there is no
+        # need for a dictionary of the indexes of the Unix times, as these are
+        # looked up on the arrays of the DBStar (see DBStar.__init__)
+        phot_info = numpy.array(rows, dtype = phot_info_dtype(dtype))
+        phot_info = phot_info.reshape((-1, 3)).T
+        return DBStar(id_, pfilter, phot_info, dtype = dtype, time_axis = time_axis)
+
+
+class PhotometryStore(collections.Sequence):
+    """ The photometry of all the stars in a filter, in a memory-mapped file.
+
+    A read-only sequence with a DBStar for each star in a LEMONdB, in the same
+    order as LEMONdB.star_ids, for when the photometry of a campaign does not
+    fit in memory. The photometry is read from the database one star at a
+    time, and written to a temporary file, a (stars x 2 x images) array of
+    magnitudes and SNRs (NaN where a star was not observed) that is memory-
+    mapped, so that the operating system pages it in and out as needed.
+    Each time that one of its elements is accessed, a DBStar, identical to the
+    one that LEMONdB.get_photometry returns, is built from its row of the
+    array: only the DBStars in use are held in memory, and they are discarded
+    once no longer needed. The observation bitmasks of all the stars (see
+    DBStar.observation_masks), their number of records and the median of their
+    magnitudes are kept in memory, as they are small and needed to decide
+    which of them have to be read.
+
+    A PhotometryStore can be pickled (for example, to be sent to the workers
+    of a multiprocessing pool) without copying the photometry, as only the
+    path to the file is pickled, which is memory-mapped again, in read-only
+    mode, when unpickled. The file is deleted by PhotometryStore.close, or
+    when the original instance (not its copies) is garbage-collected.
 
-        phot_info = numpy.empty((3, len(rows)), dtype = dtype)
+    """
+
+    def __init__(self, db, pfilter, dir = None):
+        """ Read the photometry of all the stars of a LEMONdB in a filter.
 
-        # A cache, mapping each Unix time to its index in phot_info; passed
-        # to the constructor of DBStar for O(1) lookups of Unix times
-        times_indexes = {}
+        The photometry is processed in the data type of the LEMONdB. The
+        temporary file is created in the 'dir' directory, if given, or in
+        the default directory for temporary files (see tempfile.mkstemp).
+        As this may be a file system in memory, such as /tmp, a directory on
+        disk (e.g., that of the database) should be given for large campaigns.
 
-        for index, row in enumerate(rows):
-            unix_time, magnitude, snr = row
-            phot_info[0][index] = unix_time
-            phot_info[1][index] = magnitude
-            phot_info[2][index] = snr
-            times_indexes[unix_time] = index
-        return DBStar(id_, pfilter, phot_info, times_indexes, dtype = dtype)
+        """
+
+        self.pfilter = pfilter
+        self.dtype = db.dtype
+        self.star_ids = list(db.star_ids)
+        self.time_axis = db._get_time_axis(pfilter)
+        nstars, nimages = len(self.star_ids), len(self.time_axis)
+        self.shape = (nstars, 2, nimages)
+
+        fd, self.path = tempfile.mkstemp(prefix = 'photometry_', suffix = '.npy',
+                                         dir = dir)
+        os.close(fd)
+        self._owner = True
+        self._photometry = self._map('w+')
+
+        self.masks = numpy.empty((nstars, (nimages + 7) // 8), dtype = numpy.uint8)
+        self.sizes = numpy.empty(nstars, dtype = int)
+        self.medians = numpy.empty(nstars, dtype = numpy.float64)
+        for index, star_id in enumerate(self.star_ids):
+            star = db.get_photometry(star_id, pfilter)
+            row = self._photometry[index]
+            row.fill(numpy.nan)
+            row[:, star._axis_indexes] = star._values
+            self.masks[index] = star._mask
+            self.sizes[index] = len(star)
+            median = numpy.median(star._magnitudes) if len(star) else numpy.nan
+            self.medians[index] = median
+        self._photometry.flush()
+
+    def _map(self, mode):
+        """ Memory-map the file of the photometry, in this mode """
+        # NumPy cannot memory-map empty files: use an array in memory instead
+        if not all(self.shape):
+            return numpy.empty(self.shape, dtype = self.dtype)
+        return numpy.memmap(self.path, dtype = self.dtype, mode = mode,
+                            shape = self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_photometry']
+        state['_owner'] = False # only the original instance deletes the file
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._photometry = self._map('r')
+
+    def __len__(self):
+        """ Return the number of stars """
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """ Return the DBStar of the index-th star """
+
+        if not -len(self) <= index < len(self):
+            raise IndexError("index out of range")
+        index %= len(self)
+
+        mask = self.masks[index].copy()
+        observed = numpy.unpackbits(mask)[:len(self.time_axis)]
+        indexes = numpy.flatnonzero(observed)
+        values = numpy.asarray(self._photometry[index][:, indexes])
+        indexes = indexes.astype(axis_index_dtype(len(self.time_axis)))
+        return DBStar._on_time_axis(self.star_ids[index], self.pfilter, values,
+                                    indexes, mask, self.time_axis,
+                                    dtype = self.dtype)
+
+    def blocks(self, indexes, nbytes):
+        """ Split some of the stars into blocks that fit in an amount of memory.
+
+        Sort the stars at these positions of the sequence by the median of
+        their magnitudes, and split them into consecutive blocks so that the
+        DBStars of each block take up at most 'nbytes' bytes (except if a
+        single star needs more than that, in which case its block contains
+        only it). Stars with no records go last. Return a list of lists of
+        indexes, so that the DBStars of each block can be read (and then
+        discarded) one block at a time, by increasing magnitude.
+
+        """
+
+        # The magnitude and SNR, and the position in the time axis
+        record_nbytes = 2 * numpy.dtype(self.dtype).itemsize + \
+                        axis_index_dtype(len(self.time_axis)).itemsize
+
+        indexes = numpy.asarray(indexes, dtype = int)
+        order = numpy.argsort(self.medians[indexes], kind = 'mergesort')
+
+        blocks = []
+        block, block_nbytes = [], 0
+        for index in indexes[order]:
+            star_nbytes = self.sizes[index] * record_nbytes
+            if block and block_nbytes + star_nbytes > nbytes:
+                blocks.append(block)
+                block, block_nbytes = [], 0
+            block.append(int(index))
+            block_nbytes += star_nbytes
+        if block:
+            blocks.append(block)
+        return blocks
+
+    def close(self):
+        """ Delete the temporary file, if this is the original instance """
+        if getattr(self, '_owner', False) and os.path.exists(self.path):
+            self._photometry = None
+            os.unlink(self.path)
+
+    def __del__(self):
+        self.close()
 
 
 # The parameters used for aperture photometry
@@ -202,13 +844,65 @@ typename = 'Image'
 field_names = "path pfilter unix_time object airmass gain ra dec"
 Image = collections.namedtuple(typename, field_names)
 
+# The photometry of all the stars in a filter (see get_photometry_matrix)
+typename = 'PhotometryMatrix'
+field_names = "pfilter star_ids image_ids unix_times magnitudes snrs observed"
+
+class PhotometryMatrix(collections.namedtuple(typename, field_names)):
+    """ The photometry of all the stars in a filter, as dense arrays.
+
+    A named tuple, as returned by LEMONdB.get_photometry_matrix, with seven
+    fields: the photometric filter; a list with the IDs of the stars, in
+    ascending order; and, sorted by their Unix time, a NumPy array with the
+    IDs of the images and another with their Unix times (the time axis of
+    the filter, see LEMONdB._get_time_axis). Then, three (stars x images)
+    NumPy arrays: the instrumental magnitudes and SNRs, in the data type of
+    the LEMONdB, with NaN where there is no record, and a Boolean mask,
+    True where the star was observed in the image.
+
+    """
+
+    __slots__ = ()
+
+    def dbstars(self):
+        """ Return a list with the DBStar of each star.
+
+        The DBStars, in the same order as 'star_ids', are identical to those
+        returned by LEMONdB.get_photometry, sharing the same time axis, but
+        are built from the arrays, without any further query.
+
+        """
+
+        dtype = self.magnitudes.dtype.type
+        index_dtype = axis_index_dtype(len(self.unix_times))
+        masks = numpy.packbits(self.observed, axis = 1)
+        stars = []
+        for index, star_id in enumerate(self.star_ids):
+            indexes = numpy.flatnonzero(self.observed[index])
+            values = numpy.array([self.magnitudes[index, indexes],
+                                  self.snrs[index, indexes]])
+            star = DBStar._on_time_axis(star_id, self.pfilter, values,
+                                        indexes.astype(index_dtype),
+                                        masks[index], self.unix_times,
+                                        dtype = dtype)
+            stars.append(star)
+        return stars
+
+
 class LightCurve(object):
     """ The data points of a graph of light intensity of a celestial object.
 
     Encapsulates a series of Unix times linked to a differential magnitude with
-    a signal-to-noise ratio. Internally stored as a list of three-element
-    tuples, but we are implementing the add method so that we can interact with
-    it as if it were a set, moving us up one level in the abstraction ladder.
+    a signal-to-noise ratio. Internally stored as three parallel NumPy arrays,
+    which grow as points are added, but we are implementing the add method so
+    that we can interact with it as if it were a set, moving us up one level
+    in the abstraction ladder. Indexing returns the points in the order in
+    which they were added, while iterating over the curve, or reading its
+    'unix_times', 'magnitudes' and 'snrs' arrays, returns them sorted
+    chronologically. As points are almost always added in chronological
+    order (for example, by LEMONdB.get_light_curve), the arrays are usually
+    sorted already, and are returned without needing to sort them. Missing
+    signal-to-noise ratios (None) are stored as NaN.
 
     """
 
@@ -229,38 +923,166 @@ class LightCurve(object):
         if len(cstars) != len(cweights):
             msg = "number of weights must equal that of comparison stars"
             raise ValueError(msg)
-        if not cstars:
+        if not len(cstars):
             msg = "at least one comparison star is needed"
             raise ValueError(msg)
 
-        self._data = []
+        # The arrays have room for more points than those in the curve, whose
+        # number is given by '_size', so that adding a point one at a time is
+        # done in amortized constant time. '_sorted' is True while the points
+        # have been added in chronological order; otherwise, '_order' caches
+        # the indexes that sort them (or None, if they must be computed).
+        self._unix_times = numpy.empty(0, dtype = numpy.float64)
+        self._magnitudes = numpy.empty(0, dtype = numpy.float64)
+        self._snrs = numpy.empty(0, dtype = numpy.float64)
+        self._size = 0
+        self._sorted = True
+        self._order = None
+
         self.pfilter = pfilter
         self.cstars = cstars
         self.cweights = cweights
         self.cstdevs = cstdevs
         self.dtype = dtype
 
+    def _reserve(self, size):
+        """ Make sure that the arrays have room for at least 'size' points """
+
+        capacity = len(self._unix_times)
+        if size > capacity:
+            capacity = max(size, 2 * capacity, 16)
+            for name in ('_unix_times', '_magnitudes', '_snrs'):
+                array = numpy.empty(capacity, dtype = numpy.float64)
+                array[:self._size] = getattr(self, name)[:self._size]
+                setattr(self, name, array)
+
     def add(self, unix_time, magnitude, snr):
         """ Add a data point to the light curve """
-        self._data.append((unix_time, magnitude, snr))
+
+        index = self._size
+        self._reserve(index + 1)
+        if index and unix_time < self._unix_times[index - 1]:
+            self._sorted = False
+        self._unix_times[index] = unix_time
+        self._magnitudes[index] = magnitude
+        self._snrs[index] = numpy.nan if snr is None else snr
+        self._size += 1
+        self._order = None
+
+    def extend(self, unix_times, magnitudes, snrs):
+        """ Add multiple data points to the light curve at once.
+
+        The three arguments are sequences (or NumPy arrays) of the same length,
+        with the Unix times, magnitudes and signal-to-noise ratios of the data
+        points, which are added in this order, as if LightCurve.add were called
+        for each one of them, but without looping over the points in Python.
+
+        """
+
+        # Always copies, so that the arrays can be used directly as storage
+        unix_times = numpy.array(unix_times, dtype = numpy.float64)
+        magnitudes = numpy.array(magnitudes, dtype = numpy.float64)
+        snrs = numpy.array(snrs, dtype = numpy.float64) # None becomes NaN
+        if not len(unix_times) == len(magnitudes) == len(snrs):
+            raise ValueError("all the arrays must have the same length")
+        if not len(unix_times):
+            return
+
+        start, end = self._size, self._size + len(unix_times)
+        if numpy.any(unix_times[1:] < unix_times[:-1]) or \
+           (start and unix_times[0] < self._unix_times[start - 1]):
+            self._sorted = False
+
+        if not start:
+            self._unix_times = unix_times
+            self._magnitudes = magnitudes
+            self._snrs = snrs
+        else:
+            self._reserve(end)
+            self._unix_times[start:end] = unix_times
+            self._magnitudes[start:end] = magnitudes
+            self._snrs[start:end] = snrs
+        self._size = end
+        self._order = None
 
     def __len__(self):
-        return len(self._data)
+        return self._size
+
+    @staticmethod
+    def _point(unix_time, magnitude, snr):
+        """ Return a (unix_time, magnitude, snr) tuple of Python floats """
+        return unix_time, magnitude, None if snr != snr else snr # NaN
 
     def __getitem__(self, index):
-        return self._data[index]
+        """ Return the index-th point added to the light curve """
+
+        if isinstance(index, slice):
+            return [self[x] for x in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("light curve index out of range")
+        return self._point(self._unix_times[index].item(),
+                           self._magnitudes[index].item(),
+                           self._snrs[index].item())
+
+    def _chronological(self, array):
+        """ Return a read-only view of the values of an array that correspond
+        to the points of the curve, sorted chronologically """
+
+        array = array[:self._size]
+        if not self._sorted:
+            if self._order is None:
+                unix_times = self._unix_times[:self._size]
+                # A stable sort, so that points with the same Unix time keep
+                # the order in which they were added, as Python's sorted does.
+                self._order = numpy.argsort(unix_times, kind = 'mergesort')
+            array = array[self._order]
+        view = array.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def unix_times(self):
+        """ The Unix times of the points, chronologically sorted """
+        return self._chronological(self._unix_times)
+
+    @property
+    def magnitudes(self):
+        """ The magnitudes of the points, chronologically sorted """
+        return self._chronological(self._magnitudes)
+
+    @property
+    def snrs(self):
+        """ The signal-to-noise ratios (NaN if missing) of the points,
+        chronologically sorted """
+        return self._chronological(self._snrs)
 
     def __iter__(self):
         """ Return a copy of the (unix_time, magnitude, snr) tuples,
         chronologically sorted"""
-        return iter(sorted(self._data, key = operator.itemgetter(0)))
+
+        snrs = self.snrs
+        missing = numpy.isnan(snrs)
+        if missing.any():
+            snrs = snrs.astype(object)
+            snrs[missing] = None
+        columns = (self.unix_times, self.magnitudes, snrs)
+        return itertools.izip(*(x.tolist() for x in columns))
+
+    def __getstate__(self):
+        """ Pickle only the points of the curve, not the unused room """
+
+        state = self.__dict__.copy()
+        for name in ('_unix_times', '_magnitudes', '_snrs'):
+            state[name] = state[name][:self._size].copy()
+        return state
 
     @property
     def stdev(self):
         if not self:
             raise ValueError("light curve is empty")
-        magnitudes = [mag for unix_time, mag, snr in self._data]
-        return numpy.std(numpy.array(magnitudes, dtype = self.dtype))
+        return numpy.std(self._magnitudes[:self._size].astype(self.dtype))
 
     def weights(self):
         """ Return a generator over the comparison stars and their weights.
@@ -296,10 +1118,37 @@ class LightCurve(object):
         if not self:
             raise ValueError("light curve is empty")
 
-        magnitudes = sorted(mag for unix_time, mag, snr in self._data)
+        magnitudes = numpy.sort(self._magnitudes[:self._size])
         func = numpy.median if median else numpy.mean
         return func(magnitudes[-npoints:]) - func(magnitudes[:npoints])
 
+    def fold(self, periods, epoch = None):
+        """ Return the phases of the points, folded at one or more periods.
+
+        Fold the Unix times of the points at the periods, in seconds, with
+        fold_phases: the phases are returned along the last axis of the array,
+        in the same (chronological) order as the 'magnitudes' and 'snrs' of
+        the light curve, with a row for each period if there is more than one.
+        By default, the epoch of the folding is the first Unix time.
+
+        """
+
+        return fold_phases(self.unix_times, periods, epoch = epoch)
+
+    def phase_bins(self, periods, nbins, epoch = None):
+        """ Fold the light curve at one or more periods and bin it by phase.
+
+        Return a PhaseBins named tuple (see bin_phases) with the number of
+        points and the mean and standard deviation of their magnitudes in each
+        of the 'nbins' phase bins, for each of the periods, in seconds, at which
+        the light curve is folded. The dispersion() of the result may be used
+        to find, among many trial periods, the one that fits the curve best.
+
+        """
+
+        phases = self.fold(periods, epoch = epoch)
+        return bin_phases(phases, self.magnitudes, nbins)
+
     def ignore_noisy(self, snr):
         """ Return a copy of the LightCurve without noisy points.
 
@@ -310,8 +1159,15 @@ class LightCurve(object):
         """
 
         curve = copy.deepcopy(self)
-        # _data stores three-element tuples: (Unix time, magnitude, snr)
-        curve._data = [x for x in curve._data if x[-1] >= snr]
+        # Missing SNRs (NaN) are never >= snr, as None was not in Python 2
+        keep = curve._snrs[:curve._size] >= snr
+        columns = [x[:curve._size][keep] for x in
+                   (curve._unix_times, curve._magnitudes, curve._snrs)]
+        curve._unix_times = curve._magnitudes = curve._snrs = numpy.empty(0)
+        curve._size = 0
+        curve._sorted = True
+        curve._order = None
+        curve.extend(*columns)
         return curve
 
 
@@ -342,10 +1198,38 @@ class DuplicateLightCurvePointError(sqlite3.IntegrityError):
 class LEMONdB(object):
     """ Interface to the SQLite database used to store our results """
 
-    def __init__(self, path, dtype = numpy.longdouble):
+    def __init__(self, path, dtype = numpy.longdouble, profile = 'default'):
 
         self.path = path
         self.dtype = dtype
+        # The connection profile (see PRAGMA_PROFILES and set_profile), and
+        # the original values of the pragmas that it changed, to restore them
+        self.profile = 'default'
+        self._saved_pragmas = []
+        # Map each photometric filter to its time axis (see _get_time_axis)
+        self._time_axes = {}
+        # The IDs of the stars, as a sorted list and as a dictionary mapping
+        # each of them to its index in the list, and, for each photometric
+        # filter, a dictionary mapping the Unix time of each image to its ID.
+        # They are read from the database the first time that they are needed,
+        # and discarded when a star or image is added (or if the changes are
+        # rolled back), so that they are read again.
+        self._star_ids = None
+        self._star_indexes = None
+        self._image_ids = {}
+        # Also cached: for each photometric filter, the IDs of its images and
+        # their Unix times, as arrays (see _get_image_times); and, for the
+        # 'photometry' and 'light_curves' tables, the IDs of the filters that
+        # have packed records (see _packed_filters).
+        self._image_times = {}
+        self._packed = {}
+        # The spatial index of the stars (see _get_sky_index), built the first
+        # time that we search for stars by their celestial coordinates and, as
+        # with the star IDs, discarded when a new star is added to the LEMONdB.
+        self._sky_index = None
+        # The names of the tables and indexes in the database, read from the
+        # schema the first time that they are needed (see LEMONdB._in_schema)
+        self._schema = None
         self.connection = sqlite3.connect(self.path, isolation_level = None)
         self._cursor = self.connection.cursor()
 
@@ -358,11 +1242,26 @@ class LEMONdB(object):
         self._start()
         self._create_tables()
         self.commit()
+        self.set_profile(profile)
 
-    def __del__(self):
-        self._cursor.close()
+    def close(self):
+        """ Close the connection to the database.
+
+        Changes that have not been committed are discarded, and the LEMONdB
+        cannot be used any more (the sqlite3 module raises ProgrammingError).
+        The connection is otherwise closed only when the LEMONdB is garbage
+        collected, which may be much later if references to it are kept. It
+        is safe to close a LEMONdB more than once.
+
+        """
+
+        # Closing the connection also invalidates its cursors; unlike those,
+        # sqlite3 connections can be closed again without raising an error
         self.connection.close()
 
+    def __del__(self):
+        self.close()
+
     def _execute(self, query, t = ()):
         """ Execute SQL query; returns nothing """
         self._cursor.execute(query, t)
@@ -386,6 +1285,48 @@ class LEMONdB(object):
         self._end()
         self._start()
 
+    def _get_pragma(self, pragma):
+        """ Return the current value of a SQLite pragma, None if unsupported """
+        self._execute("PRAGMA %s" % pragma)
+        row = self._rows.fetchone()
+        return row[0] if row else None
+
+    def set_profile(self, name):
+        """ Switch to another connection profile, committing first.
+
+        Set the SQLite pragmas of the connection profile with this name (see
+        PRAGMA_PROFILES), after restoring the original values of those that
+        were set by the current profile. For example, switching back to the
+        'default' profile after 'bulk-write' returns the database to the
+        rollback journal, removing the write-ahead log, which should be done
+        once the data has been stored: otherwise, the database cannot be
+        opened if the user does not have write permission on its directory.
+        The pragmas cannot be set within a transaction, so the current one
+        is committed. ValueError is raised if there is no such profile.
+
+        """
+
+        if name not in PRAGMA_PROFILES:
+            raise ValueError("unknown connection profile '%s'" % name)
+
+        self._end()
+        try:
+            # In reverse order, as 'query_only' must be disabled first
+            for pragma, value in reversed(self._saved_pragmas):
+                self._execute("PRAGMA %s = %s" % (pragma, value))
+            self._saved_pragmas = []
+            self.profile = 'default'
+
+            for pragma, value in PRAGMA_PROFILES[name]:
+                original = self._get_pragma(pragma)
+                if original is None: # e.g., mmap_size, if mmap is disabled
+                    continue
+                self._saved_pragmas.append((pragma, original))
+                self._execute("PRAGMA %s = %s" % (pragma, value))
+            self.profile = name
+        finally:
+            self._start()
+
     def _savepoint(self, name = None):
         """ Start a new savepoint, use a random name if not given any.
         Returns the name of the savepoint that was started. """
@@ -398,6 +1339,20 @@ class LEMONdB(object):
     def _rollback_to(self, name):
         """ Revert the state of the database to a savepoint """
         self._execute("ROLLBACK TO %s" % name)
+        # Stars or images may have been removed: do not trust the caches
+        self._clear_caches()
+
+    def _clear_caches(self):
+        """ Discard the star IDs, image IDs, time axes, sky index and schema """
+        self._star_ids = None
+        self._star_indexes = None
+        self._sky_index = None
+        self._image_ids.clear()
+        self._image_times.clear()
+        self._time_axes.clear()
+        self._packed.clear()
+        # Also the schema, as the creation of a table may have been reverted
+        self._schema = None
 
     def _release(self, name):
         """ Remove from the transaction stack all savepoints back to and
@@ -421,6 +1376,89 @@ class LEMONdB(object):
         self._execute("ANALYZE")
         self.commit()
 
+    def vacuum(self):
+        """ Commit and run the VACUUM command, shrinking the database file.
+
+        SQLite does not return to the file system the space freed when rows
+        are deleted (for example, after LEMONdB.pack), but reuses it for new
+        rows. The VACUUM command rebuilds the database into a minimal amount
+        of disk space, which requires as much free disk space as its size, at
+        most. It cannot be run within a transaction, so the current one is
+        committed first. [https://www.sqlite.org/lang_vacuum.html]
+
+        """
+
+        self._end()
+        self._execute("VACUUM")
+        self._start()
+
+    # The tables and indexes that were added to the LEMONdB after its schema
+    # was first defined. Unlike those of LEMONdB._create_tables, they are not
+    # created when the database is opened, but the first time that they are
+    # written to (see LEMONdB._create_lazily), and the methods that read from
+    # them work also if they do not exist. This way, databases created by an
+    # older version of LEMON can be opened without modifying their schema,
+    # which would fail if they are read-only (as those written by photometry
+    # and diffphot are) or if another process is writing to them.
+    LAZY_SCHEMA = {
+        # Find the light curve points in each image (LEMONdB.get_curveless_times)
+        'curve_by_image' :
+            "CREATE INDEX IF NOT EXISTS curve_by_image "
+            "ON light_curves(image_id)",
+
+        # The stars for which diffphot has already computed (or tried to, as
+        # there may not be enough comparison stars) the light curve in each
+        # photometric filter, so that an interrupted execution can be resumed.
+        'processed_stars' : '''
+            CREATE TABLE IF NOT EXISTS processed_stars (
+                star_id   INTEGER NOT NULL,
+                filter_id INTEGER NOT NULL,
+                FOREIGN KEY (star_id)   REFERENCES stars(id),
+                FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
+                UNIQUE (star_id, filter_id))
+            ''',
+
+        # The photometry and light curves moved out of their tables by the
+        # method LEMONdB.pack: all the records of a star in a photometric
+        # filter, compressed into a single string (see pack_records), instead
+        # of one row (and index entries) per record. The records of each star
+        # and filter are stored either here or in those tables, never both.
+        'packed_photometry' : '''
+            CREATE TABLE IF NOT EXISTS packed_photometry (
+                star_id   INTEGER NOT NULL,
+                filter_id INTEGER NOT NULL,
+                records   BLOB NOT NULL,
+                FOREIGN KEY (star_id)   REFERENCES stars(id),
+                FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
+                PRIMARY KEY (star_id, filter_id))
+            ''',
+
+        'packed_light_curves' : '''
+            CREATE TABLE IF NOT EXISTS packed_light_curves (
+                star_id   INTEGER NOT NULL,
+                filter_id INTEGER NOT NULL,
+                records   BLOB NOT NULL,
+                FOREIGN KEY (star_id)   REFERENCES stars(id),
+                FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
+                PRIMARY KEY (star_id, filter_id))
+            ''',
+        }
+
+    def _in_schema(self, name):
+        """ Return True if the database has a table or index with this name """
+
+        if self._schema is None:
+            self._execute("SELECT name FROM sqlite_master")
+            self._schema = set(row[0] for row in self._rows)
+        return name in self._schema
+
+    def _create_lazily(self, name):
+        """ Create a table or index of LAZY_SCHEMA, unless it already exists """
+
+        if not self._in_schema(name):
+            self._execute(self.LAZY_SCHEMA[name])
+            self._schema.add(name)
+
     def _create_tables(self):
         """ Create, if needed, the tables used by the database """
 
@@ -889,6 +1927,9 @@ class LEMONdB(object):
             self._execute("INSERT INTO images "
                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", t)
             self._release(mark)
+            self._time_axes.pop(image.pfilter, None)
+            self._image_ids.pop(image.pfilter, None)
+            self._image_times.pop(image.pfilter, None)
 
         except Exception as e:
             self._rollback_to(mark)
@@ -917,27 +1958,135 @@ class LEMONdB(object):
             # above, so re-raise the original exception, whatever it is.
             raise e
 
+    def _get_image_ids(self, pfilter):
+        """ Return a dictionary mapping Unix times to image IDs in a filter.
+
+        The dictionary maps the Unix time of each image in the 'pfilter'
+        photometric filter to its ID in the database. It is cached, so the
+        images are read only the first time, until another image in this
+        filter is added. It must not be modified by the caller.
+
+        """
+
+        try:
+            return self._image_ids[pfilter]
+        except KeyError:
+            self._execute("SELECT unix_time, id "
+                          "FROM images INDEXED BY img_by_filter_time "
+                          "WHERE filter_id = ?", (hash(pfilter),))
+            image_ids = self._image_ids[pfilter] = dict(self._rows)
+            return image_ids
+
     def _get_image_id(self, unix_time, pfilter):
         """ Return the ID of the Image with this Unix time and filter.
         Raises KeyError if there is no image for this date and filter"""
 
-        # Note the cast to Python's built-in float. Otherwise, if the method
-        # gets a NumPy float, SQLite raises "sqlite3.InterfaceError: Error
-        # binding parameter - probably unsupported type"
-        t = (float(unix_time), hash(pfilter))
-        self._execute("SELECT id "
-                      "FROM images INDEXED BY img_by_filter_time "
-                      "WHERE unix_time = ? "
-                      "  AND filter_id = ?", t)
-        rows = list(self._rows)
-        if not rows:
+        # Note the cast to Python's built-in float: the Unix time is looked up
+        # in a dictionary, and a NumPy float of a different precision (e.g.,
+        # numpy.longdouble) does not necessarily have the same hash value.
+        try:
+            return self._get_image_ids(pfilter)[float(unix_time)]
+        except KeyError:
             msg = "%.4f (%s) and filter %s"
             args = unix_time, methods.utctime(unix_time), pfilter
             raise KeyError(msg % args)
+
+    def _get_time_axis(self, pfilter):
+        """ Return the Unix times of the images in a photometric filter.
+
+        The method returns a sorted NumPy array with the Unix times of all the
+        images taken in the 'pfilter' photometric filter: the time axis of the
+        campaign, over which the DBStars returned by LEMONdB.get_photometry
+        compute their observation bitmasks. The array is cached, so that the
+        same object is returned (and shared among the DBStars) until an image
+        in this photometric filter is added to the database.
+
+        """
+
+        try:
+            return self._time_axes[pfilter]
+        except KeyError:
+            t = (hash(pfilter), )
+            self._execute("SELECT unix_time "
+                          "FROM images INDEXED BY img_by_filter_time "
+                          "WHERE filter_id = ? "
+                          "  AND unix_time IS NOT NULL "
+                          "ORDER BY unix_time ASC", t)
+            axis = numpy.array([x[0] for x in self._rows], dtype = numpy.float64)
+            self._time_axes[pfilter] = axis
+            return axis
+
+    def _get_image_times(self, pfilter, image_ids):
+        """ Return the Unix times of the images with these IDs.
+
+        The method returns a NumPy array with the Unix time of each of the
+        images, in the 'pfilter' photometric filter, whose IDs are in the
+        NumPy array 'image_ids'. This is the inverse of _get_image_ids, used
+        to read the packed records (see LEMONdB.pack), which refer to images
+        by their ID. The sorted IDs of the images of each filter, and their
+        Unix times, are cached, like the image IDs themselves. KeyError is
+        raised if any of the IDs is not that of an image in this filter.
+
+        """
+
+        try:
+            ids, unix_times = self._image_times[pfilter]
+        except KeyError:
+            items = sorted((id_, unix_time) for unix_time, id_ in
+                           self._get_image_ids(pfilter).iteritems()
+                           if unix_time is not None)
+            ids = numpy.array([x[0] for x in items], dtype = numpy.int64)
+            unix_times = numpy.array([x[1] for x in items], dtype = numpy.float64)
+            self._image_times[pfilter] = ids, unix_times
+
+        indexes = numpy.searchsorted(ids, image_ids)
+        if len(indexes) and (not len(ids) or
+            not numpy.all(ids.take(indexes, mode = 'clip') == image_ids)):
+            msg = "image IDs not in filter %s" % pfilter
+            raise KeyError(msg)
+        return unix_times[indexes]
+
+    def get_curveless_times(self, pfilter):
+        """ Return the Unix times of the images without light curve points.
+
+        The method returns a sorted NumPy array with the Unix times of those
+        images, taken in the 'pfilter' photometric filter, which do not yet
+        have a point in any of the light curves stored in the database. These
+        are, when light curves are updated after new images are added to the
+        database (diffphot's --update option), the images over which they have
+        to be extended.
+
+        """
+
+        # The index is created when light curves are stored; on databases
+        # created by older versions of LEMON it may not exist yet, in which
+        # case SQLite builds an automatic index for the duration of the query.
+        if self._in_schema('curve_by_image'):
+            indexed_by = "INDEXED BY curve_by_image"
         else:
-            assert len(rows) == 1
-            assert len(rows[0]) == 1
-            return rows[0][0]
+            indexed_by = ""
+
+        t = (hash(pfilter),)
+        self._execute("SELECT unix_time "
+                      "FROM images AS img INDEXED BY img_by_filter_time "
+                      "WHERE img.filter_id = ? "
+                      "  AND NOT EXISTS (SELECT 1 "
+                      "                  FROM light_curves AS curve "
+                      "                  %s "
+                      "                  WHERE curve.image_id = img.id) "
+                      "ORDER BY unix_time ASC" % indexed_by, t)
+        unix_times = numpy.array([row[0] for row in self._rows], dtype = numpy.float64)
+
+        # Exclude also the images with points in the packed light curves
+        if unix_times.size and hash(pfilter) in self._packed_filters('light_curves'):
+            self._execute("SELECT records FROM packed_light_curves "
+                          "WHERE filter_id = ?", t)
+            image_ids = [unpack_records(row[0])[0] for row in self._rows]
+            if image_ids:
+                image_ids = numpy.unique(numpy.concatenate(image_ids))
+                packed = self._get_image_times(pfilter, image_ids)
+                unix_times = numpy.setdiff1d(unix_times, packed)
+        return unix_times
 
     def get_image(self, unix_time, pfilter):
         """ Return the Image observed at a Unix time and photometric filter.
@@ -977,6 +2126,9 @@ class LEMONdB(object):
         try:
             stmt = "INSERT INTO stars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
             self._execute(stmt, t)
+            self._star_ids = None
+            self._star_indexes = None
+            self._sky_index = None
         except sqlite3.IntegrityError:
             if __debug__:
                 self._execute("SELECT id FROM stars")
@@ -1008,13 +2160,49 @@ class LEMONdB(object):
 
     def __len__(self):
         """ Return the number of stars in the database """
-        return self._table_count('STARS')
+        self._load_star_ids()
+        return len(self._star_ids)
+
+    def _load_star_ids(self):
+        """ Read the IDs of the stars from the database, unless cached """
+        if self._star_ids is None:
+            self._execute("SELECT id FROM stars ORDER BY id ASC")
+            self._star_ids = list(x[0] for x in self._rows)
+            self._star_indexes = dict((id_, index) for index, id_ in
+                                      enumerate(self._star_ids))
 
     @property
     def star_ids(self):
-        """ Return a list with the ID of the stars, in ascending order """
-        self._execute("SELECT id FROM stars ORDER BY id ASC")
-        return list(x[0] for x in self._rows)
+        """ Return a list with the ID of the stars, in ascending order.
+
+        The IDs are read from the database only the first time, and then kept
+        in memory until a star is added. A new list is returned each time, so
+        it can be modified by the caller. To check whether there is a star
+        with some ID, use LEMONdB._has_star instead, which does not need to
+        build the list.
+
+        """
+
+        self._load_star_ids()
+        return list(self._star_ids)
+
+    def _has_star(self, star_id):
+        """ Return True if there is a star with this ID in the database """
+        self._load_star_ids()
+        return star_id in self._star_indexes
+
+    def _star_index(self, star_id):
+        """ Return the index of a star in LEMONdB.star_ids.
+
+        This is the position of the star with this ID in the list of IDs, in
+        ascending order, and therefore also in the sequences of DBStars built
+        from it, such as those returned by PhotometryMatrix.dbstars. Raises
+        KeyError if there is no star with this ID in the database.
+
+        """
+
+        self._load_star_ids()
+        return self._star_indexes[star_id]
 
     def add_pm_correction(self, star_id, unix_time, pfilter, pm_x, pm_y):
         """ Store the proper-motion corrected pixel coordinates of a star.
@@ -1059,6 +2247,55 @@ class LEMONdB(object):
         stmt = "INSERT INTO pm_corrections VALUES (?, ?, ?, ?, ?)"
         self._execute(stmt, t)
 
+    def add_pm_corrections(self, star_ids, unix_time, pfilter, xs, ys):
+        """ Store the proper-motion corrections of many stars in an image.
+
+        Store, at once, the proper-motion corrected x- and y-coordinates (the
+        sequences 'xs' and 'ys') where photometry of the stars whose IDs are
+        in 'star_ids' was done in the image with this Unix time and filter.
+        This is equivalent to calling LEMONdB.add_pm_correction for each star,
+        and the same exceptions are raised, but the image ID is looked up once,
+        the proper motions of the stars are read with a single query and the
+        rows are inserted with one call to executemany(). The database is
+        modified atomically: either all the corrections are stored, or none.
+
+        """
+
+        star_ids = [int(star_id) for star_id in star_ids]
+        xs = numpy.asarray(xs, dtype = numpy.float64).tolist()
+        ys = numpy.asarray(ys, dtype = numpy.float64).tolist()
+        if not len(star_ids) == len(xs) == len(ys):
+            raise ValueError("all the sequences must have the same length")
+
+        self._execute("SELECT id, pm_ra IS NOT NULL AND pm_dec IS NOT NULL "
+                      "FROM stars")
+        has_pm = dict(self._rows)
+        for star_id in star_ids:
+            if star_id not in has_pm:
+                msg = "star with ID = %d not in database" % star_id
+                raise UnknownStarError(msg)
+            if not has_pm[star_id]:
+                msg = ("astronomical object with ID = %d does not have proper "
+                       "motions, so we cannot store proper-motion corrections "
+                       "for it. Where do these values come from?" % star_id)
+                raise ValueError(msg)
+
+        try:
+            image_id = self._get_image_id(unix_time, pfilter)
+        except KeyError, e:
+            raise UnknownImageError(str(e))
+
+        rows = itertools.izip(itertools.repeat(None), star_ids,
+                              itertools.repeat(image_id), xs, ys)
+        mark = self._savepoint()
+        try:
+            self._cursor.executemany("INSERT INTO pm_corrections "
+                                     "VALUES (?, ?, ?, ?, ?)", rows)
+            self._release(mark)
+        except:
+            self._rollback_to(mark)
+            raise
+
     def get_pm_correction(self, star_id, unix_time, pfilter):
         """ Return the proper-motion correction of a star in an image.
 
@@ -1081,7 +2318,7 @@ class LEMONdB(object):
             rows = tuple(self._rows)
             return rows[0]
         except IndexError:
-            if star_id not in self.star_ids:
+            if not self._has_star(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise KeyError(msg)
             else:
@@ -1108,13 +2345,14 @@ class LEMONdB(object):
             # method gets a NumPy float, SQLite raises "sqlite3.InterfaceError:
             # Error binding parameter - probably unsupported type"
             t = (None, star_id, image_id, float(magnitude), float(snr))
+            self._unpack('photometry', hash(pfilter), [star_id])
             self._execute("INSERT INTO photometry VALUES (?, ?, ?, ?, ?)", t)
 
         except KeyError, e:
             raise UnknownImageError(str(e))
 
         except sqlite3.IntegrityError:
-            if not star_id in self.star_ids:
+            if not self._has_star(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
 
@@ -1123,17 +2361,78 @@ class LEMONdB(object):
             args = (star_id, unix_time, methods.utctime(unix_time), pfilter)
             raise DuplicatePhotometryError(msg % args)
 
+    def add_image_photometry(self, star_ids, unix_time, pfilter, magnitudes, snrs):
+        """ Store the photometric records of many stars in the same image.
+
+        Store, at once, the magnitudes and SNRs (the sequences 'magnitudes' and
+        'snrs') of the stars whose IDs are in 'star_ids' in the image with this
+        Unix time and photometric filter. This is equivalent to calling the
+        LEMONdB.add_photometry method for each star, but much faster: the ID of
+        the image is looked up only once, instead of for every record, and all
+        the rows are inserted with a single call to executemany(). Use this
+        method to store the photometry of entire images. NumPy arrays are
+        accepted. ValueError is raised if the sequences do not have the same
+        length, and UnknownImageError if the image is not in the database.
+
+        The database is modified atomically: either all the records are stored,
+        or none of them is. If the insertion violates an integrity constraint
+        (i.e., an unknown star or a duplicate record), the changes are reverted
+        and the records are stored one by one, with add_photometry, in order
+        to raise the appropriate exception (UnknownStarError or the error
+        DuplicatePhotometryError), after which all of them are reverted.
+
+        """
+
+        # Python's built-in types, which SQLite can bind (see add_photometry)
+        star_ids = [int(star_id) for star_id in star_ids]
+        magnitudes = numpy.asarray(magnitudes, dtype = numpy.float64).tolist()
+        snrs = numpy.asarray(snrs, dtype = numpy.float64).tolist()
+        if not len(star_ids) == len(magnitudes) == len(snrs):
+            raise ValueError("all the sequences must have the same length")
+
+        try:
+            image_id = self._get_image_id(unix_time, pfilter)
+        except KeyError, e:
+            raise UnknownImageError(str(e))
+
+        rows = itertools.izip(itertools.repeat(None), star_ids,
+                              itertools.repeat(image_id), magnitudes, snrs)
+        mark = self._savepoint()
+        try:
+            self._unpack('photometry', hash(pfilter), star_ids)
+            self._cursor.executemany("INSERT INTO photometry "
+                                     "VALUES (?, ?, ?, ?, ?)", rows)
+            self._release(mark)
+
+        except sqlite3.IntegrityError:
+            self._rollback_to(mark)
+            # Store the records one by one, so that the exact error is raised
+            try:
+                for args in itertools.izip(star_ids, magnitudes, snrs):
+                    star_id, magnitude, snr = args
+                    self.add_photometry(star_id, unix_time, pfilter, magnitude, snr)
+                self._release(mark)
+            except:
+                self._rollback_to(mark)
+                raise
+
+        except:
+            self._rollback_to(mark)
+            raise
+
     def get_photometry(self, star_id, pfilter):
         """ Return the photometric information of the star.
 
         The method returns a DBStar instance with the photometric information
         of the star in a given filter. The records are sorted by their date of
         observation. Raises KeyError if 'star_id' does not match the ID of any
-        of the stars in the database.
+        of the stars in the database. All the DBStars returned for the same
+        photometric filter share the same time axis, over which their bitmask
+        of observations is defined (see LEMONdB._get_time_axis).
 
         """
 
-        if star_id not in self.star_ids:
+        if not self._has_star(star_id):
             msg = "star with ID = %d not in database" % star_id
             raise KeyError(msg)
 
@@ -1149,8 +2448,122 @@ class LEMONdB(object):
                       "  AND img.filter_id = ? "
                       "ORDER BY img.unix_time ASC", t)
 
-        args = star_id, pfilter, list(self._rows)
-        return DBStar.make_star(*args, dtype = self.dtype)
+        rows = list(self._rows)
+        packed = self._get_packed('photometry', star_id, pfilter)
+        if packed:
+            rows = sorted(rows + packed)
+
+        args = star_id, pfilter, rows
+        time_axis = self._get_time_axis(pfilter)
+        return DBStar.make_star(*args, dtype = self.dtype, time_axis = time_axis)
+
+    def get_photometry_matrix(self, pfilter):
+        """ Return the photometry of all the stars in a filter, at once.
+
+        The method returns a PhotometryMatrix, with the (stars x images) arrays
+        of the magnitudes and SNRs of all the stars in the 'pfilter' filter,
+        read with a single scan of the photometry of its images, instead of
+        with a query for each star (LEMONdB.get_photometry). The DBStars can
+        then be built from it with PhotometryMatrix.dbstars. Note that this
+        needs memory for all the images of each star, even those in which it
+        was not observed, so for sparse photometry it may be much larger than
+        the DBStars themselves (see also PhotometryStore).
+
+        """
+
+        star_ids = self.star_ids
+        unix_times = self._get_time_axis(pfilter)
+        image_ids = self._get_image_ids(pfilter)
+        image_ids = numpy.array([image_ids[unix_time] for unix_time in unix_times],
+                                dtype = int)
+
+        shape = (len(star_ids), len(unix_times))
+        magnitudes = numpy.empty(shape, dtype = self.dtype)
+        magnitudes.fill(numpy.nan)
+        snrs = magnitudes.copy()
+        observed = numpy.zeros(shape, dtype = bool)
+
+        t = (hash(pfilter), )
+        self._execute("SELECT phot.star_id, phot.image_id, "
+                      "       phot.magnitude, phot.snr "
+                      "FROM images AS img INDEXED BY img_by_filter_time "
+                      "JOIN photometry AS phot INDEXED BY phot_by_image "
+                      "ON phot.image_id = img.id "
+                      "WHERE img.filter_id = ? "
+                      "  AND img.unix_time IS NOT NULL", t)
+        rows = numpy.array(self._rows.fetchall(), dtype = numpy.float64)
+        columns = [rows.T] if len(rows) else []
+
+        # The packed records, if any, as more columns of the same four rows
+        if hash(pfilter) in self._packed_filters('photometry'):
+            self._execute("SELECT star_id, records "
+                          "FROM packed_photometry "
+                          "WHERE filter_id = ?", t)
+            for star_id, data in self._rows:
+                packed = unpack_records(data)
+                star_column = numpy.empty(len(packed[0]))
+                star_column.fill(star_id)
+                columns.append(numpy.vstack((star_column,) + packed))
+
+        if columns:
+            # Map the IDs of stars and images to their rows and columns
+            rows = numpy.hstack(columns)
+            star_indexes = numpy.searchsorted(star_ids, rows[0].astype(int))
+            order = numpy.argsort(image_ids)
+            image_indexes = order[numpy.searchsorted(image_ids, rows[1].astype(int),
+                                                     sorter = order)]
+            magnitudes[star_indexes, image_indexes] = rows[2]
+            snrs[star_indexes, image_indexes] = rows[3]
+            observed[star_indexes, image_indexes] = True
+
+        return PhotometryMatrix(pfilter, star_ids, image_ids, unix_times,
+                                magnitudes, snrs, observed)
+
+    def get_images_photometry(self, pfilter, unix_times):
+        """ Return the photometry of the stars in some of the images.
+
+        The method returns a list, sorted by star ID, with a DBStar for each
+        star observed in at least one of the images, taken in the 'pfilter'
+        photometric filter, with these Unix times, and with only its records
+        in them. Unlike LEMONdB.get_photometry_matrix, only the photometry of
+        these images is read, one image at a time, so the cost grows with the
+        number of images and not with that of the whole campaign (e.g., to
+        extend the light curves over the images that have just been added to
+        the database; see diffphot's --update option). Packed records (see
+        LEMONdB.pack), however, have to be unpacked to find those in these
+        images. The DBStars share the time axis of those returned by
+        LEMONdB.get_photometry. KeyError is raised if any of the Unix times is
+        not that of an image in this filter.
+
+        """
+
+        image_ids = self._get_image_ids(pfilter)
+        records = collections.defaultdict(list)
+        for unix_time in sorted(unix_times):
+            t = (image_ids[float(unix_time)],)
+            self._execute("SELECT star_id, magnitude, snr "
+                          "FROM photometry INDEXED BY phot_by_image "
+                          "WHERE image_id = ?", t)
+            for star_id, magnitude, snr in self._rows:
+                records[star_id].append((unix_time, magnitude, snr))
+
+        if len(unix_times) and hash(pfilter) in self._packed_filters('photometry'):
+            ids = numpy.array([image_ids[float(x)] for x in unix_times])
+            self._execute("SELECT star_id, records "
+                          "FROM packed_photometry "
+                          "WHERE filter_id = ?", (hash(pfilter),))
+            for star_id, data in self._rows.fetchall():
+                packed_ids, magnitudes, snrs = unpack_records(data)
+                wanted = numpy.in1d(packed_ids, ids)
+                if numpy.any(wanted):
+                    times = self._get_image_times(pfilter, packed_ids[wanted])
+                    rows = zip(times, magnitudes[wanted], snrs[wanted])
+                    records[star_id] = sorted(records[star_id] + rows)
+
+        time_axis = self._get_time_axis(pfilter)
+        return [DBStar.make_star(star_id, pfilter, records[star_id],
+                                 dtype = self.dtype, time_axis = time_axis)
+                for star_id in sorted(records)]
 
     def _star_pfilters(self, star_id):
         """ Return the photometric filters for which the star has data.
@@ -1162,19 +2575,30 @@ class LEMONdB(object):
 
         """
 
-        if star_id not in self.star_ids:
+        if not self._has_star(star_id):
             msg = "star with ID = %d not in database" % star_id
             raise KeyError(msg)
 
-        t = (star_id, )
-        self._execute("""SELECT DISTINCT f.name
-                         FROM (SELECT DISTINCT image_id
-                               FROM photometry INDEXED BY phot_by_star_image
-                               WHERE star_id = ?) AS phot
-                         INNER JOIN images AS img
-                         ON phot.image_id = img.id
-                         INNER JOIN photometric_filters AS f
-                         ON img.filter_id = f.id """, t)
+        t = (star_id,)
+        query = """SELECT DISTINCT f.name
+                   FROM (SELECT DISTINCT image_id
+                         FROM photometry INDEXED BY phot_by_star_image
+                         WHERE star_id = ?) AS phot
+                   INNER JOIN images AS img
+                   ON phot.image_id = img.id
+                   INNER JOIN photometric_filters AS f
+                   ON img.filter_id = f.id """
+
+        if self._in_schema('packed_photometry'):
+            t *= 2
+            query += """UNION
+                        SELECT f.name
+                        FROM packed_photometry AS packed
+                        INNER JOIN photometric_filters AS f
+                        ON packed.filter_id = f.id
+                        WHERE packed.star_id = ? """
+
+        self._execute(query, t)
 
         return sorted(passband.Passband(x[0]) for x in self._rows)
 
@@ -1190,17 +2614,190 @@ class LEMONdB(object):
 
         """
 
-        self._execute("""SELECT DISTINCT f.name
-                         FROM (SELECT DISTINCT image_id
-                               FROM photometry INDEXED BY phot_by_image)
-                               AS phot
-                         INNER JOIN images AS img
-                         ON phot.image_id = img.id
-                         INNER JOIN photometric_filters AS f
-                         ON img.filter_id = f.id """)
+        query = """SELECT DISTINCT f.name
+                   FROM (SELECT DISTINCT image_id
+                         FROM photometry INDEXED BY phot_by_image)
+                         AS phot
+                   INNER JOIN images AS img
+                   ON phot.image_id = img.id
+                   INNER JOIN photometric_filters AS f
+                   ON img.filter_id = f.id """
+
+        if self._in_schema('packed_photometry'):
+            query += """UNION
+                        SELECT f.name
+                        FROM (SELECT DISTINCT filter_id
+                              FROM packed_photometry) AS packed
+                        INNER JOIN photometric_filters AS f
+                        ON packed.filter_id = f.id """
+
+        self._execute(query)
 
         return sorted(passband.Passband(x[0]) for x in self._rows)
 
+    def _packed_filters(self, table):
+        """ Return the IDs of the filters that may have packed records.
+
+        The method returns a set with the IDs of the photometric filters for
+        which there may be packed records (see LEMONdB.pack) of the 'table'
+        table, either 'photometry' or 'light_curves'. It is cached, so that the
+        cost of checking whether a star may have packed records is negligible
+        when the database has none, which is the case unless it was packed. As
+        the set is not updated when the records of some of the stars in a
+        filter are unpacked, it may contain filters without packed records.
+        If the packed table does not exist (see LEMONdB.LAZY_SCHEMA), as the
+        database was never packed, the set is empty.
+
+        """
+
+        try:
+            return self._packed[table]
+        except KeyError:
+            if self._in_schema('packed_%s' % table):
+                self._execute("SELECT DISTINCT filter_id FROM packed_%s" % table)
+                filter_ids = set(x[0] for x in self._rows)
+            else:
+                filter_ids = set()
+            self._packed[table] = filter_ids
+            return filter_ids
+
+    def _get_packed(self, table, star_id, pfilter):
+        """ Return the packed records of a star in a photometric filter.
+
+        The method returns a list of three-element tuples (Unix time, magnitude
+        and SNR), sorted by their Unix time, with the records of the star in
+        the 'pfilter' photometric filter that are stored packed (see the method
+        LEMONdB.pack) instead of in the 'table' table, either 'photometry' or
+        'light_curves'. If there are none, an empty list is returned.
+
+        """
+
+        if hash(pfilter) not in self._packed_filters(table):
+            return []
+
+        t = (int(star_id), hash(pfilter))
+        self._execute("SELECT records FROM packed_%s "
+                      "WHERE star_id = ? AND filter_id = ?" % table, t)
+        rows = list(self._rows)
+        if not rows:
+            return []
+
+        image_ids, magnitudes, snrs = unpack_records(rows[0][0])
+        unix_times = self._get_image_times(pfilter, image_ids)
+        return zip(unix_times.tolist(), magnitudes.tolist(), snrs.tolist())
+
+    def _unpack(self, table, filter_id, star_ids = None):
+        """ Move packed records back to the rows of their table.
+
+        Store again as rows of the 'table' table ('photometry' or
+        'light_curves') the packed records (see LEMONdB.pack) in the
+        photometric filter with ID 'filter_id' of the stars whose IDs are
+        in 'star_ids', or of all the stars if it is None, and delete them
+        from the packed table. The records of a star in a filter are always
+        unpacked before new ones are added to them, so that the database
+        can check their uniqueness.
+
+        """
+
+        if filter_id not in self._packed_filters(table):
+            return
+
+        query = "SELECT star_id, records FROM packed_%s WHERE filter_id = ?" % table
+        if star_ids is None:
+            self._execute(query, (filter_id,))
+            rows = list(self._rows)
+        else:
+            rows = []
+            for star_id in set(star_ids):
+                self._execute(query + " AND star_id = ?", (filter_id, int(star_id)))
+                rows.extend(self._rows)
+
+        records = []
+        for star_id, data in rows:
+            image_ids, magnitudes, snrs = unpack_records(data)
+            records.extend(itertools.izip(itertools.repeat(None),
+                                          itertools.repeat(star_id),
+                                          image_ids.tolist(),
+                                          magnitudes.tolist(),
+                                          snrs.tolist()))
+
+        self._cursor.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % table,
+                                 records)
+        self._cursor.executemany("DELETE FROM packed_%s "
+                                 "WHERE star_id = ? AND filter_id = ?" % table,
+                                 ((star_id, filter_id) for star_id, _ in rows))
+        if star_ids is None:
+            self._packed_filters(table).discard(filter_id)
+
+    def pack(self):
+        """ Store the photometry and light curves compressed, one star at a time.
+
+        Move all the photometric records and light curve points to the packed
+        tables, where all those of each star in each photometric filter are
+        stored together, compressed into a single string (see pack_records),
+        instead of as one row per record. This usually takes up less than a
+        third of the space (rows, plus index entries, need more than 40 bytes
+        per record) and, since all the records of a star are read at once, in
+        one or a few pages, makes LEMONdB.get_photometry and get_light_curve
+        faster. Use LEMONdB.vacuum afterwards to shrink the file on disk.
+
+        Packing is transparent: the methods of LEMONdB keep working on packed
+        databases, which can also be modified. Before new records are added to
+        the packed photometry or light curve of a star, it is unpacked (moved
+        back to rows), so packed databases are better suited to read-mostly
+        use, once the photometry and light curves have been computed. The
+        database is packed atomically, and must then be committed.
+
+        """
+
+        mark = self._savepoint()
+        try:
+            for table in ('photometry', 'light_curves'):
+                # A separate cursor, as rows are inserted while it iterates
+                cursor = self.connection.cursor()
+                cursor.execute("SELECT t.star_id, img.filter_id, t.image_id, "
+                               "       t.magnitude, t.snr "
+                               "FROM %s AS t, images AS img "
+                               "ON t.image_id = img.id "
+                               "ORDER BY t.star_id, img.filter_id, "
+                               "         img.unix_time" % table)
+
+                self._create_lazily('packed_%s' % table)
+                key = operator.itemgetter(0, 1)
+                for (star_id, filter_id), group in itertools.groupby(cursor, key):
+                    columns = zip(*group)[2:]
+                    t = (star_id, filter_id, buffer(pack_records(*columns)))
+                    self._execute("INSERT INTO packed_%s "
+                                  "VALUES (?, ?, ?)" % table, t)
+                cursor.close()
+
+                self._execute("DELETE FROM %s" % table)
+                self._packed.pop(table, None)
+            self._release(mark)
+        except:
+            self._rollback_to(mark)
+            raise
+
+    def unpack(self):
+        """ Move the packed photometry and light curves back to rows.
+
+        This is the inverse of LEMONdB.pack: all the packed records, of all the
+        stars and photometric filters, are stored again as rows, one per record
+        (and then deleted from the packed tables). The database is unpacked
+        atomically, and must then be committed.
+
+        """
+
+        mark = self._savepoint()
+        try:
+            for table in ('photometry', 'light_curves'):
+                for filter_id in list(self._packed_filters(table)):
+                    self._unpack(table, filter_id)
+            self._release(mark)
+        except:
+            self._rollback_to(mark)
+            raise
+
     def _add_curve_point(self, star_id, unix_time, pfilter, magnitude, snr):
         """ Store a point of the light curve of a star.
 
@@ -1222,6 +2819,8 @@ class LEMONdB(object):
             # method gets a NumPy float, SQLite raises "sqlite3.InterfaceError:
             # Error binding parameter - probably unsupported type"
             t = (None, star_id, image_id, float(magnitude), float(snr))
+            self._unpack('light_curves', hash(pfilter), [star_id])
+            self._create_lazily('curve_by_image')
             self._execute("INSERT INTO light_curves "
                           "VALUES (?, ?, ?, ?, ?)", t)
 
@@ -1229,7 +2828,7 @@ class LEMONdB(object):
             raise UnknownImageError(str(e))
 
         except sqlite3.IntegrityError:
-            if not star_id in self.star_ids:
+            if not self._has_star(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
 
@@ -1272,7 +2871,7 @@ class LEMONdB(object):
 
         except sqlite3.IntegrityError:
             self._rollback_to(mark)
-            if star_id not in self.star_ids:
+            if not self._has_star(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
             else:
@@ -1319,6 +2918,199 @@ class LEMONdB(object):
             self._rollback_to(mark)
             raise
 
+    def add_light_curves(self, curves, extend = False):
+        """ Store the light curves of multiple stars at once.
+
+        The 'curves' argument must be a sequence or iterable of two-element
+        tuples, each one with the ID of a star and its LightCurve, which are
+        stored in the database as LEMONdB.add_light_curve would do, one after
+        another, but much faster: the IDs of the images of each photometric
+        filter are looked up only once, and all the points and comparison stars
+        are inserted with two calls to executemany(), instead of one query (and
+        one savepoint) per row. Use this method to store many light curves.
+
+        The database is modified atomically: either all the light curves are
+        stored, or none of them is. The same exceptions as add_light_curve
+        may be raised, ValueError and UnknownImageError before anything is
+        inserted. When the insertion violates an integrity constraint (i.e.,
+        an unknown star or a duplicate light curve point) the changes are
+        reverted and the light curves are stored again, this time one by one
+        with add_light_curve, in order to find out the offending curve and
+        raise the appropriate exception.
+
+        If 'extend' is True, the light curves are appended to those already
+        stored for the stars, instead of added as new ones: only their points
+        are inserted, while the comparison stars (which should be the same as
+        those of the stored curves, see LEMONdB.get_light_curve) are ignored.
+        This is how the light curves are extended over new images.
+
+        """
+
+        curves = list(curves)
+        points_rows = []
+        cstars_rows = []
+        image_ids = {} # map each filter to a {unix_time: image_id} dictionary
+
+        for star_id, light_curve in curves:
+
+            pfilter = light_curve.pfilter
+            if pfilter not in image_ids:
+                image_ids[pfilter] = self._get_image_ids(pfilter)
+            filter_ids = image_ids[pfilter]
+
+            for unix_time, magnitude, snr in light_curve:
+                # Note the casts to Python's built-in float. Otherwise, if the
+                # method gets a NumPy float, SQLite raises "sqlite3.Interface
+                # Error: Error binding parameter - probably unsupported type"
+                try:
+                    image_id = filter_ids[float(unix_time)]
+                except KeyError:
+                    msg = "%.4f (%s) and filter %s"
+                    args = unix_time, methods.utctime(unix_time), pfilter
+                    raise UnknownImageError(msg % args)
+                t = (None, star_id, image_id, float(magnitude), float(snr))
+                points_rows.append(t)
+
+            if extend:
+                continue
+
+            for cstar_id, cweight, cstdev in light_curve.weights():
+                if star_id == cstar_id:
+                    msg = "star with ID = %d cannot use itself as comparison" % star_id
+                    raise ValueError(msg)
+                t = (None, star_id, hash(pfilter), cstar_id, float(cstdev), float(cweight))
+                cstars_rows.append(t)
+
+        mark = self._savepoint()
+        try:
+            for pfilter in image_ids.iterkeys():
+                self._add_pfilter(pfilter)
+                star_ids = [star_id for star_id, light_curve in curves
+                            if light_curve.pfilter == pfilter]
+                self._unpack('light_curves', hash(pfilter), star_ids)
+            self._create_lazily('curve_by_image')
+            self._cursor.executemany("INSERT INTO light_curves "
+                                     "VALUES (?, ?, ?, ?, ?)", points_rows)
+            self._cursor.executemany("INSERT INTO cmp_stars "
+                                     "VALUES (?, ?, ?, ?, ?, ?)", cstars_rows)
+            self._release(mark)
+
+        except sqlite3.IntegrityError:
+            self._rollback_to(mark)
+            # Store the curves one by one, so that the exact error is raised;
+            # all the light curves stored until then are reverted on failure.
+            try:
+                for star_id, light_curve in curves:
+                    if not extend:
+                        self.add_light_curve(star_id, light_curve)
+                        continue
+                    for unix_time, magnitude, snr in light_curve:
+                        args = star_id, unix_time, light_curve.pfilter, magnitude, snr
+                        self._add_curve_point(*args)
+                self._release(mark)
+            except:
+                self._rollback_to(mark)
+                raise
+
+        except:
+            self._rollback_to(mark)
+            raise
+
+    def delete_light_curve(self, star_id, pfilter):
+        """ Delete the light curve of a star.
+
+        Remove from the database all the points of the light curve of the star
+        in the 'pfilter' photometric filter, as well as its comparison stars.
+        Nothing happens if the star has no light curve in this filter, while
+        KeyError is raised if no star in the database has the specified ID.
+
+        """
+
+        if not self._has_star(star_id):
+            msg = "star with ID = %d not in database" % star_id
+            raise KeyError(msg)
+
+        t = (star_id, hash(pfilter))
+        mark = self._savepoint()
+        try:
+            self._execute("DELETE FROM light_curves "
+                          "WHERE star_id = ? "
+                          "  AND image_id IN (SELECT id "
+                          "                   FROM images "
+                          "                   WHERE filter_id = ?)", t)
+            if self._in_schema('packed_light_curves'):
+                self._execute("DELETE FROM packed_light_curves "
+                              "WHERE star_id = ? "
+                              "  AND filter_id = ?", t)
+            self._execute("DELETE FROM cmp_stars "
+                          "WHERE star_id = ? "
+                          "  AND filter_id = ?", t)
+            if self._in_schema('processed_stars'):
+                self._execute("DELETE FROM processed_stars "
+                              "WHERE star_id = ? "
+                              "  AND filter_id = ?", t)
+            self._release(mark)
+        except:
+            self._rollback_to(mark)
+            raise
+
+    def add_processed_stars(self, star_ids, pfilter):
+        """ Record that the light curves of some stars have been computed.
+
+        Store in the database that the light curves of the stars whose IDs
+        are in 'star_ids' have been computed in the 'pfilter' photometric
+        filter, including those for which it was not possible (for example,
+        because of a lack of comparison stars), and which therefore have no
+        light curve. Stars already recorded are ignored. This allows diffphot
+        to resume an interrupted execution (see LEMONdB.get_processed_stars).
+        KeyError is raised if any of the stars or the filter is not in the
+        database, in which case nothing is recorded.
+
+        """
+
+        star_ids = list(star_ids)
+        for star_id in star_ids:
+            if not self._has_star(star_id):
+                msg = "star with ID = %d not in database" % star_id
+                raise KeyError(msg)
+
+        filter_id = hash(pfilter)
+        self._execute("SELECT 1 FROM photometric_filters WHERE id = ?", (filter_id,))
+        if not list(self._rows):
+            raise KeyError("photometric filter %s not in database" % pfilter)
+
+        rows = ((star_id, filter_id) for star_id in star_ids)
+        self._create_lazily('processed_stars')
+        self._cursor.executemany("INSERT OR IGNORE INTO processed_stars "
+                                 "VALUES (?, ?)", rows)
+
+    def get_processed_stars(self, pfilter):
+        """ Return the IDs of the stars whose light curves were computed.
+
+        The method returns a set with the IDs of the stars recorded in the
+        'pfilter' photometric filter with LEMONdB.add_processed_stars, as well
+        as those of the stars that have a light curve stored in the filter,
+        even if they were not recorded (e.g., databases created before the
+        stars were recorded). These are the stars that diffphot does not need
+        to process again when an interrupted execution is resumed. If no star
+        was ever recorded, the 'processed_stars' table may not exist (see
+        LEMONdB.LAZY_SCHEMA), and only the stars with a light curve count.
+
+        """
+
+        t = (hash(pfilter),)
+        self._execute("SELECT star_id "
+                      "FROM cmp_stars INDEXED BY cstars_by_star_filter "
+                      "WHERE filter_id = ?", t)
+        star_ids = set(row[0] for row in self._rows)
+
+        if self._in_schema('processed_stars'):
+            self._execute("SELECT star_id "
+                          "FROM processed_stars "
+                          "WHERE filter_id = ?", t)
+            star_ids.update(row[0] for row in self._rows)
+        return star_ids
+
     def get_light_curve(self, star_id, pfilter):
         """ Return the light curve of a star.
 
@@ -1349,6 +3141,9 @@ class LEMONdB(object):
                       "  AND img.filter_id = ? "
                       "ORDER BY img.unix_time ASC", t)
         curve_points = list(self._rows)
+        packed = self._get_packed('light_curves', star_id, pfilter)
+        if packed:
+            curve_points = sorted(curve_points + packed)
 
         if curve_points:
             # ... as well as the comparison stars.
@@ -1367,7 +3162,7 @@ class LEMONdB(object):
                 cstars, cweights, cstdevs = zip(*rows)
 
         else:
-            if star_id not in self.star_ids:
+            if not self._has_star(star_id):
                 msg = err_msg + "not in database"
                 raise KeyError(msg)
 
@@ -1375,8 +3170,9 @@ class LEMONdB(object):
             return None
 
         curve = LightCurve(pfilter, cstars, cweights, cstdevs, dtype = self.dtype)
-        for point in curve_points:
-            curve.add(*point)
+        # NULL signal-to-noise ratios become NaN in the float64 array
+        columns = numpy.array(curve_points, dtype = numpy.float64).T
+        curve.extend(*columns)
         return curve
 
     def get_instrumental_magnitudes(self, star_id, pfilter):
@@ -1400,8 +3196,10 @@ class LEMONdB(object):
                             i.filter_id = ?
                       """, t)
 
+        rows = list(self._rows)
+        rows += self._get_packed('photometry', star_id, pfilter)
         cls = collections.namedtuple('InstrumentalMagnitude', "magnitude snr")
-        return dict((r[0], cls(*r[1:])) for r in self._rows)
+        return dict((r[0], cls(*r[1:])) for r in rows)
 
     def airmasses(self, pfilter):
         """ Return the airmasses of the images in a photometric filter.
@@ -1451,29 +3249,13 @@ class LEMONdB(object):
                            curve.cstdevs,
                            dtype = curve.dtype)
 
-        unix_times, magnitudes, snrs = zip(*curve)
-        zero_t = min(unix_times)
-
-        phased_x = []
-        for utime, mag, snr in zip(unix_times, magnitudes, snrs):
-            # How far into the cycle is this Unix time?
-            fractional_part = math.modf((utime - zero_t) / period)[0]
-            phased_x.append(fractional_part)
-        assert len(phased_x) == len(unix_times)
-
-        x_max = 1;
-        phased_unix_times = phased_x[:]
-        for _ in xrange(repeat - 1): # -1 as there is already one (phased_x)
-            phased_unix_times += [utime + x_max for utime in phased_x]
-            x_max += 1;
-
-        assert len(phased_unix_times) == len(unix_times) * repeat
-        phased_magnitudes = magnitudes * repeat
-        phased_snr = snrs * repeat
-
-        for utime, mag, snr in \
-            zip(phased_unix_times, phased_magnitudes, phased_snr):
-                phase.add(utime, mag, snr)
+        # How far into the cycle is each Unix time? The curve is folded only
+        # once, and the phases shifted by one for each repetition of the cycle
+        phases = curve.fold(period)
+        cycles = numpy.arange(repeat)[:, numpy.newaxis]
+        phase.extend((phases + cycles).ravel(),
+                     numpy.tile(curve.magnitudes, repeat),
+                     numpy.tile(curve.snrs, repeat))
 
         assert len(phase) == len(curve) * repeat
         return phase
@@ -1636,33 +3418,118 @@ class LEMONdB(object):
         os.close(fd)
         return path
 
+    def _get_sky_index(self):
+        """ Return the spatial index of the stars, building it if needed.
+
+        Return a four-element tuple with the IDs of the stars, their right
+        ascensions and declinations, as NumPy arrays, and a k-d tree of their
+        positions on the unit sphere (see celestial_to_cartesian), with which
+        the stars closest to some coordinates are found in logarithmic time,
+        instead of computing the distance to each star in the database. The
+        index is built the first time that it is needed and then kept in memory
+        until a star is added, so repeated lookups (for example, when juicer
+        locates the star on which the user clicked) take only microseconds.
+
+        """
+
+        if self._sky_index is None:
+            self._execute("SELECT id, ra, dec FROM stars ORDER BY id ASC")
+            rows = numpy.array(self._rows.fetchall(), dtype = numpy.float64)
+            rows = rows.reshape(-1, 3)
+            star_ids = rows[:, 0].astype(numpy.int64)
+            ra, dec = rows[:, 1], rows[:, 2]
+            tree = scipy.spatial.cKDTree(celestial_to_cartesian(ra, dec))
+            self._sky_index = (star_ids, ra, dec, tree)
+        return self._sky_index
+
+    def _sky_matches(self, ra, dec, indexes):
+        """ Return a list of (ID, distance) for these positions of the index.
+
+        The angular distance, in degrees, from the coordinates (ra, dec) to the
+        stars at these positions of the spatial index is computed exactly, from
+        their right ascensions and declinations, and the list of two-element
+        tuples sorted by distance (and by ID, in case of a tie) is returned.
+
+        """
+
+        star_ids, star_ra, star_dec, _ = self._get_sky_index()
+        indexes = numpy.asarray(indexes, dtype = numpy.intp)
+        distances = angular_separation(ra, dec, star_ra[indexes], star_dec[indexes])
+        matches = zip(star_ids[indexes].tolist(), distances.tolist())
+        return sorted(matches, key = lambda x: (x[1], x[0]))
+
+    def stars_closest_to_world_coords(self, ra, dec, k):
+        """ Find the k stars closest to a right ascension and declination.
+
+        Return a list of two-element tuples, with the ID of each star and its
+        angular distance, in degrees, to the coordinates (ra, dec), for the 'k'
+        stars closest to them, sorted by their distance. If the LEMONdB has
+        fewer than 'k' stars, all of them are returned. The stars are looked up
+        in the spatial index of the database (see LEMONdB._get_sky_index), but
+        the distances are then computed exactly, with the same formula as
+        astromatic.Coordinates.distance. Raises ValueError if there are no
+        stars in the LEMONdB, or if 'k' is not a positive integer.
+
+        """
+
+        if k < 1:
+            raise ValueError("'k' must be a positive integer")
+        if not len(self):
+            raise ValueError("database is empty")
+
+        star_ids, _, _, tree = self._get_sky_index()
+        k = min(int(k), len(star_ids))
+        # Nearest in chord distance means nearest in angular distance, but we
+        # ask for one more neighbor than needed, if available, so that we can
+        # break the ties between equidistant stars by their ID, deterministically.
+        extra = min(k + 1, len(star_ids))
+        point = celestial_to_cartesian(ra, dec)
+        _, indexes = tree.query(point, k = extra)
+        indexes = numpy.atleast_1d(indexes)
+        return self._sky_matches(ra, dec, indexes)[:k]
+
     def star_closest_to_world_coords(self, ra, dec):
         """ Find the star closest to a right ascension and declination.
 
-        Compute the angular distance from the right ascension and declination
-        of each star in the LEMONdB to the specified coordinates (ra, dec).
+        Find the star in the LEMONdB with the shortest angular distance to the
+        specified coordinates (ra, dec), using the spatial index of the stars.
         Returns a two-element tuple containing the ID of the closest star to
         these coordinates and its angular distance, in degrees, respectively.
         Raises ValueError if there are no stars in the LEMONdB.
 
         """
 
-        if not len(self):
-            raise ValueError("database is empty")
+        return self.stars_closest_to_world_coords(ra, dec, 1)[0]
+
+    def stars_within_world_coords(self, ra, dec, radius):
+        """ Find the stars within a radius of a right ascension and declination.
 
-        self._execute("SELECT id, ra, dec FROM stars")
+        Return a list of two-element tuples, with the ID of each star and its
+        angular distance, in degrees, to the coordinates (ra, dec), for all the
+        stars whose distance is at most 'radius' degrees (a cone search). The
+        list is sorted by distance, and empty if no star is within the radius.
+        The radius in degrees is converted to the length of the chord that it
+        subtends, so that the spatial index of the stars can be used. Raises
+        ValueError if the radius is negative.
 
-        closest_id = None
-        closest_distance = float('inf')
-        coordinates = astromatic.Coordinates(ra, dec)
-        for star_id, star_ra, star_dec in self._rows:
-            star_coords = astromatic.Coordinates(star_ra, star_dec)
-            star_distance = coordinates.distance(star_coords)
-            if star_distance < closest_distance:
-                closest_id = star_id
-                closest_distance = star_distance
+        """
 
-        return closest_id, closest_distance
+        if radius < 0:
+            raise ValueError("radius must be a non-negative number")
+        if not len(self):
+            return []
+
+        star_ids, _, _, tree = self._get_sky_index()
+        # Beyond 180 degrees, the entire sphere is within the radius
+        chord = 2 * math.sin(math.radians(min(radius, 180)) / 2)
+        # Widen the search by a tiny fraction, to not miss because of rounding
+        # errors in the chords the stars that are exactly at the radius; these
+        # are then filtered out by their exact angular distance to (ra, dec).
+        chord *= 1 + 1e-9
+        point = celestial_to_cartesian(ra, dec)
+        indexes = tree.query_ball_point(point, chord)
+        matches = self._sky_matches(ra, dec, indexes)
+        return [(id_, distance) for id_, distance in matches if distance <= radius]
 
 def _add_metadata_property(name):
     """ Dynamically add a property to the LEMONdB class.
@@ -1695,3 +3562,82 @@ _add_metadata_property('HOSTNAME') # where the LEMONdB was created
 _add_metadata_property('ID')       # unique identifier of the LEMONdB
 _add_metadata_property('VMIN')     # values for the log scale (APLpy)
 _add_metadata_property('VMAX')
+
+
+class ConnectionPool(object):
+    """ Read-only connections to a LEMONdB, one per process and thread.
+
+    A SQLite connection cannot be shared among threads (the sqlite3 module
+    raises ProgrammingError), nor used by a process other than the one that
+    opened it, as those created by multiprocessing are. A ConnectionPool
+    opens a LEMONdB, with the 'read-mostly' profile (see PRAGMA_PROFILES),
+    for each process and thread that calls ConnectionPool.get, and then
+    returns the same one to each of them, which is therefore opened only once.
+    The pool can be pickled (only the path and data type are), so that it can
+    be sent to the workers of a multiprocessing pool, which can then read the
+    data from the database directly instead of receiving it through pickles.
+
+    Note that the connections only see the data that has been committed: if
+    the database is modified while it is being read (as diffphot does with
+    its output database, using the 'bulk-write' profile), the readers do not
+    block the writer and vice versa, as long as it is in WAL mode.
+
+    """
+
+    def __init__(self, path, dtype = numpy.longdouble):
+        """ Instantiation method for the ConnectionPool class.
+
+        No connection is opened until ConnectionPool.get is called. The 'dtype'
+        keyword argument is the data type of the LEMONdBs (see LEMONdB).
+
+        """
+
+        self.path = path
+        self.dtype = dtype
+        # Map each (process ID, thread ID) to its LEMONdB. Each thread only
+        # adds its own key, so there are no race conditions, while those of
+        # other processes (i.e., inherited through fork) are never used.
+        self._connections = {}
+
+    def __getstate__(self):
+        return dict(path = self.path, dtype = self.dtype)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], dtype = state['dtype'])
+
+    def get(self):
+        """ Return the LEMONdB of the calling process and thread.
+
+        The LEMONdB, opened with the 'read-mostly' profile, is created the
+        first time that the method is called from each process and thread.
+        As with any other LEMONdB, it caches star IDs, image IDs and time
+        axes, which are therefore read from the database only once.
+
+        """
+
+        key = os.getpid(), threading.current_thread().ident
+        try:
+            return self._connections[key]
+        except KeyError:
+            db = LEMONdB(self.path, dtype = self.dtype, profile = 'read-mostly')
+            self._connections[key] = db
+            return db
+
+    def __len__(self):
+        """ Return the number of connections opened by this process """
+        pid = os.getpid()
+        return sum(1 for key in self._connections if key[0] == pid)
+
+    def close(self):
+        """ Close the LEMONdB of the calling process and thread, if any.
+
+        Connections can only be closed by the thread that opened them, so each
+        thread has to close its own. A new one will be opened if ConnectionPool
+        .get is called again.
+
+        """
+
+        key = os.getpid(), threading.current_thread().ident
+        db = self._connections.pop(key, None)
+        if db is not None:
+            db.close()
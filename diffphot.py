@@ -42,14 +42,14 @@ that the former is brighter than the latter.
 
 """
 
-import copy
+import collections
 import logging
 import optparse
 import os
 import multiprocessing
 import pwd
 import numpy
-import random
+import scipy.sparse.linalg
 import shutil
 import socket
 import sys
@@ -59,657 +59,337 @@ import time
 import customparser
 import database
 import defaults
+import lightcurves
 import methods
 import snr
 import style
 
-class Weights(numpy.ndarray):
-    """ Encapsulate the weights associated with some values """
-
-    def __new__(cls, coefficients, dtype = numpy.longdouble):
-        """ Return a new instance of the Weights class.
-
-        The weights are not automatically normalized for us, so they do not
-        necessarily have to add up to 1.0. Use Weights.normalize() for that.
-        A copy of 'coefficients' is stored in the 'values' attribute of the
-        new Weights object.
-
-        """
-
-        if not len(coefficients):
-            raise ValueError("arg is an empty sequence")
-        w = numpy.asarray(coefficients, dtype = dtype).view(cls)
-        w.values = numpy.array(coefficients)
-        return w
-
-    def __str__(self):
-        coeffs_str = ", ".join(["%s" % x for x in self])
-        return "%s(%s)" % (self.__class__.__name__, coeffs_str)
-
-    def rescale(self, key):
-        """ Exclude the key-th coefficient and return the rescaled Weights.
-
-        Note that the key-th element is also removed from the 'values'
-        attribute of the returned object. The reason is that, if a coefficient
-        is deleted, there is no longer need to keep track of what its original
-        value was.
-
-        """
-
-        if len(self) == 1:
-            raise ValueError("cannot rescale one-element instance")
-        w = Weights(numpy.delete(self, key)).normalize()
-        w.values = numpy.delete(self.values, key)
-        return w
-
-    @property
-    def total(self):
-        return numpy.sum(self)
-
-    def normalize(self):
-        """ Rescale the coefficients to that they add up to one.
-
-        Return a new Weights object where each element has been divided by the
-        sum of all the coefficients. The 'values' attribute of the new object
-        is set to the value of self.values: in this manner, when working with
-        the new Weights object we will always be able to know what were the
-        original coefficients, before the normalization.
-
-        """
-
-        w = Weights(self / self.total)
-        w.values = self.values
-        return w
-
-    @classmethod
-    def inversely_proportional(cls, values, dtype = numpy.longdouble):
-        """ Return Weights inversely proportional to 'values'.
-
-        For example, [1, 1, 2] returns Weights([0.4, 0.4, 0.2]). Note that at
-        least one value is required, and that none of them may be zero (as in
-        that case we would be dividing by zero). A copy of 'values' is stored
-        in the 'values' attribute of the returned Weights object.
-
-        """
-
-        if not len(values):
-            raise ValueError("'values' is an empty sequence")
-        if not all(values):
-            raise ValueError("'values' cannot contain zeros")
-        values = numpy.array(values,  dtype = dtype)
-        w = cls(1 / values).normalize()
-        w.values = numpy.array(values)
-        return w
-
-    def absolute_percent_change(self, other, minimum = None):
-        """ Return the percent change of two Weights of the same size. More
-        specifically, the method returns the maximum absolute percent change
-        between the coefficients of both instances that have the same
-        position. In other words: the percent change between the first
-        coefficient in 'self' and the first one in 'other' is calculated, and
-        so on, and the maximum value among them is then returned. This method
-        can be used in order to check how similar two weights are in percentage
-        terms, or whether some Weights have converged to a given solution. Note
-        that pairs which contain a zero in self are ignored (i.e., the maximum
-        percent change between 0 and 4 cannot be calculated).
-
-        The 'minimum' keyword, which must be a positive number, sets the lowest
-        value that a coefficient must have (in both 'self' and 'other') in
-        order to be taken into account. In this manner, extremely small
-        coefficients, such as 1.09720056734e-15 (true story, we came across
-        this exact value while reducing real data) may be excluded from the
-        comparison, as at this point we are comparing mostly noise. ValueError
-        is raised is 'minimum' causes all the coefficients to be discarded.
-
-        """
-
-        if minimum is not None and minimum <= 0:
-            raise ValueError("'minimum' must be a positive number")
-
-        if len(self) != len(other):
-            raise ValueError("both instances must be of the same size")
-
-        coefficients = []
-        for x, y in zip(self, other):
-            if x and (not minimum or min(x, y) >= minimum):
-                coefficients.append((x, y))
-
-        if not coefficients:
-            msg = "all coefficients were discarded ('minimum' too high?)"
-            raise ValueError(msg, self)
-        else:
-            return max((abs(methods.percentage_change(x, y))
-                            for x, y in coefficients))
-
-    @classmethod
-    def random(cls, size):
-        weights = cls([random.uniform(0, 1) for _ in xrange(size)])
-        return weights.normalize()
-
-
-class StarSet(object):
-    """ A collection of DBStars *with information for the exact same images*,
-    all of them also taken in the same filter. Internally, and for performance
-    purposes, all the photometric information is kept in a three-dimensional
-    (star, data, image) array. """
-
-    def _add(self, index, star):
-        """ Add a DBStar to the set.
-
-        In order not to maintain duplicate information in memory, the DBStar
-        instances are parsed and their photometric information stored in the
-        three-dimensional, low-level internal array.
-
-        The ValueError exception is raised in the following cases:
-        (1) If the DBStar has no photometric records (i.e., is empty)
-        (2) If the photometric filter of the DBStar does not match that of
-            the StarSet, which was defined when the class was instantiated.
-        (3) If the ID of the DBStar matches that of any of the DBStars
-            already stored in the set, if any. This means, thus, that the
-            DBStars stored in a StarSet are guaranteed to have different IDs.
-        (4) If the Unix times of the photometric records of the DBStar are
-            not equal to those of the DBStars already stored in the StarSet,
-            if any. In other words: the DBStars stored in a StarSet are
-            guaranteed to have photometric records for the same Unix times.
-
-        """
-
-        # We cannot do time-series photometry with stars which have no
-        # information at all. It makes no sense, so don't even allow it.
-        if not len(star):
-            raise ValueError("star cannot be empty")
-
-        if not len(self.star_ids):
-            self._star_ids.append(star.id)
-            self.pfilter = star.pfilter
-            self._unix_times = star._unix_times
-
-            # A cache, mapping each Unix time to its index in phot_info; passed
-            # to the constructor of DBStar for O(1) lookups of Unix times
-            self._times_indexes = {}
-            for time_index, unix_time in enumerate(self._unix_times):
-                self._times_indexes[unix_time] = time_index
-
-            # Three-dimensional array: first dimension maps to the star; second
-            # to the type of info (index 0 for mag, 1 for SNR) and third to the
-            # Unix time (in case we need to know to which time a given index
-            # correspond, we can use self._unix_times). For example, to get all
-            # the magnitudes of the third star, we will do self.phot_info[2][0]
-            self._phot_info[index] = star._phot_info[1:]
+def photometry_points(stars):
+    """ Arrange the photometry of some DBStars as a list of observed points.
 
-        else:
-            if star.pfilter != self.pfilter:
-                msg = "star with ID = %d has filter '%s', expected '%s'"
-                raise ValueError(msg % (star.id, star.pfilter, self.pfilter))
-
-            if star.id in self.star_ids:
-                raise ValueError("star with ID = %d already in the set" % star.id)
-
-            for unix_time in self._unix_times:
-                if unix_time not in star._time_indexes:
-                    raise ValueError("stars must have info for the same Unix times")
-
-            self._star_ids.append(star.id)
-            self._phot_info[index] = star._phot_info[1:]
-
-    def __init__(self, stars, dtype = numpy.longdouble):
-        """ Instantiation method for the StarSet class.
-
-        The DBStars that belong to the StarSet must be given in a sequence (the
-        'stars' parameter) at instantiation time. You are not expected, and
-        should never, ever need to call the StarSet._add method by yourself.
-
-        The method propagates the exceptions raised by StarSet._add, to which
-        you should refer for in-depth information. The rules, anyway, can be
-        summarized as follows: at least one DBStar, which cannot be empty, is
-        needed, and they must have the same filter and Unix times, as well as
-        different IDs. If one of these conditions is not met, ValueError is
-        raised.
-
-        """
-
-        if not stars:
-            raise ValueError("at least one star is needed")
-
-        self.dtype = dtype
-        self._star_ids = []
-        # Do not set the array values to zero (marginally faster)
-        self._phot_info = numpy.empty((len(stars), 2, len(stars[0])), dtype = self.dtype)
-        for index, star in enumerate(stars):
-            self._add(index, star)
-
-    @property
-    def star_ids(self):
-        """ Return a list with the IDs of the stars contained in the set """
-        return self._star_ids
-
-    def __len__(self):
-        """ The number of stars in the set """
-        return self._phot_info.shape[0]  # 1st dimension = stars
-
-    @property
-    def nimages(self):
-        """ The number of Unix times for which the stars have info """
-        return len(self._unix_times)
-
-    def __delitem__(self, index):
-        """ Delete the index-th star """
-        self._phot_info = numpy.delete(self._phot_info, index, axis = 0)
-        assert self._phot_info.shape[0] == len(self)  # first dimension: star
-        del self._star_ids[index]
-        assert len(self.star_ids) == len(self), "%d vs %d" % (len(self.star_ids), len(self))
-
-    def __getitem__(self, index):
-        """ Return the index-th star as a DBStar instance """
-
-        # The constructor of a DBStar receives a NumPy array with three rows
-        # (the first for the time, the second for the magnitude and the last
-        # for the SNR), and as many columns as records for which there is
-        # photometric information.
-        sphot_info = numpy.empty((3, self.nimages), dtype = self.dtype)
-        sphot_info[0] = self._unix_times
-        sphot_info[1] = self._phot_info[index][0]
-        sphot_info[2] = self._phot_info[index][1]
-
-        id_ = self._star_ids[index]
-        return database.DBStar(id_, self.pfilter, sphot_info,
-                               self._times_indexes, self.dtype)
-
-    def flux_proportional_weights(self):
-        """ Return the Weights proportional to the flux of each star.
-
-        The method returns a Weights instance with as many coefficients as
-        stars there are in the set, and where each one is assigned a value
-        directly proportional to the median of its normalized flux. Note that,
-        although the DBStars store instrumental magnitudes, we work here with
-        fluxes: thus, if the instrumental magnitude of A is one magnitude
-        greater than that of B, for example, it means that A is 2.512 times
-        fainter and its weight must be 2.512 times smaller than that of B.
-
-        The first versions of this algorithm used a single image (such as that
-        with the best seeing) to determine the flux-proportional weights. The
-        logic behind the current implementation, considerably more robust as
-        all the images are used, is that, for example, the brightest star in
-        the field should always be the brightest, no matter what the
-        atmospheric conditions are. Therefore, instrumental magnitudes are
-        normalized by dividing them by the maximum of each image, and then
-        the median of the normalized magnitudes of each star used to compute
-        the weights, directly proportional to these values.
-
-        Note that, of course, the 'brightest star will always be the brightest'
-        line of reasoning only applies to non-variable stars, which are assumed
-        to be the great majority of the objects in the field. Otherwise, to
-        what exactly do you intend to compare their instrumental magnitudes?
-
-        """
-
-        # Bi-dimensional matrix (as many rows as stars, as many columns as
-        # images) in which the normalized magnitude of the stars are stored
-        norm_mags = numpy.empty((len(self), self.nimages), dtype = self.dtype)
-
-        # For each image (third dimension of self._phot_info), normalize the
-        # magnitudes (second dimension, x = 0) of each star (first dimension).
-        # That is: the magnitudes for all the stars in the image are divided
-        # by the maximum magnitude.
-        for image_index in xrange(self.nimages):
-            image_mags = self._phot_info[:, 0, image_index]
-            norm_mags[:, image_index] = image_mags / image_mags.max()
-
-        # Now, for each star, calculate the median of the normalized magnitudes
-        mag_medians = numpy.empty(len(self), dtype = self.dtype)
-        for star_index in xrange(len(self)):
-            mag_medians[star_index] = numpy.median(norm_mags[star_index])
-
-        pogsonr = 100 ** 0.2  # fifth root of 100 (Pogson's Ratio)
-        return Weights.inversely_proportional(pogsonr ** mag_medians)
-
-    def light_curve(self, weights, star, no_snr = False, _exclude_index = None):
-        """ Generate the light curve of a DBStar.
-
-        Use the stars in the set to compute an artificial comparison star,
-        using the weighted average of their instrumental magnitudes as the
-        photometric reference level: for each point in time, subtract the
-        instrumental magnitude of the comparison star from that of the star.
-
-        The 'weights' object is **expected** to have been created with the
-        Weights.inversely_proportional() method, assigning to each comparison
-        star a weight inversely proportional to the standard deviation of its
-        light curve. This is very important because this method expects that
-        weights.values stores the *light curve standard deviations* of the
-        comparison stars, and therefore these will be the values stored in
-        the 'cstdevs' attribute of the returned LightCurve object.
-
-        Note that it is mandatory that the DBStar has photometric information
-        for exactly the same Unix times for which the stars in the set have
-        photometric records. In practice, this means that they will be those
-        returned by the DBStar.complete_for method, which identifies precisely
-        the DBStars that can be used as the artificial comparison star.
-
-        The calculation of the signal-to-noise ratio of each differential
-        magnitude is, being currently written in pure Python, considerably
-        slow. It is barely noticeable when a few conversions from SNR to error
-        in magnitudes (or vice versa) are done, but when invoked thousands of
-        times it causes an unbearable performance hit. Until the 'snr' module
-        is rewritten in C, the 'no_snr' keyword argument, if set to True, will
-        make the method skip the calculation of the differential SNRs, using
-        None instead. This is probably only needed by StarSet.broeg_weights,
-        which does not care about the signal-to-noise ratios, but only the
-        standard deviation of the light curves, and can therefore avoid
-        computing them.
-
-        If specified, the '_exclude_index' argument determines the index of the
-        star in the set that will not be used as comparison star, regardless of
-        its weight. It is equivalent to setting the index-th coefficient to
-        zero and then rescaling the weights. This parameter is here (and most
-        probably only needed) because of the method StarSet.broeg_weights,
-        which computes the light curve of each one of the stars in the set
-        using all the others as comparison.
-
-        """
-
-        if len(weights) != len(self):
-            msg = "number of weights must match that of comparison stars"
-            raise ValueError(msg)
-
-        if _exclude_index is not None and not 0 <= _exclude_index < len(self):
-            msg = "_exclude_index out of range"
-            raise IndexError(msg)
-
-        if not numpy.all(numpy.equal(star._unix_times, self._unix_times)):
-            msg = "Unix times of StarSet and DBStar do not match"
-            raise ValueError(msg)
-
-        if _exclude_index is None:
-            rweights = weights
-        else:
-            # Set the _exclude_index-th star to zero, but preserve the original
-            # value of the 'values' attribute. These are the standard deviations
-            # of the comparison stars, so we do not want to modify them, even if
-            # one of them has not been used as comparison.
-            values = numpy.array(weights.values)
-            rweights = weights.rescale(_exclude_index)
-            rweights = numpy.insert(rweights, _exclude_index, 0.0)
-            rweights.values = values
-
-        assert len(rweights) == len(self)
-
-        assert hasattr(rweights, 'values')
-        cstdevs = rweights.values
-        args = self.pfilter, self.star_ids, rweights, cstdevs
-        curve = database.LightCurve(*args, dtype = self.dtype)
-
-        for index, unix_time in enumerate(self._unix_times):
-            # The magnitude and SNR of the comparison star
-            cmags = self._phot_info[:, 0, index]
-            csnrs = self._phot_info[:, 1, index]
-            cmag = numpy.average(cmags, weights = rweights)
-            csnr = None if no_snr else snr.mean_snr(csnrs, weights = rweights)
-
-            smag = star.mag(index)
-            ssnr = star.snr(index)
-
-            dmag = smag - cmag
-            dsnr = None if no_snr else snr.difference_snr(ssnr, csnr)
-            curve.add(unix_time, dmag, dsnr)
-
-        return curve
-
-    def broeg_weights(self, pct = 0.01, max_iters = None, minimum = None):
-        """ Determine the weights that give the optimum comparison star.
-
-        This is our implementation of C. Broeg's algorithm ('A new algorithm
-        for differential photometry: computing an optimum artificial comparison
-        star', 2005, http://adsabs.harvard.edu/abs/2005AN....326..134B), which
-        identifies the weights that produce the optimal artificial comparison
-        star. In other words: the returned Weights instance, if applied to the
-        StarSet to compute a light curve, create an artificial comparison star
-        with the minimal standard deviation; that is, the most constant one.
-
-        In broad terms, Broeg's algorithm works by iteratively calculating the
-        differential magnitudes of all the stars in the set with respect to the
-        others, using weights inversely proportional to the standard deviation
-        of each star in the previous step. This is mostly it. You should refer
-        to the original paper in case you need to understand the exact details
-        of the algorithm.
-
-        There is, however, a major difference between the original algorithm
-        and the one implemented here: for the first series of light curves,
-        Broeg uses the instrumental errors as a first guess for the standard
-        deviations. We, instead, use weights directly proportional to the flux
-        of each star (see method StarSet.flux_proportional_weights), on the
-        reasoning that, the brightest a star, the higher its signal-to-noise
-        ratio and lower its noise, and therefore it should be given more
-        weight in the first iteration.
-
-        Note that the returned Weights object stores the standard deviations of
-        the light curves of the comparison stars in the 'values' attribute. In
-        this manner, we can always know what was the standard deviation of each
-        of the comparison stars, from which the inversely-proportional weights
-        returned in the Weights object were calculated.
-
-        The ValueError exception is raised if there are less than two stars
-        in the set. The reason for this is that the standard deviation of the
-        light curve of a star cannot be calculated if it was only observed in
-        one image: we cannot compute the standard deviation of a single value,
-        and assuming it to be zero, as NumPy does, is equally catastrophic and
-        useless, for all the stars would have the same standard deviation and,
-        furthermore, it would result in divisions by zero when
-        Weights.inversely_proportional were called.
-
-        Keyword arguments:
-        - pct: the convergence threshold, given as a percentage change. The
-               optimum weights will be considered to have been found when the
-               percentage change (see Weights.absolute_percent_change) between
-               the weights computed in the last two iterations is less than or
-               equal to this value.
-        - max_iters: the maximum number of iterations of the algorithm. Any
-                     value which evaluates to False (such as zero or None) will
-                     be interpreted as to mean 'use the current value of the
-                     recursion limit' - as returned by sys.getrecursionlimit().
-        - minimum: the minimum value for a coefficient to be taken into account
-                   when calculating the percentage change between two Weights;
-                   used in order to prevent scientifically-insignificant values
-                   from making the algorithm stop or iterate more than needed.
-
-        """
-
-        if not len(self):
-            raise ValueError("cannot work with an empty instance")
-
-        # If there is only one star, its weight cannot be other than one
-        if len(self) == 1:
-            return Weights([1.0])
-
-        # When there are only two stars in the StarSet, and since their light
-        # curves are generated by comparing each one to the other, both will
-        # have the same standard deviation, and therefore also equal weights.
-        if len(self) == 2:
-            return Weights([0.5, 0.5])
-
-        if self.nimages < 2:
-            raise ValueError("at least two images are needed")
-
-        # Initial weights are inversely proportional to the magnitude of each
-        # star. Then, the differential magnitude of each comparison star is
-        # calculated with respect to the others using the same (rescaled)
-        # weights. The standard deviation of the light curve that results from
-        # using these (rescaled) weights is used in order to compute the new
-        # weights for each star. We stop when the absolute percent change
-        # between the old weights and the new one is below the threshold
-
-        weights = [self.flux_proportional_weights()]
-        curves_stdevs = numpy.empty(len(self), dtype = self.dtype)
-        for iteration in xrange(max_iters or sys.getrecursionlimit()):
-            for star_index in xrange(len(self)):
-                star_curve = self.light_curve(weights[-1], self[star_index],
-                                              _exclude_index = star_index,
-                                              no_snr = True)
-                curves_stdevs[star_index] = star_curve.stdev
-
-            # Avoid the division by zero if, somehow, a star ends up having a
-            # standard deviation of zero, as Weights.inversely_proportional
-            # would raise ValueError. Instead, stop the computation so that
-            # the last valid weights are returned.
-            #
-            # How this may happen? The only time it has ever happened to us we
-            # were computing the weights of a set of stars with information in
-            # only two images. With that few points in the light curve of each
-            # star we may have, if only by chance, two differential magnitudes
-            # almost identical and therefore a standard deviation which would
-            # converge to zero.
-
-            if not all(curves_stdevs):
-                break
-
-            # The Weights object returned by Weights.inversely_proportional()
-            # stores the standard deviations in the 'values' attribute.
-            weights.append(Weights.inversely_proportional(curves_stdevs))
-            if weights[-2].absolute_percent_change(weights[-1], minimum = minimum) < pct:
-                break
-
-        return weights[-1]
-
-    def worst(self, fraction, pct = 0.01, max_iters = None, minimum = None):
-        """ Return the indexes of the less constant stars.
-
-        The method returns the indexes of the 'fraction' less constant (that
-        is, the most variable) stars in the set, and consequently the less
-        ideal stars to be used as comparison when a light curve is computed.
-        This is done by calculating the Broeg weights (StarSet.broeg_weights)
-        of the stars in the set and identifying those with the lowest values;
-        since these weights are inversely proportional to the standard
-        deviation of the light curves, this effectively finds those stars
-        with the highest variability when their differential magnitudes are
-        calculated with respect to the others.
-
-        The order of the returned indexes is not casual: they are sorted by
-        increasing variability, that is, by the unconstantness of the stars.
-        This means that the i-th index corresponds to a star whose variability
-        is higher than or equal to that of the star of the i+1-th index.
-
-        Fractional numbers of indexes to be returned are rounded to the nearest
-        integer, although at least one star is always returned, independently
-        of the value of the 'fraction' argument. The ValueError exception is
-        raised, however, if it is not in the range (0, 1], as it makes no sense
-        to ask for either zero or more stars than there are in the set.
-
-        The three keyword parameters are not used by this method itself, but
-        just passed down to StarSet.broeg_weights. See the documentation of
-        that method for details.
-
-        """
-
-        if not 0 < fraction <= 1:
-            raise ValueError("'fraction' must be in the range (0,1]")
-
-        if len(self) < 3:
-            raise ValueError("at least three stars are needed")
-
-        # The number of stars with the lowest weights (and therefore the
-        # highest standard deviation in their light curves) to be returned
-        nstars = int(round(fraction * len(self)))
-        if not nstars:
-            nstars = 1
-
-        # Find the indexes of the 'nstars' coefficients of the Broeg weights
-        # with the lowest values. These will correspond to the stars with the
-        # maximum standard deviation, which we consider to be the worst. Code
-        # courtesy of user 'aix' at: http://stackoverflow.com/q/6910672
-        kwargs = dict(pct = pct, max_iters = max_iters, minimum = minimum)
-        bweights = self.broeg_weights(**kwargs)
-        return list(bweights.argsort()[:nstars])
-
-    def best(self, n, fraction = 0.1, pct = 0.01, max_iters = None, minimum = None):
-        """ Find the most constant stars in the set.
-
-        The method returns a StarSet with the 'n' most constant (that is, the
-        less variable) stars in the set, and therefore the optimal to be used
-        as comparison when a light curve is computed. In order to achieve this,
-        the method iterates by identifying the 'fraction' less constant stars
-        (StarSet.worst), discarding them and recomputing the light curves of
-        the remaining stars. The process continues until there are only 'n'
-        stars left, which are returned. The original StarSet is not modified.
-
-        Ideally, stars would be discarded one by one, but this is terribly
-        CPU-expensive for medium and large data sets, so in practice we are
-        required to discard several stars at each step. The default fraction
-        value is 0.1, which means that at each iteration 10% of the stars in
-        the set, those with a highest standard deviation, are discarded.
-
-        The ValueError exception is raised if the StarSet has fewer than three
-        stars, as that is the lowest number which which their variability can
-        be determined reliably. The same exception is raised if less than one
-        star or more than the size of the set are requested, or if the value of
-        the 'fraction' argument is not in the range (0, 1], as it makes no
-        sense to, at each iteration, discard either zero or more stars than
-        there are in the set.
-
-        The three keyword parameters are not used by this method itself, but
-        just passed down to StarSet.broeg_weights. See the documentation of
-        that method for details.
-
-        """
-
-        if not 0 < fraction <= 1:
-            raise ValueError("'fraction' must be in the range (0,1]")
-
-        if len(self) < 3:
-            raise ValueError("at least three stars are needed")
-
-        if not 1 <= n <= len(self):
-            msg = ("must ask for at least one star, at most for as many "
-                   "as there are in the set")
-            raise ValueError(msg)
-
-        set_ = copy.deepcopy(self)
-
-        # We do not discard stars here until only 'n' stars are left, as at
-        # least three stars are needed in order to determine their variability
-        # reliably. This means that, once we are left with fewer than tree
-        # stars (that is, two), we cannot iterate any further. The solution,
-        # thus, is to discard stars until 'n' or three stars are left, whatever
-        # happens first. After that, if we stopped at three but 'n' is smaller,
-        # we can discard the last batch of stars until only 'n' are left.
-
-        kwargs = dict(pct = pct, max_iters = max_iters, minimum = minimum)
-        while len(set_) > max(n, 3):
-
-            worst_indexes = set_.worst(fraction, **kwargs)
-
-            # The stars whose indexes have been returned by StarSet.worst
-            # cannot be blindly deleted, as the difference between the number
-            # of them and that of stars left in 'set_' may be higher than the
-            # number of stars that have to be deleted in order to get 'n' stars
-            # left. For example, assume there are 100 stars and we want the
-            # best 30, with a fraction of 0.5. 50 stars would be deleted in the
-            # first loop, while 25 more would be removed in the second. There
-            # would then be 100 - 50 - 25 = 25 stars left, when we wanted 30!
-
-            del worst_indexes[(len(set_) - max(n, 3)):]
-            # Remove the stars going backwards, from highest to lowest index
-            for index in sorted(worst_indexes, reverse = True):
-                del set_[index]
-
-        # If there are only three stars left but there are still stars to
-        # discard we must identify them all at once, independently of the value
-        # of 'fraction'. The reason for this is that a minimum of three stars
-        # in needed to realibly determine their variability.
-
-        assert len(set_) >= n
-        if len(set_) != n:
-            worst_indexes = set_.worst(1.0, pct = pct, max_iters = max_iters)
-            del worst_indexes[(len(set_) - n):]
-            for index in sorted(worst_indexes, reverse = True):
-                del set_[index]
-
-        assert len(set_) == n
-        return set_
+    All the DBStars must share the same time axis (see DBStar.__init__), the
+    Unix times of all the images. The method returns a four-element tuple of
+    one-dimensional arrays with an element for each point where a star was
+    observed in an image: the index of the star in 'stars' and that of the
+    image in the time axis, as integer arrays, and the instrumental magnitude
+    and SNR, as float64 arrays. The points are sorted by star, so the first
+    len(stars[0]) are those of the first star, and so on. Unlike a (stars x
+    images) array, these take memory only for the images in which each star
+    was observed, which for large campaigns may be a small fraction of them.
+
+    """
+
+    time_axis = stars[0]._time_axis
+    if time_axis is None or not all(s._time_axis is time_axis for s in stars):
+        raise ValueError("DBStars must share the same time axis")
+
+    sizes = [len(star) for star in stars]
+    rows = numpy.repeat(numpy.arange(len(stars)), sizes)
+    columns = numpy.concatenate([star._axis_indexes for star in stars])
+    mags = numpy.concatenate([star._magnitudes for star in stars])
+    snrs = numpy.concatenate([star._snrs for star in stars])
+    return (rows, columns.astype(numpy.intp), mags.astype(numpy.float64),
+            snrs.astype(numpy.float64))
+
+def ensemble_photometry(rows, columns, mags, errors, shape, iterations = 3,
+                        tol = 1e-10):
+    """ Solve for the zero point of each image and mean magnitude of each star.
+
+    This is our implementation of inhomogeneous ensemble photometry (Honeycutt
+    1992, http://adsabs.harvard.edu/abs/1992PASP..104..435H): the instrumental
+    magnitude of the i-th star in the j-th image is modeled as m_ij = M_i + z_j,
+    its mean magnitude plus the zero point of the image, and these are found
+    all at once by minimizing the weighted sum of squares of the residuals over
+    all the observed points. These are given as in photometry_points: 'rows'
+    and 'columns' are the indexes of the star and image of each point, 'mags'
+    its instrumental magnitude and 'errors' its error in magnitudes, while
+    'shape' is a two-element tuple with the number of stars and images. Stars
+    do not need to have been observed in the same images. Each point is
+    weighted by the inverse of its variance: the square of its error plus the
+    excess variance of the star, that is, how much the scatter of its
+    residuals exceeds that expected from its errors. The excess variances are
+    initially zero, and the solution is computed again 'iterations' times,
+    each time with the excess variances derived from the previous one, so
+    that variable stars have less and less influence on the zero points.
+
+    The mean magnitudes are eliminated from the normal equations, which leaves
+    an (images x images) system for the zero points. This is solved with the
+    conjugate gradient method, never building the matrix explicitly: each
+    product by it is a couple of weighted sums over the points, grouped by
+    star and by image (numpy.bincount), so neither time nor memory grow with
+    the number of stars times that of images. It is solved to a relative
+    tolerance of 'tol'. Zero points are only defined up to a constant, so we
+    choose that which makes them add up to zero. Images without observations
+    are given a zero point of NaN.
+
+    The method returns a four-element tuple: the mean magnitudes of the stars,
+    the zero points of the images and their errors, and the final weights of
+    the points. All of them are float64 arrays.
+
+    """
+
+    nstars, nimages = shape
+    star_sum = lambda values: numpy.bincount(rows, values, minlength = nstars)
+    image_sum = lambda values: numpy.bincount(columns, values, minlength = nimages)
+
+    variances = numpy.square(errors)
+    nobs = numpy.maximum(numpy.bincount(rows, minlength = nstars), 1)
+    used = numpy.bincount(columns, minlength = nimages) > 0
+    excess = numpy.zeros(nstars)
+
+    for iteration in xrange(max(iterations, 1)):
+
+        weights = 1 / (variances + excess[rows])
+        star_weights = star_sum(weights)
+        star_weights[star_weights == 0] = 1 # stars without observations
+        image_weights = image_sum(weights)
+        wmags = weights * mags
+        star_wmags = star_sum(wmags)
+
+        # Normal equations for the zero points, once the mean magnitudes
+        # M_i = sum_j w_ij (m_ij - z_j) / sum_j w_ij have been substituted
+        def matvec(zero_points):
+            zero_points = numpy.ravel(zero_points)
+            wzero_points = star_sum(weights * zero_points[columns]) / star_weights
+            return image_weights * zero_points - image_sum(weights * wzero_points[rows])
+
+        rhs = image_sum(wmags) - image_sum(weights * (star_wmags / star_weights)[rows])
+        system = scipy.sparse.linalg.LinearOperator((nimages, nimages),
+                                                    matvec = matvec,
+                                                    dtype = numpy.float64)
+        zero_points, info = scipy.sparse.linalg.cg(system, rhs, tol = tol,
+                                                   maxiter = 10 * nimages)
+        if info > 0:
+            logging.warning("Ensemble zero points did not converge after %d "
+                            "iterations of the conjugate gradient" % info)
+
+        zero_points = numpy.where(used, zero_points - zero_points[used].mean(), 0)
+        star_means = (star_wmags - star_sum(weights * zero_points[columns])) / star_weights
+
+        residuals = mags - star_means[rows] - zero_points[columns]
+        mean_variances = star_sum(variances) / nobs
+        excess = numpy.maximum(star_sum(numpy.square(residuals)) / nobs - mean_variances, 0)
+
+    with numpy.errstate(divide = 'ignore'):
+        zp_errors = 1 / numpy.sqrt(image_weights)
+    zero_points[~used] = numpy.nan
+    zp_errors[~used] = numpy.nan
+    return star_means, zero_points, zp_errors, weights
+
+def ensemble_light_curves(stars, options):
+    """ Compute the light curves of some DBStars with ensemble photometry.
+
+    Solve once for the zero points of all the images in which the DBStars (all
+    of them in the same photometric filter and sharing the same time axis)
+    were observed (see ensemble_photometry), and subtract them from the
+    instrumental magnitudes of each star. The error of each point is that of
+    the instrumental magnitude combined with that of the zero point.
+
+    Stars observed in fewer than options.min_images images are left out of the
+    ensemble, and so are, from each light curve, those images in which fewer
+    than options.min_cstars other stars were observed. As there is no per-star
+    comparison star, the options.ncstars stars with the highest total weight
+    in the solution (other than the star itself) are stored as the comparison
+    stars of each light curve, with their share of this total weight and the
+    standard deviation of their own light curve. Return a list of two-element
+    tuples, with the ID of each star and its LightCurve, for those stars with
+    enough points.
+
+    """
+
+    stars = [star for star in stars if len(star) >= options.min_images]
+    if len(stars) < 2:
+        return []
+
+    time_axis = stars[0]._time_axis
+    rows, columns, mags, snrs = photometry_points(stars)
+    errors = snr.snr_to_error(snrs)[1]
+
+    shape = len(stars), len(time_axis)
+    star_means, zero_points, zp_errors, weights = \
+        ensemble_photometry(rows, columns, mags, errors, shape,
+                            iterations = options.ensemble_iters)
+
+    # The points of each star are contiguous: [ends[i] - len(star), ends[i])
+    ends = numpy.cumsum([len(star) for star in stars])
+    slices = [slice(end - len(star), end) for star, end in zip(stars, ends)]
+
+    # The standard deviation of the light curve of each star; and the stars
+    # that contribute the most to the ensemble, with their share of the weight
+    dmags = mags - zero_points[columns]
+    stdevs = numpy.array([numpy.std(dmags[points]) for points in slices])
+    total_weights = numpy.bincount(rows, weights, minlength = len(stars))
+    ranking = numpy.argsort(total_weights)[::-1][:options.ncstars + 1]
+
+    # Number of stars in each image other than the star itself
+    image_counts = numpy.bincount(columns, minlength = len(time_axis))
+
+    light_curves = []
+    for index, star in enumerate(stars):
+
+        star_columns = columns[slices[index]]
+        points = image_counts[star_columns] - 1 >= options.min_cstars
+        if points.sum() < options.min_images:
+            logging.debug("Star %d: ignored (minimum of %d images with %d "
+                          "other stars not met)" % (star.id, options.min_images,
+                                                    options.min_cstars))
+            continue
+
+        cindexes = [x for x in ranking if x != index][:options.ncstars]
+        cstars = [stars[x].id for x in cindexes]
+        cweights = total_weights[cindexes] / total_weights[cindexes].sum()
+        curve = database.LightCurve(star.pfilter, cstars, cweights,
+                                    stdevs[cindexes], dtype = star.dtype)
+
+        star_errors = errors[slices[index]][points]
+        point_errors = snr.difference_error(star_errors, zp_errors[star_columns[points]])
+        dsnrs = snr.error_to_snr(point_errors)
+        curve.extend(time_axis[star_columns[points]],
+                     dmags[slices[index]][points], dsnrs)
+        light_curves.append((star.id, curve))
+
+    return light_curves
 
 # The Queue is global -- this works, but note that we could have
 # passed its reference to the function managed by pool.map_async.
 # See http://stackoverflow.com/a/3217427/184363
 queue = methods.Queue()
 
+def comparison_key(star, options):
+    """ Return the key under which the comparison stars of a star are cached.
+
+    Stars observed in exactly the same images, and therefore with the same
+    observation bitmask (see DBStar.__init__), have the same candidates to
+    comparison stars, except for themselves. Those with, in addition, similar
+    magnitudes, can then share the comparison stars that were identified for
+    any of them. The key is a two-element tuple: the bitmask, as a string, and
+    the index of the bin, of width options.memoize_bin, where the median of
+    the instrumental magnitudes of the star falls.
+
+    """
+
+    mag_bin = int(numpy.floor(numpy.median(star._magnitudes) / options.memoize_bin))
+    return star._mask.tostring(), mag_bin
+
+def memoize_groups(stars, options):
+    """ Group the stars that can share their comparison stars (--memoize).
+
+    Return a list of lists of DBStars: the stars with the same comparison_key,
+    in the same order as in 'stars'. Each group is processed by one worker,
+    which identifies the comparison stars of its first star and reuses them
+    for the others. As most stars are usually observed in the same images, a
+    few groups may contain most of them, so those larger than the share of
+    each core (the number of stars divided by options.ncores) are split into
+    consecutive chunks of that size, which the workers can process in
+    parallel, at the cost of identifying the comparison stars once per chunk
+    instead of once per group.
+
+    """
+
+    groups = collections.OrderedDict()
+    for star in stars:
+        key = comparison_key(star, options)
+        groups.setdefault(key, []).append(star)
+
+    chunks = []
+    size = max(int(numpy.ceil(len(stars) / options.ncores)), 1)
+    for group in groups.itervalues():
+        chunks.extend(group[index:index + size]
+                      for index in xrange(0, len(group), size))
+    logging.info("%d stars grouped into %d groups of identical observations, "
+                 "split into %d chunks" % (len(stars), len(groups), len(chunks)))
+    return chunks
+
+def extend_light_curve(star, light_curve, stars_by_id):
+    """ Compute the points of a stored light curve for new images.
+
+    Use the comparison stars and weights of 'light_curve', the LightCurve of
+    the star as stored in the LEMONdB, to compute its differential photometry
+    in the images in which 'star', a DBStar, has records (usually, only those
+    that were added to the database after the curve was computed; see the
+    --update option). The comparison stars are looked up in 'stars_by_id', a
+    dictionary mapping each ID to its DBStar. Return a LightCurve, with the
+    same comparison stars and weights, that contains only the new points; or
+    None if any of the comparison stars was not observed in all the images,
+    in which case they have to be identified again.
+
+    """
+
+    cstars = [stars_by_id.get(cstar_id) for cstar_id in light_curve.cstars]
+    for cstar in cstars:
+        if cstar is None or not star.issubset(cstar):
+            return None
+
+    trimmed = [cstar._trim_to(star) for cstar in cstars]
+    comparison_stars = lightcurves.StarSet(trimmed, dtype = star.dtype)
+    cweights = lightcurves.Weights(light_curve.cweights, dtype = star.dtype)
+    cweights.values = numpy.array(light_curve.cstdevs)
+    return comparison_stars.light_curve(cweights, star)
+
+# The photometry read by each worker process (see worker_photometry): a single
+# entry, as each process only needs the photometry of one filter at a time.
+_worker_photometry = {}
+
+def share_photometry(db, connections, pfilter, all_stars, store, options):
+    """ Keep the photometry of all the stars for the worker processes.
+
+    Compute the observation bitmasks of 'all_stars', a sequence with the
+    DBStar of each star in the 'pfilter' photometric filter, in the same order
+    as LEMONdB.star_ids, and, with the --nearest option, their Neighbors, read
+    from 'db', a LEMONdB. These are kept, with the stars, as the photometry
+    that worker_photometry returns for 'connections' and 'store' (see that
+    function), and also returned. main() calls this function before creating
+    the pool of workers: as these are forked from it, they inherit the stars
+    (copy-on-write) instead of each of them reading all the photometry from
+    the database again.
+
+    """
+
+    key = connections.path, pfilter, store and store.path
+    _worker_photometry.clear()
+    if store is not None:
+        masks = store.masks
+    else:
+        masks = database.DBStar.observation_masks(all_stars)
+
+    if options.nearest:
+        args = db, all_stars, options.nearest_mag_scale
+        neighbors = lightcurves.Neighbors.from_db(*args)
+    else:
+        neighbors = None
+
+    value = _worker_photometry[key] = all_stars, masks, neighbors
+    return value
+
+def worker_photometry(connections, pfilter, store, options):
+    """ Return the photometry of all the stars, as read by this process.
+
+    Return a three-element tuple: a sequence with the DBStar of each star in
+    the 'pfilter' photometric filter, in the same order as LEMONdB.star_ids,
+    their observation bitmasks (see DBStar.observation_masks) and, with the
+    --nearest option, their Neighbors (None otherwise). These are normally
+    inherited from the parent process (see share_photometry); otherwise, the
+    stars are read from the database through 'connections', a database
+    .ConnectionPool, the first time that the function is called in each
+    process for the filter, and then kept in memory, so that they do not have
+    to be sent to the workers, pickled, with every task. With --max-memory,
+    'store' is the database.PhotometryStore with the photometry of the stars,
+    which is used instead; otherwise, it must be None.
+
+    """
+
+    key = connections.path, pfilter, store and store.path
+    try:
+        return _worker_photometry[key]
+    except KeyError:
+        db = connections.get()
+        if store is not None:
+            all_stars = store
+        else:
+            all_stars = db.get_photometry_matrix(pfilter).dbstars()
+        args = db, connections, pfilter, all_stars, store, options
+        return share_photometry(*args)
+
 @methods.print_exception_traceback
 def parallel_light_curves(args):
     """ Method argument of map_async to compute light curves in parallel.
@@ -719,80 +399,169 @@ def parallel_light_curves(args):
     receives a single argument, values are passed in a tuple which is then
     unpacked.
 
+    The first element of the tuple is a list with the indexes (in the order
+    of LEMONdB.star_ids) of the stars whose light curves are computed, one
+    after another. Their DBStars, and those of all the stars, candidates to
+    comparison stars, are those inherited by each worker process from main()
+    or, if none, read the first time that it needs them (see the function
+    worker_photometry) from the database, through 'connections', a database
+    .ConnectionPool, or, with --max-memory, from 'store', a database
+    .PhotometryStore (None otherwise). If --memoize
+    was given, these are stars with the same comparison_key(): the comparison
+    stars identified for the first one are then reused for the rest, unless
+    one of them is among its own comparison stars, in which case they have to
+    be identified again. If --warm-start was given, Broeg's algorithm starts, for each star,
+    from the weights stored for it in the 'initial_weights' dictionary (see
+    the --update option) or, if none, from those of the comparison stars of
+    the previous star in the list. For each star, a four-element tuple is put
+    in the queue: its ID, its light curve (None if it could not be computed),
+    whether the comparison stars were reused (None if they were not needed)
+    and the number of iterations of Broeg's algorithm that were run.
+
     """
 
-    star, all_stars, options = args
-    logging.debug("Star %d: photometry on %d images, enforced minimum of %d" %
-                 (star.id, len(star), options.min_images))
-
-    if len(star) < options.min_images:
-        logging.debug("Star %d: ignored (minimum of %d images not met)" %
-                     (star.id, options.min_images))
-        queue.put((star.id, None))
-        return
-
-    complete_for = star.complete_for(all_stars)
-    logging.debug("Star %d: %d complete stars, enforced minimum = %d" %
-                 (star.id, len(complete_for), options.min_cstars))
-
-    ncstars = min(len(complete_for), options.ncstars)
-    if ncstars < options.min_cstars:
-        logging.debug("Star %d: ignored (minimum of %d comparison stars "
-                      "not met)" % (star.id, options.min_cstars))
-        queue.put((star.id, None))
-        return
-
-    logging.debug("Star %d: will use %d complete stars (out of %d) as "
-                  "comparison)" % (star.id, ncstars, len(complete_for)))
-
-    logging.debug("Star %d: fraction of worst stars to discard = %.4f" %
-                 (star.id, options.worst_fraction))
-    logging.debug("Star %d: weights percentage change threshold = %.4f" %
-                 (star.id, options.pct))
-    logging.debug("Star %d: minimum Weights coefficients = %.4f" %
-                 (star.id, options.wminimum))
-    logging.debug("Star %d: maximum Broeg iterations: %.4f" %
-                 (star.id, options.max_iters))
-
-    complete_stars = StarSet(complete_for)
-    comparison_stars = \
-        complete_stars.best(ncstars, fraction = options.worst_fraction,
-                            pct = options.pct, minimum = options.wminimum,
-                            max_iters = options.max_iters)
-
-    logging.debug("Star %d: identified the %d best stars (out of %d)" %
-                 (star.id, len(comparison_stars), len(complete_stars)))
-    logging.debug("Star %d: best stars IDs: %s" %
-                 (star.id, [x.id for x in comparison_stars]))
-
-    cweights = \
-        comparison_stars.broeg_weights(pct = options.pct,
-                                       minimum = options.wminimum,
-                                       max_iters = options.max_iters)
-
-    logging.debug("Star %d: Broeg weights: %s" % (star.id, str(cweights)))
-    light_curve = comparison_stars.light_curve(cweights, star)
-    logging.debug("Star %d: light curve sucessfully generated "
-                  "(stdev = %.4f)" % (star.id, light_curve.stdev))
-    queue.put((star.id, light_curve))
+    indexes, connections, pfilter, store, initial_weights, options = args
+    args = connections, pfilter, store, options
+    all_stars, masks, neighbors = worker_photometry(*args)
+    stars = [all_stars[index] for index in indexes]
+
+    cached = None
+    previous = {} # the weights of the comparison stars of the previous star
+    for star in stars:
+
+        logging.debug("Star %d: photometry on %d images, enforced minimum "
+                      "of %d" % (star.id, len(star), options.min_images))
+
+        if len(star) < options.min_images:
+            logging.debug("Star %d: ignored (minimum of %d images not met)" %
+                         (star.id, options.min_images))
+            queue.put((star.id, None, None, 0))
+            continue
+
+        # A star cannot be used as comparison for itself. The comparison stars
+        # cached for the first one, that is, are reused for the others only if
+        # they are not among them. Note that if the minimum number of comparison
+        # stars was not met (i.e., the cached value is None) it will not be met
+        # either for any other star with the same key, as their complete stars
+        # are the same, only swapping themselves for the first star.
+
+        if cached is not None and \
+           (cached[1] is None or star.id not in cached[1][0].star_ids):
+            logging.debug("Star %d: reusing comparison stars of star %d" %
+                          (star.id, cached[0]))
+            selection = cached[1]
+            hit = True
+            iterations = 0
+        else:
+            if options.warm_start:
+                initial = initial_weights.get(star.id, previous)
+            else:
+                initial = None
+            args = star, all_stars, masks, options, neighbors, initial
+            selection = lightcurves.select_comparison_stars(*args)
+            if cached is None and options.memoize:
+                cached = star.id, selection
+            hit = False
+            iterations = selection[-1] if selection is not None else 0
+
+        if selection is None:
+            queue.put((star.id, None, hit, iterations))
+            continue
+
+        comparison_stars, cweights = selection[:2]
+        previous = dict(zip(comparison_stars.star_ids, cweights))
+        light_curve = comparison_stars.light_curve(cweights, star)
+        logging.debug("Star %d: light curve sucessfully generated "
+                      "(stdev = %.4f)" % (star.id, light_curve.stdev))
+        queue.put((star.id, light_curve, hit, iterations))
 
 
 parser = customparser.get_parser(description)
-parser.usage = "%prog [OPTION]... INPUT_DB OUTPUT_DB"
+parser.usage = "%prog [OPTION]... INPUT_DB OUTPUT_DB\n" \
+               "       %prog --update [OPTION]... LEMON_DB\n" \
+               "       %prog --resume [OPTION]... OUTPUT_DB"
 parser.add_option('--overwrite', action = 'store_true', dest = 'overwrite',
                   help = "overwrite output database if it already exists")
 
+parser.add_option('--update', action = 'store_true', dest = 'update',
+                  help = "update in place the light curves of a LEMON "
+                  "database to which new images have been added, instead of "
+                  "computing them all again in a new database. Each stored "
+                  "light curve is extended over the images for which there "
+                  "are no light curve points yet, with the same comparison "
+                  "stars and weights, unless these were not observed in all "
+                  "the new images in which the star was: only then (and for "
+                  "the stars that have no light curve) the comparison stars "
+                  "are identified again")
+
+parser.add_option('--resume', action = 'store_true', dest = 'resume',
+                  help = "resume an interrupted execution, whose output "
+                  "database is given as the only argument. The light curves "
+                  "are committed to the database as they are computed (see "
+                  "--checkpoint), and the stars for which this was done "
+                  "recorded, so only those stars without a light curve (or "
+                  "for which it could not be computed) are processed. The "
+                  "same options as in the interrupted execution should be "
+                  "given")
+
+parser.add_option('--checkpoint', action = 'store', type = 'int',
+                  dest = 'checkpoint', default = 100,
+                  help = "commit the light curves to the database, so that "
+                  "they are not lost if the execution is interrupted, every "
+                  "time that at least this number of stars have been "
+                  "processed since the last commit [default: %default]")
+
 parser.add_option('--cores', action = 'store', type = 'int',
                   dest = 'ncores', default = defaults.ncores,
                   help = defaults.desc['ncores'])
 
+parser.add_option('--precision', action = 'store', type = 'choice',
+                  choices = database.PRECISIONS.keys(),
+                  dest = 'precision', default = 'longdouble',
+                  help = "the floating-point precision in which instrumental "
+                  "magnitudes and SNRs are processed: " +
+                  ", ".join(database.PRECISIONS.keys()) + ". Lower precisions "
+                  "use less memory and are faster, with differences in the "
+                  "light curves well below the millimag (see the script "
+                  "benchmarks/precision.py) [default: %default]")
+
+parser.add_option('--max-memory', action = 'store', type = 'int',
+                  dest = 'max_memory', default = 0,
+                  help = "compute the light curves out of core, for campaigns "
+                  "whose photometry does not fit in memory. Instead of being "
+                  "loaded all at once, the photometry is read from the "
+                  "database one star at a time and written to a temporary, "
+                  "memory-mapped file (in the directory of the output "
+                  "database), from which the stars are read only when they "
+                  "are needed; and the stars are processed in blocks, by "
+                  "increasing magnitude, whose photometry takes up at most "
+                  "this number of MiB. All the stars are still candidates to "
+                  "comparison stars, so the light curves are the same as in "
+                  "memory, but with --memoize or --warm-start the stars are "
+                  "grouped only within each block. It cannot be used with "
+                  "--update or --ensemble. If zero, all the photometry is "
+                  "loaded into memory [default: %default]")
+
+parser.add_option('--pack', action = 'store_true', dest = 'pack',
+                  help = "pack the output database once the light curves "
+                  "have been computed: all the photometric records (and "
+                  "light curve points) of each star in each filter are "
+                  "stored together, compressed, instead of one database row "
+                  "per record. The database takes up much less disk space, "
+                  "and the photometry and light curve of a star are read "
+                  "faster, while it can still be used as any other LEMON "
+                  "database. Stars are unpacked when records are added to "
+                  "them (e.g., with --update), so this is best used once "
+                  "the database is not going to be modified")
+
 parser.add_option('-v', '--verbose', action = 'count',
                   dest = 'verbose', default = defaults.verbosity,
                   help = defaults.desc['verbosity'])
 
 curves_group = optparse.OptionGroup(parser, "Light Curves", "")
 curves_group.add_option('--minimum-images', action = 'store', type = 'int',
-                        dest = 'min_images', default = 10,
+                        dest = 'min_images',
+                        default = lightcurves.DEFAULT_OPTIONS['min_images'],
                         help = "the minimum number of images in which a star "
                         "must have been observed; the light curve will not be "
                         "calculated for those filters for which the star was "
@@ -800,7 +569,8 @@ curves_group.add_option('--minimum-images', action = 'store', type = 'int',
                         "[default: %default]")
 
 curves_group.add_option('--stars', action = 'store', type = 'int',
-                        dest = 'ncstars', default = 20,
+                        dest = 'ncstars',
+                        default = lightcurves.DEFAULT_OPTIONS['ncstars'],
                         help = "number of complete stars that will be used as "
                         "the artificial comparison star. For each star, its "
                         "'complete' set are those stars for which there is "
@@ -808,7 +578,8 @@ curves_group.add_option('--stars', action = 'store', type = 'int',
                         "images in which it was observed [default: %default]")
 
 curves_group.add_option('--minimum-stars', action = 'store',
-                        type = 'int', dest = 'min_cstars', default = 8,
+                        type = 'int', dest = 'min_cstars',
+                        default = lightcurves.DEFAULT_OPTIONS['min_cstars'],
                         help = "the minimum number of stars used to compute "
                         "the artificial comparison star, regarless of the "
                         "value of the --stars option. The light curve will "
@@ -818,11 +589,27 @@ curves_group.add_option('--minimum-stars', action = 'store',
                         "generated, so the module exits with an error. "
                         "Although acceptable, a value equal to that of "
                         "--stars is not recommended. [default: %default]")
+
+curves_group.add_option('--coverage', action = 'store', type = 'float',
+                        dest = 'coverage',
+                        default = lightcurves.DEFAULT_OPTIONS['coverage'],
+                        help = "the minimum fraction of the images in which a "
+                        "star was observed in which another star must have "
+                        "also been observed in order to be a candidate to "
+                        "comparison star. With the default value, one, only "
+                        "the complete stars are considered. Lower values "
+                        "allow comparison stars with gaps (e.g., because of "
+                        "clouds or bad columns): in each image, the weights "
+                        "are then renormalized over the comparison stars "
+                        "observed in it, and only the images in which none "
+                        "was observed are left out of the light curve "
+                        "[default: %default]")
 parser.add_option_group(curves_group)
 
 broeg_group = optparse.OptionGroup(parser, "Broeg's Algorithm", "")
 broeg_group.add_option('--pct', action = 'store', type = 'float',
-                       dest = 'pct', default = 0.01,
+                       dest = 'pct',
+                       default = lightcurves.DEFAULT_OPTIONS['pct'],
                        help = "the convergence threshold of the weights "
                        "determined by Broeg algorithm, given as a percentage "
                        "change. Iteration will stop when the percentage "
@@ -830,7 +617,8 @@ broeg_group.add_option('--pct', action = 'store', type = 'float',
                        "equal to this value [default: %default]")
 
 broeg_group.add_option('--weights-threshold', action = 'store',
-                       type = 'float', dest = 'wminimum', default = 0.0001,
+                       type = 'float', dest = 'wminimum',
+                       default = lightcurves.DEFAULT_OPTIONS['wminimum'],
                        help = "the minimum value for a coefficient to be "
                        "taken into account when calculating the percentage "
                        "change between two Weights; needed to prevent "
@@ -839,17 +627,33 @@ broeg_group.add_option('--weights-threshold', action = 'store',
                        "[default: %default]")
 
 broeg_group.add_option('--max-iters', action = 'store', type = 'int',
-                       dest = 'max_iters', default = sys.getrecursionlimit(),
+                       dest = 'max_iters',
+                       default = lightcurves.DEFAULT_OPTIONS['max_iters'],
                        help = "the maximum number of iterations of the "
                        "algorithm. If exceeded, the last computed weights "
                        "will be taken, regardless of the percentage change. "
                        "This option defaults to the maximum depth of the "
                        "Python interpreter stack [default: %default]")
+
+broeg_group.add_option('--warm-start', action = 'store_true',
+                       dest = 'warm_start',
+                       help = "start the algorithm, for each star, from the "
+                       "weights found for a star of similar magnitude, "
+                       "instead of from weights proportional to the flux of "
+                       "the comparison stars, and at each step of the "
+                       "identification of the most constant stars, from "
+                       "the weights found in the previous one. With --update, "
+                       "the weights stored for the light curves that have to "
+                       "be computed again are used. The weights to which "
+                       "the algorithm converges may differ slightly, within "
+                       "the tolerance given by --pct, but fewer iterations "
+                       "are needed to find them")
 parser.add_option_group(broeg_group)
 
 best_group = optparse.OptionGroup(parser, "Worst and Best Stars", "")
 best_group.add_option('--worst-fraction', action = 'store', type = 'float',
-                      dest = 'worst_fraction', default = 0.10,
+                      dest = 'worst_fraction',
+                      default = lightcurves.DEFAULT_OPTIONS['worst_fraction'],
                       help = "the fraction of the stars that will be "
                       "discarded at each step when identifying which are the "
                       "most constant stars. The lower this value, the most "
@@ -857,6 +661,75 @@ best_group.add_option('--worst-fraction', action = 'store', type = 'float',
                       "the field will be, but also more CPU-expensive "
                       "[default: %default]")
 parser.add_option_group(best_group)
+
+memoize_group = optparse.OptionGroup(parser, "Memoization", "")
+memoize_group.add_option('--memoize', action = 'store_true',
+                         dest = 'memoize',
+                         help = "identify the comparison stars only once for "
+                         "all the stars observed in exactly the same images "
+                         "and with similar instrumental magnitudes, reusing "
+                         "them for the rest instead of repeating the search. "
+                         "Much faster for large campaigns, where many stars "
+                         "share the same observations, at the cost of each "
+                         "star not being compared to its own optimal set")
+
+memoize_group.add_option('--memoize-bin', action = 'store', type = 'float',
+                         dest = 'memoize_bin', default = 0.5,
+                         help = "the width, in magnitudes, of the bins into "
+                         "which stars are grouped by the median of their "
+                         "instrumental magnitudes when --memoize is used. "
+                         "Stars in different bins never share their "
+                         "comparison stars [default: %default]")
+parser.add_option_group(memoize_group)
+
+nearest_group = optparse.OptionGroup(parser, "Nearest Comparison Stars", "")
+nearest_group.add_option('--nearest', action = 'store', type = 'int',
+                         dest = 'nearest',
+                         default = lightcurves.DEFAULT_OPTIONS['nearest'],
+                         help = "choose the comparison stars of each star "
+                         "only among the N stars (of those for which it is "
+                         "complete) closest to it in position and magnitude, "
+                         "found with a k-d tree over the x- and y- coordinates "
+                         "of the stars and the median of their instrumental "
+                         "magnitudes. This gives spatially local comparison "
+                         "stars, less affected by systematics such as "
+                         "vignetting or PSF variations across the field, and "
+                         "bounds the cost of finding them for each star. If "
+                         "zero, all the stars are candidates [default: "
+                         "%default]")
+
+nearest_group.add_option('--nearest-mag-scale', action = 'store',
+                         type = 'float', dest = 'nearest_mag_scale',
+                         default = lightcurves.DEFAULT_OPTIONS['nearest_mag_scale'],
+                         help = "the number of pixels equivalent to a "
+                         "difference of one magnitude when measuring the "
+                         "distance between two stars for --nearest. The "
+                         "higher this value, the more importance is given "
+                         "to magnitudes over positions [default: %default]")
+parser.add_option_group(nearest_group)
+
+ensemble_group = optparse.OptionGroup(parser, "Global Ensemble", "")
+ensemble_group.add_option('--ensemble', action = 'store_true',
+                          dest = 'ensemble',
+                          help = "instead of computing an artificial "
+                          "comparison star for each star, solve once, for "
+                          "each photometric filter, for the zero point of "
+                          "every image and the mean magnitude of every star, "
+                          "using all the photometry at once (inhomogeneous "
+                          "ensemble photometry, Honeycutt 1992). The light "
+                          "curves are then the instrumental magnitudes minus "
+                          "the zero points. Broeg's algorithm is not used, "
+                          "and the --stars option only determines how many of "
+                          "the stars with the most weight in the ensemble are "
+                          "stored as comparison stars")
+
+ensemble_group.add_option('--ensemble-iters', action = 'store', type = 'int',
+                          dest = 'ensemble_iters', default = 3,
+                          help = "the number of times the ensemble solution "
+                          "is computed, each time giving less weight to the "
+                          "stars whose scatter in the previous one exceeded "
+                          "that expected from their errors [default: %default]")
+parser.add_option_group(ensemble_group)
 customparser.clear_metavars(parser)
 
 def main(arguments = None):
@@ -889,13 +762,67 @@ def main(arguments = None):
         logging_level = logging.DEBUG
     logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
 
-    if len(args) != 2:
+    if len(args) != (1 if (options.update or options.resume) else 2):
         parser.print_help()
         return 2  # used for command line syntax errors
     else:
-        assert len(args) == 2
         input_db_path = args[0]
-        output_db_path = args[1]
+        output_db_path = args[-1]
+
+    if options.memoize_bin <= 0:
+        print "%sError. The value of --memoize-bin must be positive." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if not 0 < options.coverage <= 1:
+        print "%sError. The value of --coverage must be in (0, 1]." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.nearest < 0:
+        print "%sError. The value of --nearest must be positive." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.nearest and options.nearest < options.min_cstars:
+        print "%sError. The value of --nearest must be >= --minimum-stars." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.nearest_mag_scale < 0:
+        print "%sError. The value of --nearest-mag-scale cannot be negative." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.nearest and options.memoize:
+        print "%sError. --nearest cannot be used with --memoize." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.ensemble and options.update:
+        print "%sError. --ensemble cannot be used with --update." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.resume and (options.update or options.ensemble):
+        print "%sError. --resume cannot be used with --update or --ensemble." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.max_memory < 0:
+        print "%sError. The value of --max-memory cannot be negative." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.max_memory and (options.update or options.ensemble):
+        print "%sError. --max-memory cannot be used with --update or --ensemble." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    if options.checkpoint < 1:
+        print "%sError. The value of --checkpoint must be positive." % style.prefix
+        print style.error_exit_message
+        return 1
 
     if options.min_cstars > options.ncstars:
         print "%sError. The value of --minimum-stars must be <= --stars." % style.prefix
@@ -907,7 +834,15 @@ def main(arguments = None):
         print style.error_exit_message
         return 1
 
-    if os.path.exists(output_db_path):
+    if options.update:
+        print "%sThe light curves of '%s' will be updated." % \
+              (style.prefix, output_db_path)
+
+    elif options.resume:
+        print "%sThe light curves of '%s' will be resumed." % \
+              (style.prefix, output_db_path)
+
+    elif os.path.exists(output_db_path):
         if not options.overwrite:
             print "%sError. The output database '%s' already exists." % \
                   (style.prefix, output_db_path)
@@ -916,20 +851,25 @@ def main(arguments = None):
         else:
             os.unlink(output_db_path)
 
-    # Note that we do not allow the user to update an existing LEMON database,
-    # although it would make sense if we had just done photometry and now we
-    # wanted to generate the light curves. However, and to be on the safe side,
-    # we prefer to preserve a copy of the original database, as it is not
-    # inconceivable that the astronomer may need to recompute the curves more
-    # than once, each time with a different set of parameters.
+    # Unless --update is given, we do not modify the input LEMON database, but
+    # work on a copy of it. It is not inconceivable that the astronomer may
+    # need to recompute the curves more than once, each time with a different
+    # set of parameters, so we prefer to be on the safe side and preserve it.
+    # With --resume, the copy was already made by the interrupted execution.
 
-    print "%sMaking a copy of the input database..." % style.prefix ,
-    sys.stdout.flush()
-    shutil.copy2(input_db_path, output_db_path)
+    if not (options.update or options.resume):
+        print "%sMaking a copy of the input database..." % style.prefix ,
+        sys.stdout.flush()
+        shutil.copy2(input_db_path, output_db_path)
+        print 'done.'
     methods.owner_writable(output_db_path, True) # chmod u+w
-    print 'done.'
 
-    db = database.LEMONdB(output_db_path);
+    dtype = database.PRECISIONS[options.precision]
+    # The 'bulk-write' profile while the light curves are stored, until the end
+    db = database.LEMONdB(output_db_path, dtype = dtype, profile = 'bulk-write')
+    # The workers read the photometry from the database, each process with its
+    # own read-only connection, instead of receiving it with each task
+    connections = database.ConnectionPool(output_db_path, dtype = dtype)
     nstars = len(db)
     print "%sThere are %d stars in the database" % (style.prefix, nstars)
 
@@ -938,62 +878,229 @@ def main(arguments = None):
         print style.prefix
         print "%sLight curves for the %s filter will now be generated." % \
               (style.prefix, pfilter)
+        # The stars (their indexes in LEMONdB.star_ids) whose light curves have
+        # to be computed from scratch. When updating the light curves, only
+        # the stars observed in at least one of the images without light curve
+        # points need to be considered, and only their photometry in these
+        # images is read. Those with a stored light curve keep their comparison
+        # stars and weights, with which it is extended over the new images, if
+        # possible; the photometry of all the stars, candidates to comparison
+        # stars, is then loaded only if some curves have to be recomputed.
+        star_ids = db.star_ids
+        initial_weights = {} # stored weights of the curves to recompute
+        if options.update:
+            targets = []
+            extended = []
+            new_times = db.get_curveless_times(pfilter)
+            new_stars = db.get_images_photometry(pfilter, new_times)
+            stars_by_id = dict((star.id, star) for star in new_stars)
+            for star in new_stars:
+                stored_curve = db.get_light_curve(star.id, pfilter)
+                if stored_curve is None:
+                    targets.append(db._star_index(star.id))
+                    continue
+
+                curve = extend_light_curve(star, stored_curve, stars_by_id)
+                if curve is None:
+                    logging.debug("Star %d: comparison stars not observed in "
+                                  "all the new images" % star.id)
+                    db.delete_light_curve(star.id, pfilter)
+                    targets.append(db._star_index(star.id))
+                    weights = zip(stored_curve.cstars, stored_curve.cweights)
+                    initial_weights[star.id] = dict(weights)
+                else:
+                    extended.append((star.id, curve))
+
+            db.add_light_curves(extended, extend = True)
+            print "%s%d new images: %d light curves extended, %d to be " \
+                  "computed." % (style.prefix, len(new_times), len(extended),
+                                 len(targets))
+            del new_stars, stars_by_id
+            if not targets:
+                db.commit()
+                continue
+
+        elif options.resume:
+            # Those stars processed before the execution was interrupted
+            processed = db.get_processed_stars(pfilter)
+            targets = [index for index, star_id in enumerate(star_ids)
+                       if star_id not in processed]
+            print "%s%d stars already processed, %d to go." % \
+                  (style.prefix, len(star_ids) - len(targets), len(targets))
+        else:
+            targets = range(len(star_ids))
+
         print "%sLoading photometric information..." % style.prefix ,
         sys.stdout.flush()
-        all_stars = [db.get_photometry(star_id, pfilter) for star_id in db.star_ids]
+        # With --max-memory, the photometry is not loaded into memory, but
+        # into a memory-mapped file, from which each DBStar is read only when
+        # it is needed: 'all_stars' is a sequence, not a list, of DBStars.
+        if options.max_memory:
+            output_dir = os.path.dirname(os.path.abspath(output_db_path))
+            all_stars = database.PhotometryStore(db, pfilter, dir = output_dir)
+        else:
+            # Read with a single query, instead of one per star
+            all_stars = db.get_photometry_matrix(pfilter).dbstars()
         print 'done.'
 
+        if options.ensemble:
+            print "%sSolving the ensemble zero points..." % style.prefix ,
+            sys.stdout.flush()
+            stars = [all_stars[index] for index in targets]
+            light_curves = ensemble_light_curves(stars, options)
+            db.add_light_curves(light_curves)
+            db.commit()
+            print 'done.'
+            print "%s%d light curves stored in the database." % \
+                  (style.prefix, len(light_curves))
+            continue
+
+        # With --max-memory, the stars are processed in blocks, by increasing
+        # magnitude, and only the DBStars of the current block (in addition to
+        # those that the workers read to use as comparison stars) are held in
+        # memory. Otherwise, all the stars are processed at once.
+        if options.max_memory:
+            blocks = all_stars.blocks(targets, options.max_memory * 2 ** 20)
+            logging.info("%d stars split into %d blocks of at most %d MiB" %
+                         (len(targets), len(blocks), options.max_memory))
+        else:
+            blocks = [targets]
+
         # The generation of each light curve is a task independent from the
-        # others, so we can use a pool of workers and do it in parallel.
+        # others, so we can use a pool of workers and do it in parallel. The
+        # photometry of all the stars, already in memory (or, with --max-memory,
+        # in the memory-mapped file), is shared with the workers, which are
+        # forked from this process, instead of each one reading it again.
+        store = all_stars if options.max_memory else None
+        share_photometry(db, connections, pfilter, all_stars, store, options)
         pool = multiprocessing.Pool(options.ncores)
-        map_async_args = ((star, all_stars, options) for star in all_stars)
-        result = pool.map_async(parallel_light_curves, map_async_args)
+
+        # The multiprocessing queue contains four-element tuples, mapping the
+        # ID of each star to its light curve (None if it could not be computed),
+        # whether the comparison stars were reused from another star with the
+        # same observations and the number of iterations of Broeg's algorithm
+        # needed to find them. Instead of waiting for all the workers to
+        # finish, the light curves are stored in the database as they arrive,
+        # all those in the queue at once (LEMONdB.add_light_curves), and the
+        # stars recorded as processed (LEMONdB.add_processed_stars). Every
+        # options.checkpoint stars, the transaction is committed, so that the
+        # execution can be resumed if interrupted (the --resume option).
+
+        hits = []
+        iterations = []
+        nprocessed = 0
+        star_indexes = dict((star_id, index) for index, star_id in enumerate(star_ids))
+        ncommitted = [0] # a list, so that the nested function can modify it
+
+        def store_queued_curves():
+            """ Store the light curves in the queue; return how many """
+
+            queued = [queue.get() for x in xrange(queue.qsize())]
+            curves = []
+            for star_id, curve, hit, niterations in queued:
+                iterations.append(niterations)
+                if hit is not None:
+                    hits.append(hit)
+                if curve is None:
+                    logging.debug("Nothing for star %d; light curve could "
+                                  "not be generated" % star_id)
+                else:
+                    curves.append((star_id, curve))
+
+            if curves:
+                logging.debug("Storing %d light curves in database" % len(curves))
+                db.add_light_curves(curves)
+                logging.debug("Light curves successfully stored")
+            db.add_processed_stars((x[0] for x in queued), pfilter)
+
+            ncommitted[0] += len(queued)
+            if ncommitted[0] >= options.checkpoint:
+                logging.debug("Committing %d processed stars" % ncommitted[0])
+                db.commit()
+                ncommitted[0] = 0
+            return len(queued)
 
         methods.show_progress(0.0)
-        while not result.ready():
-            time.sleep(1)
-            methods.show_progress(queue.qsize() / len(all_stars) * 100)
-            # Do not update the progress bar when debugging; instead, print it
-            # on a new line each time. This prevents the next logging message,
-            # if any, from being printed on the same line that the bar.
-            if logging_level < logging.WARNING:
-                print
-
-        result.get() # reraise exceptions of the remote call, if any
+        for block in blocks:
+
+            stars = [all_stars[index] for index in block]
+
+            # Group the stars that can share their comparison stars, if any.
+            # In that case, each group has to be processed by the same worker;
+            # if not, each star is a group of its own.
+            if options.memoize:
+                groups = memoize_groups(stars, options)
+            elif options.warm_start:
+                # Sort the stars by magnitude, and split them into consecutive
+                # blocks (eight per core, so that the load is balanced) so that
+                # each star is warm-started with the weights of a similar one.
+                key = lambda star: numpy.median(star._magnitudes) if len(star) else 0
+                sorted_stars = sorted(stars, key = key)
+                size = max(int(numpy.ceil(len(stars) / (8 * options.ncores))), 1)
+                groups = [sorted_stars[index:index + size]
+                          for index in xrange(0, len(stars), size)]
+            else:
+                groups = [[star] for star in stars]
+
+            # Each task gets only the indexes of its stars (and their stored
+            # weights, if any): the photometry is read by the workers
+            def task(group):
+                indexes = [star_indexes[star.id] for star in group]
+                weights = dict((star.id, initial_weights[star.id])
+                               for star in group if star.id in initial_weights)
+                return indexes, connections, pfilter, store, weights, options
+
+            map_async_args = (task(group) for group in groups)
+            result = pool.map_async(parallel_light_curves, map_async_args)
+
+            while not result.ready():
+                time.sleep(1)
+                nprocessed += store_queued_curves()
+                methods.show_progress(nprocessed / max(len(targets), 1) * 100)
+                # Do not update the progress bar when debugging; instead, print
+                # it on a new line each time. This prevents the next logging
+                # message, if any, from being printed on the same line that
+                # the bar.
+                if logging_level < logging.WARNING:
+                    print
+
+            result.get() # reraise exceptions of the remote call, if any
+            nprocessed += store_queued_curves()
+
+        # The workers exit, closing their connections to the database
+        pool.close()
+        pool.join()
+        _worker_photometry.clear()
+
+        assert nprocessed == len(targets)
         methods.show_progress(100) # in case the queue was ready too soon
         print
 
-        # The multiprocessing queue contains two-element tuples,
-        # mapping the ID of each star to its light curve.
-        print "%sStoring the light curves in the database..." % style.prefix
-        methods.show_progress(0)
-        light_curves = (queue.get() for x in xrange(queue.qsize()))
-        for index, (star_id, curve) in enumerate(light_curves):
-
-            # NoneType is returned by parallel_light_curves when the light
-            # curve could not be calculated -- because it did not meet the
-            # minimum number of images or comparison stars.
-            if curve is None:
-                logging.debug("Nothing for star %d; light curve could not "
-                              "be generated" % star_id)
-                continue
+        if options.max_memory:
+            all_stars.close()
 
-            logging.debug("Storing light curve for star %d in database" % star_id)
-            db.add_light_curve(star_id, curve)
-            logging.debug("Light curve for star %d successfully stored" % star_id)
+        if options.memoize:
+            nhits = hits.count(True)
+            hit_rate = nhits / len(hits) * 100 if hits else 0
+            print "%sComparison stars reused for %d of %d stars (hit rate: " \
+                  "%.2f %%)" % (style.prefix, nhits, len(hits), hit_rate)
 
-            methods.show_progress(100 * (index + 1) / len(all_stars))
-            if logging_level < logging.WARNING:
-                print
+        nsolved = sum(1 for x in iterations if x)
+        print "%sBroeg's algorithm: %d iterations in total, %.2f per star " \
+              "for which comparison stars were identified" % \
+              (style.prefix, sum(iterations), sum(iterations) / max(nsolved, 1))
 
-        else:
-            logging.info("Light curves for %s generated" % pfilter)
-            logging.debug("Committing database transaction")
-            db.commit()
-            logging.info("Database transaction commited")
+        logging.info("Light curves for %s generated" % pfilter)
+        logging.debug("Committing database transaction")
+        db.commit()
+        logging.info("Database transaction commited")
 
-            methods.show_progress(100.0)
-            print
+    if options.pack:
+        print "%sPacking photometry and light curves..." % style.prefix ,
+        sys.stdout.flush()
+        db.pack()
+        db.vacuum()
+        print 'done.'
 
     print "%sUpdating statistics about tables and indexes..." % style.prefix ,
     sys.stdout.flush()
@@ -1005,6 +1112,7 @@ def main(arguments = None):
     db.author = pwd.getpwuid(os.getuid())[0]
     db.hostname = socket.gethostname()
     db.commit()
+    db.set_profile('default') # back to the rollback journal
 
     methods.owner_writable(output_db_path, False) # chmod u-w
     print "%sYou're done ^_^" % style.prefix
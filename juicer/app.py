@@ -403,7 +403,7 @@ class StarDetailsGUI(object):
     def redraw_light_curve(self, widget):
         """ Replot the light curve """
 
-        curve = self.db.get_light_curve(self.id, self.shown)
+        curve = self.db.lazy_light_curve(self.id, self.shown)
         args = self.airmasses_visible(), self.julian_dates_visible()
         self.update_curve(curve, *args)
 
@@ -439,7 +439,7 @@ class StarDetailsGUI(object):
             return
 
         self.shown = pfilter
-        curve = self.db.get_light_curve(self.id, pfilter)
+        curve = self.db.lazy_light_curve(self.id, pfilter)
         args = self.airmasses_visible(), self.julian_dates_visible()
         self.update_curve(curve, *args)
         self.update_light_curve_points(curve)
@@ -626,11 +626,13 @@ class StarDetailsGUI(object):
         # A row per filter with the standard deviation of the light curve;
         # these rows are inserted even for the photometric filters in which the
         # curve could not be generated (using UNKNOWN_VALUE instead), but they
-        # are hidden from the user.
+        # are hidden from the user. The light curves that are not stored in the
+        # database (e.g., because diffphot was not run) are computed now, when
+        # the star is opened, and cached there (LEMONdBMiner.lazy_light_curve)
 
         for pfilter in self.db.pfilters:
             label = "Stdev %s" % pfilter.letter
-            curve = self.db.get_light_curve(star_id, pfilter)
+            curve = self.db.lazy_light_curve(star_id, pfilter)
             if curve:
                 stdev = curve.stdev if curve else UNKNOWN_VALUE
                 store.append((label, stdev, bool(stdev)))
@@ -664,7 +666,7 @@ class StarDetailsGUI(object):
             button.set_mode(draw_indicator = False)
 
             # Disable the button if there is no curve in this filter
-            if not self.db.get_light_curve(star_id, pfilter):
+            if not self.db.lazy_light_curve(star_id, pfilter):
                 button.set_sensitive(False)
             else:
                 button.connect('button-press-event', self.show_pfilter, pfilter)
@@ -1224,7 +1226,11 @@ class LEMONJuicerGUI(object):
 
         try:
 
-            db = mining.LEMONdBMiner(path)
+            # Databases that cannot be modified (as diffphot leaves them) are
+            # browsed with the 'read-mostly' profile; otherwise, the default,
+            # so that the light curves computed on demand can be stored.
+            profile = 'default' if os.access(path, os.W_OK) else 'read-mostly'
+            db = mining.LEMONdBMiner(path, profile = profile)
             db_pfilters = db.pfilters
 
             # Two columns are used for the right ascension and declination of
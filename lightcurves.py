@@ -0,0 +1,1256 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+
+"""
+This module implements the computation of the light curve of each star: the
+identification of its comparison stars, their Broeg weights and the artificial
+comparison star with which the differential photometry is done. It is used by
+diffphot, for all the stars at once, and by those modules that need the light
+curve of a single star, which can be computed here straight from a LEMONdB.
+
+"""
+
+import itertools
+import logging
+import numpy
+import optparse
+import random
+import scipy.spatial
+import sys
+
+# LEMON modules
+import database
+import methods
+import snr
+
+# The default values of the options of diffphot that determine how the light
+# curves are computed (see select_comparison_stars and compute_light_curve),
+# used when these are computed outside of diffphot, without its options
+DEFAULT_OPTIONS = dict(min_images = 10, ncstars = 20, min_cstars = 8,
+                       coverage = 1.0, pct = 0.01, wminimum = 0.0001,
+                       max_iters = sys.getrecursionlimit(),
+                       worst_fraction = 0.10, nearest = 0,
+                       nearest_mag_scale = 100.0)
+
+class Weights(numpy.ndarray):
+    """ Encapsulate the weights associated with some values """
+
+    def __new__(cls, coefficients, dtype = numpy.longdouble):
+        """ Return a new instance of the Weights class.
+
+        The weights are not automatically normalized for us, so they do not
+        necessarily have to add up to 1.0. Use Weights.normalize() for that.
+        A copy of 'coefficients' is stored in the 'values' attribute of the
+        new Weights object.
+
+        """
+
+        if not len(coefficients):
+            raise ValueError("arg is an empty sequence")
+        w = numpy.asarray(coefficients, dtype = dtype).view(cls)
+        w.values = numpy.array(coefficients)
+        return w
+
+    def __str__(self):
+        coeffs_str = ", ".join(["%s" % x for x in self])
+        return "%s(%s)" % (self.__class__.__name__, coeffs_str)
+
+    def rescale(self, key):
+        """ Exclude the key-th coefficient and return the rescaled Weights.
+
+        Note that the key-th element is also removed from the 'values'
+        attribute of the returned object. The reason is that, if a coefficient
+        is deleted, there is no longer need to keep track of what its original
+        value was.
+
+        """
+
+        if len(self) == 1:
+            raise ValueError("cannot rescale one-element instance")
+        w = Weights(numpy.delete(self, key), dtype = self.dtype).normalize()
+        w.values = numpy.delete(self.values, key)
+        return w
+
+    @property
+    def total(self):
+        return numpy.sum(self)
+
+    def normalize(self):
+        """ Rescale the coefficients to that they add up to one.
+
+        Return a new Weights object where each element has been divided by the
+        sum of all the coefficients. The 'values' attribute of the new object
+        is set to the value of self.values: in this manner, when working with
+        the new Weights object we will always be able to know what were the
+        original coefficients, before the normalization.
+
+        """
+
+        w = Weights(self / self.total, dtype = self.dtype)
+        w.values = self.values
+        return w
+
+    @classmethod
+    def inversely_proportional(cls, values, dtype = numpy.longdouble):
+        """ Return Weights inversely proportional to 'values'.
+
+        For example, [1, 1, 2] returns Weights([0.4, 0.4, 0.2]). Note that at
+        least one value is required, and that none of them may be zero (as in
+        that case we would be dividing by zero). A copy of 'values' is stored
+        in the 'values' attribute of the returned Weights object.
+
+        """
+
+        if not len(values):
+            raise ValueError("'values' is an empty sequence")
+        if not all(values):
+            raise ValueError("'values' cannot contain zeros")
+        values = numpy.array(values,  dtype = dtype)
+        w = cls(1 / values).normalize()
+        w.values = numpy.array(values)
+        return w
+
+    def absolute_percent_change(self, other, minimum = None):
+        """ Return the percent change of two Weights of the same size. More
+        specifically, the method returns the maximum absolute percent change
+        between the coefficients of both instances that have the same
+        position. In other words: the percent change between the first
+        coefficient in 'self' and the first one in 'other' is calculated, and
+        so on, and the maximum value among them is then returned. This method
+        can be used in order to check how similar two weights are in percentage
+        terms, or whether some Weights have converged to a given solution. Note
+        that pairs which contain a zero in self are ignored (i.e., the maximum
+        percent change between 0 and 4 cannot be calculated).
+
+        The 'minimum' keyword, which must be a positive number, sets the lowest
+        value that a coefficient must have (in both 'self' and 'other') in
+        order to be taken into account. In this manner, extremely small
+        coefficients, such as 1.09720056734e-15 (true story, we came across
+        this exact value while reducing real data) may be excluded from the
+        comparison, as at this point we are comparing mostly noise. ValueError
+        is raised is 'minimum' causes all the coefficients to be discarded.
+
+        """
+
+        if minimum is not None and minimum <= 0:
+            raise ValueError("'minimum' must be a positive number")
+
+        if len(self) != len(other):
+            raise ValueError("both instances must be of the same size")
+
+        coefficients = []
+        for x, y in zip(self, other):
+            if x and (not minimum or min(x, y) >= minimum):
+                coefficients.append((x, y))
+
+        if not coefficients:
+            msg = "all coefficients were discarded ('minimum' too high?)"
+            raise ValueError(msg, self)
+        else:
+            return max((abs(methods.percentage_change(x, y))
+                            for x, y in coefficients))
+
+    @classmethod
+    def random(cls, size):
+        weights = cls([random.uniform(0, 1) for _ in xrange(size)])
+        return weights.normalize()
+
+
+class StarSet(object):
+    """ A collection of DBStars *with information for the exact same images*,
+    all of them also taken in the same filter. Internally, and for performance
+    purposes, all the photometric information is kept in a three-dimensional
+    (star, data, image) array. The only exception are the sets returned by
+    StarSet.masked, whose stars may lack some of the images (see there). """
+
+    def _add(self, index, star):
+        """ Add a DBStar to the set.
+
+        In order not to maintain duplicate information in memory, the DBStar
+        instances are parsed and their photometric information stored in the
+        three-dimensional, low-level internal array.
+
+        The ValueError exception is raised in the following cases:
+        (1) If the DBStar has no photometric records (i.e., is empty)
+        (2) If the photometric filter of the DBStar does not match that of
+            the StarSet, which was defined when the class was instantiated.
+        (3) If the ID of the DBStar matches that of any of the DBStars
+            already stored in the set, if any. This means, thus, that the
+            DBStars stored in a StarSet are guaranteed to have different IDs.
+        (4) If the Unix times of the photometric records of the DBStar are
+            not equal to those of the DBStars already stored in the StarSet,
+            if any. In other words: the DBStars stored in a StarSet are
+            guaranteed to have photometric records for the same Unix times.
+
+        """
+
+        # We cannot do time-series photometry with stars which have no
+        # information at all. It makes no sense, so don't even allow it.
+        if not len(star):
+            raise ValueError("star cannot be empty")
+
+        if not len(self.star_ids):
+            self._star_ids.append(star.id)
+            self.pfilter = star.pfilter
+            self._unix_times = star._unix_times
+            self._time_axis = star._time_axis
+
+            # Three-dimensional array: first dimension maps to the star; second
+            # to the type of info (index 0 for mag, 1 for SNR) and third to the
+            # Unix time (in case we need to know to which time a given index
+            # correspond, we can use self._unix_times). For example, to get all
+            # the magnitudes of the third star, we will do self.phot_info[2][0]
+            self._phot_info[index] = star._values
+
+        else:
+            if star.pfilter != self.pfilter:
+                msg = "star with ID = %d has filter '%s', expected '%s'"
+                raise ValueError(msg % (star.id, star.pfilter, self.pfilter))
+
+            if star.id in self.star_ids:
+                raise ValueError("star with ID = %d already in the set" % star.id)
+
+            if len(star) != self.nimages or \
+               not numpy.all(numpy.in1d(self._unix_times, star._unix_times)):
+                raise ValueError("stars must have info for the same Unix times")
+
+            self._star_ids.append(star.id)
+            self._phot_info[index] = star._values
+
+    def __init__(self, stars, dtype = numpy.longdouble):
+        """ Instantiation method for the StarSet class.
+
+        The DBStars that belong to the StarSet must be given in a sequence (the
+        'stars' parameter) at instantiation time. You are not expected, and
+        should never, ever need to call the StarSet._add method by yourself.
+
+        The method propagates the exceptions raised by StarSet._add, to which
+        you should refer for in-depth information. The rules, anyway, can be
+        summarized as follows: at least one DBStar, which cannot be empty, is
+        needed, and they must have the same filter and Unix times, as well as
+        different IDs. If one of these conditions is not met, ValueError is
+        raised.
+
+        """
+
+        if not stars:
+            raise ValueError("at least one star is needed")
+
+        self.dtype = dtype
+        self.iterations = 0 # of Broeg's algorithm, see StarSet.broeg_weights
+        self._star_ids = []
+        self._observed = None # all the stars were observed in all the images
+        # Do not set the array values to zero (marginally faster)
+        self._phot_info = numpy.empty((len(stars), 2, len(stars[0])), dtype = self.dtype)
+        for index, star in enumerate(stars):
+            self._add(index, star)
+
+    @property
+    def star_ids(self):
+        """ Return a list with the IDs of the stars contained in the set """
+        return self._star_ids
+
+    def __len__(self):
+        """ The number of stars in the set """
+        return self._phot_info.shape[0]  # 1st dimension = stars
+
+    @property
+    def nimages(self):
+        """ The number of Unix times for which the stars have info """
+        return len(self._unix_times)
+
+    def __delitem__(self, index):
+        """ Delete the index-th star """
+        self._phot_info = numpy.delete(self._phot_info, index, axis = 0)
+        assert self._phot_info.shape[0] == len(self)  # first dimension: star
+        if self._observed is not None:
+            self._observed = numpy.delete(self._observed, index, axis = 0)
+        del self._star_ids[index]
+        assert len(self.star_ids) == len(self), "%d vs %d" % (len(self.star_ids), len(self))
+
+    def __getitem__(self, index):
+        """ Return the index-th star as a DBStar instance """
+
+        # The constructor of a DBStar receives a NumPy array with three rows
+        # (the first for the time, the second for the magnitude and the last
+        # for the SNR), and as many columns as records for which there is
+        # photometric information.
+        dtype = database.phot_info_dtype(self.dtype)
+        sphot_info = numpy.empty((3, self.nimages), dtype = dtype)
+        sphot_info[0] = self._unix_times
+        sphot_info[1] = self._phot_info[index][0]
+        sphot_info[2] = self._phot_info[index][1]
+
+        # In a masked set, only the images in which the star was observed
+        if self._observed is not None:
+            sphot_info = sphot_info[:, self._observed[index]]
+
+        id_ = self._star_ids[index]
+        return database.DBStar(id_, self.pfilter, sphot_info,
+                               dtype = self.dtype, time_axis = self._time_axis)
+
+    @classmethod
+    def masked(cls, star, stars, dtype = numpy.longdouble):
+        """ Return a StarSet, over the images of a DBStar, of gapped stars.
+
+        Unlike the StarSet constructor, this method accepts DBStars that were
+        not observed in all the images in which 'star' was, such as those
+        returned by DBStar.covered_for. The Unix times of the set are those of
+        'star', and a boolean (stars x images) array, the '_observed' attribute,
+        tells whether each star was observed in each image; where it was not,
+        its magnitude and SNR are NaN. Records of the stars for images in which
+        'star' was not observed are ignored. The flux-proportional and Broeg
+        weights of these sets, as well as the light curves computed with them,
+        work on the masked (stars x images) array: in each image, the weights
+        are renormalized over the stars observed in it. 'star' itself is not
+        added to the set. All the DBStars must share the same time axis and
+        filter, have different IDs and have been observed in at least one of
+        the images of 'star'; ValueError is raised otherwise.
+
+        If it turns out that all the stars were observed in all the images, the
+        '_observed' attribute is set to None, so that the StarSet is exactly as
+        if it had been created with the constructor: there is then no cost at
+        all in allowing for gaps.
+
+        """
+
+        if not stars:
+            raise ValueError("at least one star is needed")
+
+        time_axis = star._time_axis
+        if time_axis is None or not all(s._time_axis is time_axis for s in stars):
+            raise ValueError("DBStars must share the same time axis")
+
+        # Map each position in the time axis to the index of the Unix time in
+        # 'star' (-1 for the images in which it was not observed)
+        lookup = numpy.empty(len(time_axis), dtype = int)
+        lookup.fill(-1)
+        lookup[star._axis_indexes] = numpy.arange(len(star))
+
+        set_ = cls.__new__(cls)
+        set_.dtype = dtype
+        set_.iterations = 0
+        set_.pfilter = star.pfilter
+        set_._star_ids = []
+        set_._unix_times = star._unix_times
+        set_._time_axis = time_axis
+
+        shape = len(stars), 2, len(star)
+        set_._phot_info = numpy.empty(shape, dtype = dtype)
+        set_._phot_info.fill(numpy.nan)
+        set_._observed = numpy.zeros((len(stars), len(star)), dtype = bool)
+
+        for index, other in enumerate(stars):
+            if other.pfilter != star.pfilter:
+                msg = "star with ID = %d has filter '%s', expected '%s'"
+                raise ValueError(msg % (other.id, other.pfilter, star.pfilter))
+            if other.id in set_._star_ids:
+                raise ValueError("star with ID = %d already in the set" % other.id)
+            set_._star_ids.append(other.id)
+
+            columns = lookup[other._axis_indexes]
+            shared = columns != -1
+            if not numpy.any(shared):
+                msg = "star with ID = %d has no images in common with star %d"
+                raise ValueError(msg % (other.id, star.id))
+            set_._phot_info[index][:, columns[shared]] = other._values[:, shared]
+            set_._observed[index, columns[shared]] = True
+
+        if numpy.all(set_._observed):
+            set_._observed = None
+        return set_
+
+    def flux_proportional_weights(self):
+        """ Return the Weights proportional to the flux of each star.
+
+        The method returns a Weights instance with as many coefficients as
+        stars there are in the set, and where each one is assigned a value
+        directly proportional to the median of its normalized flux. Note that,
+        although the DBStars store instrumental magnitudes, we work here with
+        fluxes: thus, if the instrumental magnitude of A is one magnitude
+        greater than that of B, for example, it means that A is 2.512 times
+        fainter and its weight must be 2.512 times smaller than that of B.
+
+        The first versions of this algorithm used a single image (such as that
+        with the best seeing) to determine the flux-proportional weights. The
+        logic behind the current implementation, considerably more robust as
+        all the images are used, is that, for example, the brightest star in
+        the field should always be the brightest, no matter what the
+        atmospheric conditions are. Therefore, instrumental magnitudes are
+        normalized by dividing them by the maximum of each image, and then
+        the median of the normalized magnitudes of each star used to compute
+        the weights, directly proportional to these values.
+
+        Note that, of course, the 'brightest star will always be the brightest'
+        line of reasoning only applies to non-variable stars, which are assumed
+        to be the great majority of the objects in the field. Otherwise, to
+        what exactly do you intend to compare their instrumental magnitudes?
+
+        """
+
+        mags = self._phot_info[:, 0, :]
+        return self._flux_proportional_weights(mags, self.dtype, self._observed)
+
+    @staticmethod
+    def _flux_proportional_weights(mags, dtype, observed = None):
+        """ The flux-proportional Weights of a (stars x images) magnitudes array.
+
+        This is the actual implementation of StarSet.flux_proportional_weights,
+        which works on any two-dimensional array of instrumental magnitudes, so
+        that the weights of a subset of the stars can be computed without
+        having to create a new StarSet (see StarSet.best). 'observed', if given,
+        is a boolean array of the same shape that tells whether each star was
+        observed in each image: the magnitudes where it is False are ignored.
+
+        """
+
+        # For each image (column), normalize the magnitudes of the stars: they
+        # are divided by the maximum magnitude in the image. Then, for each
+        # star (row), calculate the median of its normalized magnitudes.
+        if observed is None:
+            norm_mags = mags / mags.max(axis = 0)
+            mag_medians = numpy.median(norm_mags, axis = 1)
+        else:
+            # A masked median, as numpy.nanmedian is new in NumPy 1.9
+            maxima = numpy.where(observed, mags, -numpy.inf).max(axis = 0)
+            with numpy.errstate(invalid = 'ignore'):
+                norm_mags = numpy.ma.masked_array(mags / maxima, mask = ~observed)
+            mag_medians = numpy.ma.median(norm_mags, axis = 1).filled(numpy.nan)
+
+        pogsonr = 100 ** 0.2  # fifth root of 100 (Pogson's Ratio)
+        args = pogsonr ** mag_medians
+        return Weights.inversely_proportional(args, dtype = dtype)
+
+    def light_curve(self, weights, star, no_snr = False, _exclude_index = None):
+        """ Generate the light curve of a DBStar.
+
+        Use the stars in the set to compute an artificial comparison star,
+        using the weighted average of their instrumental magnitudes as the
+        photometric reference level: for each point in time, subtract the
+        instrumental magnitude of the comparison star from that of the star.
+
+        The 'weights' object is **expected** to have been created with the
+        Weights.inversely_proportional() method, assigning to each comparison
+        star a weight inversely proportional to the standard deviation of its
+        light curve. This is very important because this method expects that
+        weights.values stores the *light curve standard deviations* of the
+        comparison stars, and therefore these will be the values stored in
+        the 'cstdevs' attribute of the returned LightCurve object.
+
+        Note that it is mandatory that the DBStar has photometric information
+        for exactly the same Unix times for which the stars in the set have
+        photometric records. In practice, this means that they will be those
+        returned by the DBStar.complete_for method, which identifies precisely
+        the DBStars that can be used as the artificial comparison star.
+
+        The differential magnitudes and signal-to-noise ratios are computed
+        for all the images at once, operating on the (stars x images) arrays
+        of magnitudes and SNRs, and only then added to the light curve. The
+        calculation of the SNRs, however, still involves several conversions
+        between SNRs and errors in magnitudes, so the 'no_snr' keyword
+        argument, if set to True, will make the method skip it, using None
+        instead. This is useful for those callers that do not care about the
+        signal-to-noise ratios, but only the standard deviation of the light
+        curves.
+
+        If specified, the '_exclude_index' argument determines the index of the
+        star in the set that will not be used as comparison star, regardless of
+        its weight. It is equivalent to setting the index-th coefficient to
+        zero and then rescaling the weights. This parameter is here (and most
+        probably only needed) because of the method StarSet.broeg_weights,
+        which computes the light curve of each one of the stars in the set
+        using all the others as comparison.
+
+        """
+
+        if len(weights) != len(self):
+            msg = "number of weights must match that of comparison stars"
+            raise ValueError(msg)
+
+        if _exclude_index is not None and not 0 <= _exclude_index < len(self):
+            msg = "_exclude_index out of range"
+            raise IndexError(msg)
+
+        if not numpy.all(numpy.equal(star._unix_times, self._unix_times)):
+            msg = "Unix times of StarSet and DBStar do not match"
+            raise ValueError(msg)
+
+        if _exclude_index is None:
+            rweights = weights
+        else:
+            # Set the _exclude_index-th star to zero, but preserve the original
+            # value of the 'values' attribute. These are the standard deviations
+            # of the comparison stars, so we do not want to modify them, even if
+            # one of them has not been used as comparison.
+            values = numpy.array(weights.values)
+            rweights = weights.rescale(_exclude_index)
+            rweights = numpy.insert(rweights, _exclude_index, 0.0)
+            rweights.values = values
+
+        assert len(rweights) == len(self)
+
+        assert hasattr(rweights, 'values')
+        cstdevs = rweights.values
+        args = self.pfilter, self.star_ids, rweights, cstdevs
+        curve = database.LightCurve(*args, dtype = self.dtype)
+
+        # The magnitudes and SNRs of the comparison star in each image: the
+        # weighted mean of each column of the (stars x images) arrays.
+        rweights = numpy.asarray(rweights)
+        if self._observed is not None:
+            return self._masked_light_curve(curve, rweights, star, no_snr)
+
+        cmags = numpy.average(self._phot_info[:, 0, :], axis = 0, weights = rweights)
+        dmags = star._magnitudes - cmags
+
+        if no_snr:
+            dsnrs = [None] * self.nimages
+        else:
+            csnrs = snr.mean_snr(self._phot_info[:, 1, :], weights = rweights)
+            dsnrs = snr.difference_snr(star._snrs, csnrs)
+
+        curve.extend(self._unix_times, dmags, dsnrs)
+        return curve
+
+    @staticmethod
+    def _masked_means(mags, observed):
+        """ Return the mean magnitude of each star of a masked set.
+
+        'mags' is a (stars x images) array of instrumental magnitudes and
+        'observed' the boolean array that tells whether each star was observed
+        in each image (see StarSet.masked). The mean of each star (row) is
+        taken over the images in which it was observed.
+
+        """
+
+        sums = numpy.where(observed, mags, 0).sum(axis = 1)
+        return sums / numpy.maximum(observed.sum(axis = 1), 1)
+
+    def _masked_light_curve(self, curve, weights, star, no_snr = False):
+        """ StarSet.light_curve, for the sets returned by StarSet.masked.
+
+        In each image, the weights of the comparison stars are renormalized
+        over those observed in it, so that the artificial comparison star is
+        the weighted mean of the stars that are available. As the stars have
+        different brightness, what is averaged in each image is how much each
+        star deviates from its mean magnitude (StarSet._masked_means); the
+        weighted mean of these means is then added back. Otherwise, the level
+        of the comparison star would jump whenever one of the stars was not
+        observed. Images in which none of the comparison stars (with a
+        non-zero weight) was observed are left out of the light curve. The
+        points are added to 'curve', the empty LightCurve, which is returned.
+
+        """
+
+        observed = self._observed
+        means = self._masked_means(self._phot_info[:, 0, :], observed)
+        level = (weights * means).sum() / weights.sum()
+        iweights = weights[:, numpy.newaxis] * observed
+        totals = iweights.sum(axis = 0)
+        points = totals > 0
+        iweights = iweights[:, points] / totals[points]
+        observed = observed[:, points]
+
+        offsets = self._phot_info[:, 0, points] - means[:, numpy.newaxis]
+        offsets = numpy.where(observed, offsets, 0)
+        cmags = level + (iweights * offsets).sum(axis = 0)
+        dmags = star._magnitudes[points] - cmags
+
+        if no_snr:
+            dsnrs = [None] * len(dmags)
+        else:
+            # snr.mean_snr, with a different set of weights for each image. The
+            # SNRs of the stars not observed (with a weight of zero) could be
+            # any valid value: we use infinity, for an error of zero.
+            snrs = numpy.where(observed, self._phot_info[:, 1, points], numpy.inf)
+            errors = snr.snr_to_error(snrs)[1]
+            cerrors = numpy.sqrt(numpy.sum(iweights ** 2 * errors ** 2, axis = 0))
+            dsnrs = snr.difference_snr(star._snrs[points], snr.error_to_snr(cerrors))
+
+        curve.extend(self._unix_times[points], dmags, dsnrs)
+        return curve
+
+    @staticmethod
+    def _leave_one_out_stdevs(mags, weights, observed = None):
+        """ Return the stdev of the light curve of each star against the rest.
+
+        'mags' is a two-dimensional (stars x images) array of instrumental
+        magnitudes and 'weights' the coefficient of each star. For each star,
+        the light curve is computed using all the other stars as comparison,
+        with their weights rescaled so that they add up to one, and the
+        standard deviation of its differential magnitudes returned. This is
+        the equivalent of calling StarSet.light_curve with _exclude_index set
+        to each of the stars, but instead of building a curve for each one of
+        them we compute the weighted sum of all the magnitudes, once, and then
+        subtract from it the contribution of each star (a rank-1 update), so
+        the cost is O(N x T) instead of O(N^2 x T).
+
+        'observed', if given, is a boolean array of the same shape as 'mags'
+        that tells whether each star was observed in each image. The weights
+        are then renormalized in each image over the other stars observed in
+        it, and the standard deviation of each star computed over the images
+        in which both it and at least one of the others were observed. Stars
+        with fewer than two such images are given an infinite deviation. As
+        in StarSet._masked_light_curve, the magnitudes are first taken
+        relative to the mean of each star.
+
+        """
+
+        weights = numpy.asarray(weights)[:, numpy.newaxis]
+        if observed is None:
+            wmags = weights * mags
+            # The comparison star of the i-th star: the weighted mean of the
+            # magnitudes of all the stars, excluding the i-th one from both the
+            # weighted sum and the sum of the weights (i.e., rescaling them).
+            cmags = (wmags.sum(axis = 0) - wmags) / (weights.sum() - weights)
+            return numpy.std(mags - cmags, axis = 1)
+
+        # The same, but with the sum of the weights of each image (column)
+        # restricted to the stars observed in it. Where these add up to zero
+        # there is no comparison star, so the point is not used.
+        weights = weights * observed
+        means = StarSet._masked_means(mags, observed)
+        mags = numpy.where(observed, mags - means[:, numpy.newaxis], 0)
+        wmags = weights * mags
+        rweights = weights.sum(axis = 0) - weights
+        used = observed & (rweights > 0)
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            cmags = (wmags.sum(axis = 0) - wmags) / rweights
+        dmags = numpy.where(used, mags - cmags, 0)
+
+        npoints = used.sum(axis = 1)
+        stdevs = numpy.empty(len(mags), dtype = dmags.dtype)
+        stdevs.fill(numpy.inf)
+        enough = npoints >= 2
+        means = dmags[enough].sum(axis = 1) / npoints[enough]
+        residuals = numpy.where(used[enough], dmags[enough] - means[:, numpy.newaxis], 0)
+        stdevs[enough] = numpy.sqrt(numpy.square(residuals).sum(axis = 1) / npoints[enough])
+        return stdevs
+
+    def broeg_weights(self, pct = 0.01, max_iters = None, minimum = None,
+                      initial = None):
+        """ Determine the weights that give the optimum comparison star.
+
+        This is our implementation of C. Broeg's algorithm ('A new algorithm
+        for differential photometry: computing an optimum artificial comparison
+        star', 2005, http://adsabs.harvard.edu/abs/2005AN....326..134B), which
+        identifies the weights that produce the optimal artificial comparison
+        star. In other words: the returned Weights instance, if applied to the
+        StarSet to compute a light curve, create an artificial comparison star
+        with the minimal standard deviation; that is, the most constant one.
+
+        In broad terms, Broeg's algorithm works by iteratively calculating the
+        differential magnitudes of all the stars in the set with respect to the
+        others, using weights inversely proportional to the standard deviation
+        of each star in the previous step. This is mostly it. You should refer
+        to the original paper in case you need to understand the exact details
+        of the algorithm.
+
+        There is, however, a major difference between the original algorithm
+        and the one implemented here: for the first series of light curves,
+        Broeg uses the instrumental errors as a first guess for the standard
+        deviations. We, instead, use weights directly proportional to the flux
+        of each star (see method StarSet.flux_proportional_weights), on the
+        reasoning that, the brightest a star, the higher its signal-to-noise
+        ratio and lower its noise, and therefore it should be given more
+        weight in the first iteration.
+
+        Note that the returned Weights object stores the standard deviations of
+        the light curves of the comparison stars in the 'values' attribute. In
+        this manner, we can always know what was the standard deviation of each
+        of the comparison stars, from which the inversely-proportional weights
+        returned in the Weights object were calculated.
+
+        The ValueError exception is raised if there are less than two stars
+        in the set. The reason for this is that the standard deviation of the
+        light curve of a star cannot be calculated if it was only observed in
+        one image: we cannot compute the standard deviation of a single value,
+        and assuming it to be zero, as NumPy does, is equally catastrophic and
+        useless, for all the stars would have the same standard deviation and,
+        furthermore, it would result in divisions by zero when
+        Weights.inversely_proportional were called.
+
+        Keyword arguments:
+        - pct: the convergence threshold, given as a percentage change. The
+               optimum weights will be considered to have been found when the
+               percentage change (see Weights.absolute_percent_change) between
+               the weights computed in the last two iterations is less than or
+               equal to this value.
+        - max_iters: the maximum number of iterations of the algorithm. Any
+                     value which evaluates to False (such as zero or None) will
+                     be interpreted as to mean 'use the current value of the
+                     recursion limit' - as returned by sys.getrecursionlimit().
+        - minimum: the minimum value for a coefficient to be taken into account
+                   when calculating the percentage change between two Weights;
+                   used in order to prevent scientifically-insignificant values
+                   from making the algorithm stop or iterate more than needed.
+        - initial: a dictionary mapping star IDs to the weights from which to
+                   start iterating, instead of the flux-proportional ones, such
+                   as those previously found for a similar set of stars. Stars
+                   not in the dictionary start with their flux-proportional
+                   weights. See StarSet._initial_weights for details.
+
+        The number of iterations of the algorithm is added to the 'iterations'
+        attribute of the StarSet, so that we can keep track of how many were
+        needed to find the weights (for example, with different 'initial').
+
+        """
+
+        if not len(self):
+            raise ValueError("cannot work with an empty instance")
+
+        kwargs = dict(pct = pct, max_iters = max_iters, minimum = minimum)
+        initial = self._aligned_weights(initial)
+        return self._broeg_weights(self._phot_info[:, 0, :], initial = initial,
+                                   observed = self._observed, **kwargs)
+
+    def _broeg_weights(self, mags, pct = 0.01, max_iters = None,
+                       minimum = None, initial = None, observed = None):
+        """ The Broeg weights of a (stars x images) magnitudes array.
+
+        This is the actual implementation of StarSet.broeg_weights, working on
+        any two-dimensional array of instrumental magnitudes, such as the rows
+        of self._phot_info[:, 0, :] that correspond to some of the stars in the
+        set. This allows StarSet.best to iteratively discard the most variable
+        stars by working with an array of the indexes of those left, without
+        having to copy the StarSet or delete stars from it at each step.
+
+        'initial', if given, is an array with the initial weight of each star
+        (row of 'mags'), NaN for those for which it is unknown. 'observed', for
+        masked sets, tells whether each star was observed in each image (see
+        StarSet.masked). The number of iterations of the algorithm is added to
+        self.iterations.
+
+        """
+
+        nstars, nimages = mags.shape
+
+        # If there is only one star, its weight cannot be other than one
+        if nstars == 1:
+            return Weights([1.0], dtype = self.dtype)
+
+        # When there are only two stars in the StarSet, and since their light
+        # curves are generated by comparing each one to the other, both will
+        # have the same standard deviation, and therefore also equal weights.
+        if nstars == 2:
+            return Weights([0.5, 0.5], dtype = self.dtype)
+
+        if nimages < 2:
+            raise ValueError("at least two images are needed")
+
+        # Initial weights are inversely proportional to the magnitude of each
+        # star. Then, the differential magnitude of each comparison star is
+        # calculated with respect to the others using the same (rescaled)
+        # weights. The standard deviation of the light curve that results from
+        # using these (rescaled) weights is used in order to compute the new
+        # weights for each star. We stop when the absolute percent change
+        # between the old weights and the new one is below the threshold
+
+        weights = [self._initial_weights(mags, initial, observed)]
+        for iteration in xrange(max_iters or sys.getrecursionlimit()):
+            self.iterations += 1
+            curves_stdevs = self._leave_one_out_stdevs(mags, weights[-1], observed)
+
+            # Avoid the division by zero if, somehow, a star ends up having a
+            # standard deviation of zero, as Weights.inversely_proportional
+            # would raise ValueError. Instead, stop the computation so that
+            # the last valid weights are returned.
+            #
+            # How this may happen? The only time it has ever happened to us we
+            # were computing the weights of a set of stars with information in
+            # only two images. With that few points in the light curve of each
+            # star we may have, if only by chance, two differential magnitudes
+            # almost identical and therefore a standard deviation which would
+            # converge to zero.
+
+            if not all(curves_stdevs):
+                break
+
+            # The Weights object returned by Weights.inversely_proportional()
+            # stores the standard deviations in the 'values' attribute.
+            kwargs = dict(dtype = self.dtype)
+            weights.append(Weights.inversely_proportional(curves_stdevs, **kwargs))
+            if weights[-2].absolute_percent_change(weights[-1], minimum = minimum) < pct:
+                break
+
+        return weights[-1]
+
+    def _initial_weights(self, mags, initial = None, observed = None):
+        """ The Weights from which Broeg's algorithm starts to iterate.
+
+        These are the flux-proportional weights of the stars (see the method
+        StarSet.flux_proportional_weights), unless 'initial' is given: an array
+        with the initial weight of each star (row of 'mags'), such as those to
+        which the algorithm converged for a different but similar set of
+        stars. NaN values are allowed, and mean that the initial weight of the
+        star is unknown, so it keeps its flux-proportional weight. The known
+        weights are rescaled so that they add up to the same value as the
+        flux-proportional weights of the same stars, and then all the weights
+        are normalized. The closer these initial weights are to the solution,
+        the fewer iterations are needed to converge to it. 'observed' is passed
+        down to StarSet._flux_proportional_weights.
+
+        """
+
+        weights = self._flux_proportional_weights(mags, self.dtype, observed)
+        if initial is None:
+            return weights
+
+        initial = numpy.asarray(initial, dtype = self.dtype)
+        known = numpy.isfinite(initial) & (initial > 0)
+        if not numpy.any(known):
+            return weights
+
+        coefficients = numpy.array(weights)
+        scale = coefficients[known].sum() / initial[known].sum()
+        coefficients[known] = initial[known] * scale
+        return Weights(coefficients, dtype = self.dtype).normalize()
+
+    def _aligned_weights(self, initial, indexes = None):
+        """ Return an array with the weights in 'initial' for some stars.
+
+        'initial' maps star IDs to weights. Return an array with the weight of
+        each star in the set (or, if given, only of those at 'indexes'), NaN
+        for those not in 'initial'. None is returned if 'initial' is None.
+
+        """
+
+        if initial is None:
+            return None
+        if indexes is None:
+            indexes = xrange(len(self))
+        ids = (self._star_ids[index] for index in indexes)
+        return numpy.array([initial.get(id_, numpy.nan) for id_ in ids], dtype = self.dtype)
+
+    def worst(self, fraction, pct = 0.01, max_iters = None, minimum = None):
+        """ Return the indexes of the less constant stars.
+
+        The method returns the indexes of the 'fraction' less constant (that
+        is, the most variable) stars in the set, and consequently the less
+        ideal stars to be used as comparison when a light curve is computed.
+        This is done by calculating the Broeg weights (StarSet.broeg_weights)
+        of the stars in the set and identifying those with the lowest values;
+        since these weights are inversely proportional to the standard
+        deviation of the light curves, this effectively finds those stars
+        with the highest variability when their differential magnitudes are
+        calculated with respect to the others.
+
+        The order of the returned indexes is not casual: they are sorted by
+        increasing variability, that is, by the unconstantness of the stars.
+        This means that the i-th index corresponds to a star whose variability
+        is higher than or equal to that of the star of the i+1-th index.
+
+        Fractional numbers of indexes to be returned are rounded to the nearest
+        integer, although at least one star is always returned, independently
+        of the value of the 'fraction' argument. The ValueError exception is
+        raised, however, if it is not in the range (0, 1], as it makes no sense
+        to ask for either zero or more stars than there are in the set.
+
+        The three keyword parameters are not used by this method itself, but
+        just passed down to StarSet.broeg_weights. See the documentation of
+        that method for details.
+
+        """
+
+        if not 0 < fraction <= 1:
+            raise ValueError("'fraction' must be in the range (0,1]")
+
+        if len(self) < 3:
+            raise ValueError("at least three stars are needed")
+
+        # The number of stars with the lowest weights (and therefore the
+        # highest standard deviation in their light curves) to be returned
+        nstars = int(round(fraction * len(self)))
+        if not nstars:
+            nstars = 1
+
+        # Find the indexes of the 'nstars' coefficients of the Broeg weights
+        # with the lowest values. These will correspond to the stars with the
+        # maximum standard deviation, which we consider to be the worst. Code
+        # courtesy of user 'aix' at: http://stackoverflow.com/q/6910672
+        kwargs = dict(pct = pct, max_iters = max_iters, minimum = minimum)
+        bweights = self.broeg_weights(**kwargs)
+        return list(bweights.argsort()[:nstars])
+
+    def best(self, n, fraction = 0.1, pct = 0.01, max_iters = None,
+             minimum = None, initial = None):
+        """ Find the most constant stars in the set.
+
+        The method returns a StarSet with the 'n' most constant (that is, the
+        less variable) stars in the set, and therefore the optimal to be used
+        as comparison when a light curve is computed. In order to achieve this,
+        the method iterates by identifying the 'fraction' less constant stars
+        (StarSet.worst), discarding them and recomputing the light curves of
+        the remaining stars. The process continues until there are only 'n'
+        stars left, which are returned. The original StarSet is not modified.
+
+        Ideally, stars would be discarded one by one, but this is terribly
+        CPU-expensive for medium and large data sets, so in practice we are
+        required to discard several stars at each step. The default fraction
+        value is 0.1, which means that at each iteration 10% of the stars in
+        the set, those with a highest standard deviation, are discarded.
+
+        The ValueError exception is raised if the StarSet has fewer than three
+        stars, as that is the lowest number which which their variability can
+        be determined reliably. The same exception is raised if less than one
+        star or more than the size of the set are requested, or if the value of
+        the 'fraction' argument is not in the range (0, 1], as it makes no
+        sense to, at each iteration, discard either zero or more stars than
+        there are in the set.
+
+        The last four keyword parameters are not used by this method itself,
+        but just passed down to StarSet.broeg_weights. See the documentation
+        of that method for details. If 'initial' is given (even if it is an
+        empty dictionary), after the first step Broeg's algorithm is started
+        from the weights computed in the previous one.
+
+        """
+
+        if not 0 < fraction <= 1:
+            raise ValueError("'fraction' must be in the range (0,1]")
+
+        if len(self) < 3:
+            raise ValueError("at least three stars are needed")
+
+        if not 1 <= n <= len(self):
+            msg = ("must ask for at least one star, at most for as many "
+                   "as there are in the set")
+            raise ValueError(msg)
+
+        # Instead of copying the StarSet and deleting the worst stars from it,
+        # we work on the indexes of the stars left, computing the Broeg weights
+        # of the corresponding rows of the magnitudes array (which is what the
+        # StarSet.worst method does). Only the StarSet with the 'n' stars that
+        # remain at the end is created.
+        mags = self._phot_info[:, 0, :]
+        indexes = numpy.arange(len(self))
+
+        # If initial weights are given, each step of Broeg's algorithm starts
+        # from the weights to which the previous step converged, as the stars
+        # are the same except for those that were discarded.
+        warm = self._aligned_weights(initial)
+
+        def worst(fraction, **kwargs):
+            """ StarSet.worst, for the stars at 'indexes' """
+            nworst = max(int(round(fraction * len(indexes))), 1)
+            if self._observed is not None:
+                kwargs['observed'] = self._observed[indexes]
+            bweights = self._broeg_weights(mags[indexes], initial = warm, **kwargs)
+            return bweights, bweights.argsort()[:nworst]
+
+        # We do not discard stars here until only 'n' stars are left, as at
+        # least three stars are needed in order to determine their variability
+        # reliably. This means that, once we are left with fewer than tree
+        # stars (that is, two), we cannot iterate any further. The solution,
+        # thus, is to discard stars until 'n' or three stars are left, whatever
+        # happens first. After that, if we stopped at three but 'n' is smaller,
+        # we can discard the last batch of stars until only 'n' are left.
+
+        kwargs = dict(pct = pct, max_iters = max_iters, minimum = minimum)
+        while len(indexes) > max(n, 3):
+
+            bweights, worst_indexes = worst(fraction, **kwargs)
+
+            # The stars whose indexes have been returned by worst() cannot be
+            # blindly deleted, as the difference between the number of them
+            # and that of stars left may be higher than the number of stars
+            # that have to be deleted in order to get 'n' stars left. For
+            # example, assume there are 100 stars and we want the best 30,
+            # with a fraction of 0.5. 50 stars would be deleted in the first
+            # loop, while 25 more would be removed in the second. There would
+            # then be 100 - 50 - 25 = 25 stars left, when we wanted 30!
+
+            worst_indexes = worst_indexes[:(len(indexes) - max(n, 3))]
+            indexes = numpy.delete(indexes, worst_indexes)
+            if warm is not None:
+                warm = numpy.delete(numpy.asarray(bweights), worst_indexes)
+
+        # If there are only three stars left but there are still stars to
+        # discard we must identify them all at once, independently of the value
+        # of 'fraction'. The reason for this is that a minimum of three stars
+        # in needed to realibly determine their variability.
+
+        assert len(indexes) >= n
+        if len(indexes) != n:
+            worst_indexes = worst(1.0, pct = pct, max_iters = max_iters)[1]
+            indexes = numpy.delete(indexes, worst_indexes[:(len(indexes) - n)])
+
+        assert len(indexes) == n
+        return self._subset(indexes)
+
+    def _subset(self, indexes):
+        """ Return a new StarSet with the stars at these indexes.
+
+        The new StarSet shares the Unix times with this one, and its
+        photometric information is taken directly from the internal array,
+        without going through StarSet._add as the stars are already known
+        to have records for the same images.
+
+        """
+
+        set_ = StarSet.__new__(StarSet)
+        set_.dtype = self.dtype
+        set_.iterations = 0
+        set_.pfilter = self.pfilter
+        set_._star_ids = [self._star_ids[index] for index in indexes]
+        set_._phot_info = self._phot_info[indexes]
+        set_._unix_times = self._unix_times
+        set_._time_axis = self._time_axis
+        set_._observed = None
+        if self._observed is not None:
+            set_._observed = self._observed[indexes]
+        return set_
+
+class Neighbors(object):
+    """ Find the stars closest to each other in position and magnitude.
+
+    The stars are indexed in a k-d tree over their (x, y, magnitude) space,
+    where magnitudes are multiplied by a scale factor (the number of pixels
+    that are considered to be equivalent to a difference of one magnitude),
+    so that the comparison stars of each star can be chosen among the nearest
+    ones, in the same region of the detector and with a similar brightness.
+
+    """
+
+    def __init__(self, star_ids, x, y, mags, mag_scale):
+        """ Build the k-d tree of the stars with these coordinates.
+
+        'star_ids', 'x', 'y' and 'mags' are sequences with the ID of each star,
+        its x- and y- coordinates and magnitude, while 'mag_scale' is the value
+        by which magnitudes are multiplied in the k-d tree.
+
+        """
+
+        self.mag_scale = mag_scale
+        self._indexes = dict((id_, index) for index, id_ in enumerate(star_ids))
+        points = numpy.column_stack((x, y, numpy.asarray(mags) * mag_scale))
+        self._tree = scipy.spatial.cKDTree(points)
+
+    @classmethod
+    def from_db(cls, db, all_stars, mag_scale):
+        """ Build the k-d tree of the stars of a LEMONdB.
+
+        'all_stars' is a sequence with the DBStar of each star in the LEMONdB
+        in a photometric filter, in the same order as LEMONdB.star_ids. The
+        coordinates of the stars are read from the database, and their
+        magnitudes are the median of their instrumental magnitudes or, for
+        the stars with no records, those in the LEMONdB.
+
+        """
+
+        star_ids = db.star_ids
+        stars_info = [db.get_star(star_id) for star_id in star_ids]
+        x, y = zip(*stars_info)[:2]
+        mags = [numpy.median(star._magnitudes) if len(star) else info[-1]
+                for star, info in itertools.izip(all_stars, stars_info)]
+        return cls(star_ids, x, y, mags, mag_scale)
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def nearest(self, star_id, k):
+        """ Return the indexes of the k stars nearest to that with this ID.
+
+        The indexes, sorted by increasing distance, refer to the position of
+        the stars in the sequences given at instantiation time. The star itself
+        is included (as the first one, unless another is at distance zero).
+
+        """
+
+        k = min(k, len(self))
+        point = self._tree.data[self._indexes[star_id]]
+        return numpy.atleast_1d(self._tree.query(point, k = k)[1])
+
+    def complete_for(self, star, all_stars, masks, k, coverage = 1):
+        """ Return the k nearest stars for which a DBStar is complete.
+
+        Among the DBStars in 'all_stars', in the same order as the stars were
+        given at instantiation time, find the k nearest ones for which 'star'
+        is complete, and return them trimmed, sorted by increasing distance
+        (see DBStar.complete_for, to which the rows of 'masks', the bitmasks
+        of 'all_stars', are passed down). As not all the stars are complete,
+        more and more neighbors are considered, doubling their number each
+        time, until k of them are found or there are no stars left. If
+        'coverage' is lower than one, the stars are those returned, untrimmed,
+        by DBStar.covered_for, which may lack some of the images of 'star'.
+
+        """
+
+        nneighbors = k + 1
+        while True:
+            nearest = self.nearest(star.id, nneighbors)
+            # Leave out the star itself, which DBStar.complete_for recognizes
+            # only if it is the same object (not if 'all_stars' is a store of
+            # photometry, which builds a new DBStar each time; see --max-memory)
+            indexes = nearest[nearest != self._indexes[star.id]]
+            candidates = [all_stars[index] for index in indexes]
+            if coverage < 1:
+                complete = star.covered_for(candidates, coverage, masks = masks[indexes])
+            else:
+                complete = star.complete_for(candidates, masks = masks[indexes])
+            if len(complete) >= k or len(nearest) == len(self):
+                return complete[:k]
+            nneighbors *= 2
+
+def select_comparison_stars(star, all_stars, masks, options, neighbors = None,
+                            initial = None):
+    """ Find the comparison stars with which to compute a light curve.
+
+    Identify, among the stars for which 'star' is complete (DBStar.complete_for,
+    passing down 'masks'), the 'options.ncstars' most constant ones, and then
+    compute their Broeg weights. If options.coverage is lower than one, the
+    candidates are instead the stars observed in at least that fraction of
+    the images of 'star' (DBStar.covered_for), in a masked StarSet (see the
+    method StarSet.masked). If 'neighbors', a Neighbors object, is given,
+    the candidates are only the 'options.nearest' complete stars closest to
+    'star' in position and magnitude. 'initial', a dictionary mapping star IDs
+    to weights, is passed down to StarSet.best and StarSet.broeg_weights, so
+    that Broeg's algorithm starts from these weights. Return a three-element
+    tuple with the StarSet of comparison stars, their Weights and the number
+    of iterations of Broeg's algorithm that were needed to find them; or None
+    if the minimum number of comparison stars (options.min_cstars) is not met.
+
+    """
+
+    if neighbors is not None:
+        args = star, all_stars, masks, options.nearest
+        complete_for = neighbors.complete_for(*args, coverage = options.coverage)
+    elif options.coverage < 1:
+        complete_for = star.covered_for(all_stars, options.coverage, masks = masks)
+    else:
+        complete_for = star.complete_for(all_stars, masks = masks)
+    # If 'all_stars' is a database.PhotometryStore, which builds a new DBStar
+    # each time that a star is read, 'star' is among its own complete stars
+    complete_for = [cstar for cstar in complete_for if cstar.id != star.id]
+    logging.debug("Star %d: %d complete stars, enforced minimum = %d" %
+                 (star.id, len(complete_for), options.min_cstars))
+
+    ncstars = min(len(complete_for), options.ncstars)
+    if ncstars < options.min_cstars:
+        logging.debug("Star %d: ignored (minimum of %d comparison stars "
+                      "not met)" % (star.id, options.min_cstars))
+        return None
+
+    logging.debug("Star %d: will use %d complete stars (out of %d) as "
+                  "comparison)" % (star.id, ncstars, len(complete_for)))
+
+    logging.debug("Star %d: fraction of worst stars to discard = %.4f" %
+                 (star.id, options.worst_fraction))
+    logging.debug("Star %d: weights percentage change threshold = %.4f" %
+                 (star.id, options.pct))
+    logging.debug("Star %d: minimum Weights coefficients = %.4f" %
+                 (star.id, options.wminimum))
+    logging.debug("Star %d: maximum Broeg iterations: %.4f" %
+                 (star.id, options.max_iters))
+
+    if options.coverage < 1:
+        complete_stars = StarSet.masked(star, complete_for, dtype = star.dtype)
+    else:
+        complete_stars = StarSet(complete_for, dtype = star.dtype)
+    comparison_stars = \
+        complete_stars.best(ncstars, fraction = options.worst_fraction,
+                            pct = options.pct, minimum = options.wminimum,
+                            max_iters = options.max_iters, initial = initial)
+
+    logging.debug("Star %d: identified the %d best stars (out of %d)" %
+                 (star.id, len(comparison_stars), len(complete_stars)))
+    logging.debug("Star %d: best stars IDs: %s" %
+                 (star.id, comparison_stars.star_ids))
+
+    cweights = \
+        comparison_stars.broeg_weights(pct = options.pct,
+                                       minimum = options.wminimum,
+                                       max_iters = options.max_iters,
+                                       initial = initial)
+
+    iterations = complete_stars.iterations + comparison_stars.iterations
+    logging.debug("Star %d: Broeg weights: %s" % (star.id, str(cweights)))
+    logging.debug("Star %d: %d iterations of Broeg's algorithm" %
+                  (star.id, iterations))
+    return comparison_stars, cweights, iterations
+
+def compute_light_curve(db, star_id, pfilter, options = None, all_stars = None,
+                        store = True):
+    """ Compute the light curve of a star on demand, and cache it.
+
+    Identify the comparison stars of the star with ID 'star_id' in the
+    'pfilter' photometric filter, straight from the photometry in 'db', a
+    LEMONdB, and compute its light curve, exactly as diffphot would do for it
+    (select_comparison_stars). 'options' are the values of the command-line
+    options of diffphot, as returned by diffphot.parser.parse_args, or, if not
+    given, their default values (DEFAULT_OPTIONS). The light curve is cached
+    in the database: it is stored, and the star recorded as processed
+    (LEMONdB.add_processed_stars), so the curve is returned directly if it
+    had already been computed, and None, without trying again, if it could
+    not. Return a LightCurve object, or None if the light curve could not be
+    computed (e.g., because the minimum number of images or comparison stars
+    was not met).
+
+    Loading the photometry of all the stars, which are the candidates to
+    comparison stars, is the most expensive part. 'all_stars', a sequence with
+    the DBStar of each star in this filter, in the same order as the IDs in
+    LEMONdB.star_ids, may be given so that it does not have to be done for
+    every star. If 'store' is False, the light curve is only returned, and
+    nothing is written to the database (e.g., because it is read-only).
+
+    """
+
+    if options is None:
+        options = optparse.Values(DEFAULT_OPTIONS)
+
+    if not db._has_star(star_id):
+        msg = "star with ID = %d not in database" % star_id
+        raise KeyError(msg)
+
+    curve = db.get_light_curve(star_id, pfilter)
+    if curve is not None or star_id in db.get_processed_stars(pfilter):
+        return curve
+
+    if all_stars is None:
+        all_stars = db.get_photometry_matrix(pfilter).dbstars()
+    star = all_stars[db._star_index(star_id)]
+
+    logging.debug("Star %d: computing light curve on demand" % star_id)
+    if len(star) < options.min_images:
+        logging.debug("Star %d: ignored (minimum of %d images not met)" %
+                      (star.id, options.min_images))
+        selection = None
+    else:
+        masks = database.DBStar.observation_masks(all_stars)
+        if options.nearest:
+            neighbors = Neighbors.from_db(db, all_stars, options.nearest_mag_scale)
+        else:
+            neighbors = None
+        selection = select_comparison_stars(star, all_stars, masks, options,
+                                            neighbors = neighbors)
+
+    if selection is not None:
+        comparison_stars, cweights = selection[:2]
+        curve = comparison_stars.light_curve(cweights, star)
+
+    if store:
+        if curve is not None:
+            db.add_light_curve(star_id, curve)
+        db.add_processed_stars([star_id], pfilter)
+        db.commit()
+    return curve
@@ -378,7 +378,13 @@ def split_by_diff(iterable, delta = 3):
 
 def memoize(f):
     """ Minimalistic memoization decorator (*args / **kwargs)
-    Based on: http://code.activestate.com/recipes/577219/ """
+    Based on: http://code.activestate.com/recipes/577219/
+
+    The value cached for some arguments can be discarded with the forget
+    attribute of the decorated function, called with the same arguments
+    (including 'self', for methods), so that it is computed again.
+
+    """
 
     cache = {}
     @functools.wraps(f)
@@ -387,6 +393,11 @@ def memoize(f):
         if (args, fkwargs) not in cache:
             cache[args, fkwargs] = f(*args, **kwargs)
         return cache[args, fkwargs]
+
+    def forget(*args, **kwargs):
+        cache.pop((args, frozenset(kwargs.iteritems())), None)
+
+    memf.forget = forget
     return memf
 
 def utctime(seconds = None, suffix = True):
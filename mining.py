@@ -34,10 +34,12 @@ import datetime
 import itertools
 import numpy
 import operator
+import os
 import scipy.stats
 
 # LEMON modules
 import database
+import lightcurves
 import methods
 
 class NoStarsSelectedError(ValueError):
@@ -51,22 +53,77 @@ class LEMONdBMiner(database.LEMONdB):
     Databases accessed through this class are expected to be read-only, and
     thus methods expensive (whether in I/O or CPU) in the parent class are
     memoized. Making changes to the LEMONdB would be a very, very bad idea,
-    as you might end up with outdated data.
+    as you might end up with outdated data. The only exception are the light
+    curves computed on demand (see the method lazy_light_curve), which are
+    stored in the database if it can be written, and otherwise kept in
+    memory. Either way, they are from then on returned by get_light_curve.
 
     """
 
+    def __init__(self, *args, **kwargs):
+        super(LEMONdBMiner, self).__init__(*args, **kwargs)
+        # Map each (star ID, photometric filter) to the light curve computed
+        # on demand by lazy_light_curve, or None if it could not be computed
+        self._lazy_curves = {}
+
     @methods.memoize
     def get_star(self, *args):
         return super(LEMONdBMiner, self).get_star(*args)
 
+    def get_light_curve(self, star_id, pfilter):
+        """ Return the light curve of a star, stored or computed on demand """
+
+        try:
+            return self._lazy_curves[(star_id, pfilter)]
+        except KeyError:
+            return self._stored_light_curve(star_id, pfilter)
+
     @methods.memoize
-    def get_light_curve(self, *args):
+    def _stored_light_curve(self, *args):
         return super(LEMONdBMiner, self).get_light_curve(*args)
 
     @methods.memoize
     def get_period(self, *args):
         return super(LEMONdBMiner, self).get_period(*args)
 
+    @methods.memoize
+    def _all_stars(self, pfilter):
+        """ Return the DBStars of all the stars in a photometric filter """
+        return self.get_photometry_matrix(pfilter).dbstars()
+
+    def lazy_light_curve(self, star_id, pfilter):
+        """ Return the light curve of a star, computing it if not stored.
+
+        Return the light curve of the star in the photometric filter, as
+        LEMONdB.get_light_curve does, but, if there is none, compute it on
+        demand with the default options of diffphot (see the function
+        lightcurves.compute_light_curve). The curve is cached in the database,
+        unless it is not writable (or it was opened with the 'read-mostly'
+        profile), so that it does not have to be computed again, not even in
+        later sessions; otherwise, it is cached in memory. Either way, it is
+        from then on also returned by get_light_curve. None is returned if the
+        light curve could not be computed. The photometry of all the stars,
+        needed to find the comparison stars, is loaded the first time that a
+        curve is computed in each filter, and then kept in memory.
+
+        """
+
+        key = star_id, pfilter
+        curve = self.get_light_curve(star_id, pfilter)
+        if curve is None and key not in self._lazy_curves:
+            all_stars = self._all_stars(pfilter)
+            store = (os.access(self.path, os.W_OK) and
+                     self.profile != 'read-mostly')
+            curve = lightcurves.compute_light_curve(self, star_id, pfilter,
+                                                    all_stars = all_stars,
+                                                    store = store)
+            if store and curve is not None:
+                # Stored: forget the None memoized by get_light_curve
+                LEMONdBMiner._stored_light_curve.forget(self, star_id, pfilter)
+            else:
+                self._lazy_curves[key] = curve
+        return curve
+
     @staticmethod
     def _ascii_table(headers, table_rows, sort_index = 1, descending = True,
                     ndecimals = 8, dates_columns = None):
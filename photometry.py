@@ -1137,7 +1137,8 @@ def main(arguments = None):
     print msg % style.prefix ,
     sys.stdout.flush()
 
-    output_db = database.LEMONdB(output_db_path)
+    # The 'bulk-write' profile while the photometry is stored, until the end
+    output_db = database.LEMONdB(output_db_path, profile = 'bulk-write')
 
     # The fact that the QPhot object returned by qphot.run() preserves the
     # order of the astronomical objects proves to be useful again: it allows us
@@ -1416,6 +1417,12 @@ def main(arguments = None):
         print msg % style.prefix
         sys.stdout.flush()
 
+        # Whether each star has proper motions, looked up only once instead of
+        # for each measurement, as the proper-motion corrected coordinates are
+        # stored only for those stars that have them.
+        has_pm = dict((star_id, any(output_db.get_star(star_id)[5:7]))
+                      for star_id in output_db.star_ids)
+
         methods.show_progress(0)
         qphot_results = (queue.get() for x in xrange(queue.qsize()))
         for index, args in enumerate(qphot_results):
@@ -1425,7 +1432,12 @@ def main(arguments = None):
             output_db.add_image(db_image)
             logging.debug("Image %s successfully stored" % db_image.path)
 
-            # Now store each photometric measurement
+            # The measurements of the image are accumulated here, and then
+            # stored all at once (LEMONdB.add_image_photometry), as the
+            # records of a single image are inserted much faster in bulk.
+            phot_rows = []
+            pm_rows = []
+
             for object_id, object_phot in enumerate(img_qphot):
                 # INDEF photometric measurements have a magnitude of None, and
                 # those with at least one saturated pixel in the aperture have
@@ -1465,21 +1477,7 @@ def main(arguments = None):
                     args = db_image.path, object_id, object_snr
                     logging.debug(msg % args)
 
-                    msg = "%s: storing measurement for object %d in database"
-                    args = db_image.path, object_id
-                    logging.debug(msg % args)
-
-                    args = (object_id,
-                            db_image.unix_time,
-                            db_image.pfilter,
-                            object_phot.mag,
-                            object_snr)
-
-                    output_db.add_photometry(*args)
-
-                    msg = "%s: measurement for object %d successfully stored"
-                    args = db_image.path, object_id
-                    logging.debug(msg % args)
+                    phot_rows.append((object_id, object_phot.mag, object_snr))
 
                     # Store the pixel (x and y) coordinates where photometry
                     # has been done. Useful mostly, if not exclusively, for
@@ -1487,42 +1485,34 @@ def main(arguments = None):
                     # the measurement was taken at the proper-motion corrected
                     # coordinates.
 
-                    pm_ra, pm_dec = output_db.get_star(object_id)[5:7]
-
-                    if not pm_ra and not pm_dec:
-
+                    if not has_pm[object_id]:
                         msg = "%s: object %d does not have proper motion"
                         args = db_image.path, object_id
                         logging.debug(msg % args)
 
                     else:
-
-                        assert pm_ra  is not None
-                        assert pm_dec is not None
-
-                        msg = "%s: object %d pm_ra = %f (x = %f)"
-                        args = db_image.path, object_id, pm_ra, object_phot.x
-                        logging.debug(msg % args)
-
-                        msg = "%s: object %d pm_dec = %f (y = %f)"
-                        args = db_image.path, object_id, pm_dec, object_phot.y
-                        logging.debug(msg % args)
-
-                        msg = "%s: storing proper-motion corrections for object %d"
-                        args = db_image.path, object_id
+                        msg = "%s: object %d proper-motion corrected " \
+                              "coordinates: x = %f, y = %f"
+                        args = (db_image.path, object_id,
+                                object_phot.x, object_phot.y)
                         logging.debug(msg % args)
+                        pm_rows.append((object_id, object_phot.x, object_phot.y))
 
-                        args = (object_id,
-                                db_image.unix_time,
-                                db_image.pfilter,
-                                object_phot.x,
-                                object_phot.y)
+            msg = "%s: storing %d measurements (%d proper-motion corrections)"
+            args = db_image.path, len(phot_rows), len(pm_rows)
+            logging.debug(msg % args)
 
-                        output_db.add_pm_correction(*args)
+            if phot_rows:
+                object_ids, mags, snrs = zip(*phot_rows)
+                output_db.add_image_photometry(object_ids, db_image.unix_time,
+                                               db_image.pfilter, mags, snrs)
+            if pm_rows:
+                object_ids, xs, ys = zip(*pm_rows)
+                output_db.add_pm_corrections(object_ids, db_image.unix_time,
+                                             db_image.pfilter, xs, ys)
 
-                        msg = "%s: proper-motion correction for object %d sucessfully stored"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
+            msg = "%s: measurements successfully stored"
+            logging.debug(msg % db_image.path)
 
             methods.show_progress(100 * (index + 1) / len(images))
             if logging_level < logging.WARNING:
@@ -1566,6 +1556,7 @@ def main(arguments = None):
     md5.update(str(output_db.hostname))
     output_db.id = md5.hexdigest()
     output_db.commit()
+    output_db.set_profile('default') # back to the rollback journal
 
     methods.owner_writable(output_db_path, False) # chmod u-w
     print "%sYou're done ^_^" % style.prefix
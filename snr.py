@@ -44,9 +44,17 @@ def snr_to_error(snr):
     base-10 logarithm of zero or a negative value cannot be calculated. This,
     ValueError is raised if the signal-to-noise ratio is not above one.
 
+    'snr' may also be a NumPy array, in which case the conversion is done
+    element-wise and two arrays, of the same shape, are returned. ValueError
+    is then raised if any of the signal-to-noise ratios is not above one.
+
     """
 
-    if not numpy.any(snr > 1):
+    snr = numpy.asarray(snr)
+    # Not 'snr <= 1', which is False for NaN, so NaN would go through
+    with numpy.errstate(invalid = 'ignore'):
+        invalid = numpy.any(~(snr > 1))
+    if invalid:
         raise ValueError("SNR cannot be less than or equal to one")
 
     operators = (operator.add, operator.sub)
@@ -73,11 +81,23 @@ def error_to_snr(error):
     always negative, while a minus makes the returned value to be positive.
     Therefore, which sign the equation must use can be straight-forwardly
     determined: a plus if the error is negative and a minus if it turns out
-    to be negative.
+    to be negative. As with snr_to_error, 'error' may be a NumPy array.
+
+    An error of zero (that is, an infinite signal-to-noise ratio) is outside of
+    the domain of the formula, so ValueError is raised if 'error' is zero or
+    NaN, or if any of its elements is, in case of a NumPy array.
 
     """
 
-    return (1 if error < 0 else -1) / (math.pow(10, error / -2.5) - 1)
+    error = numpy.asarray(error)
+    # Not 'error == 0', which is False for NaN, so NaN would go through
+    with numpy.errstate(invalid = 'ignore'):
+        invalid = numpy.any(~(numpy.abs(error) > 0))
+    if invalid:
+        raise ValueError("error in magnitudes cannot be zero")
+
+    sign = numpy.where(error < 0, 1, -1)
+    return sign / (numpy.power(10, error / -2.5) - 1)
 
 def difference_error(*errors):
     """ Return the absolute error of the difference of a series of errors.
@@ -100,9 +120,12 @@ def difference_error(*errors):
     between two or more stars. However, it may be perfectly used for additions
     too, and of course also for a combination of additions and subtractions.
 
+    Each error may be a NumPy array, all of them of the same shape, in which
+    case the errors are combined element-wise and an array is returned.
+
     """
 
-    return math.sqrt(sum(e ** 2 for e in errors))
+    return numpy.sqrt(sum(numpy.square(e) for e in errors))
 
 def difference_snr(*snrs):
     """ Return the SNR of the difference of a series of SNRs.
@@ -125,7 +148,7 @@ def difference_snr(*snrs):
     # converting back to SNR.
 
     errors = [snr_to_error(s)[1] for s in snrs]
-    assert all(e >= 0 for e in errors)
+    assert all(numpy.all(e >= 0) for e in errors)
     error = difference_error(*errors)
     return error_to_snr(error)
 
@@ -152,6 +175,13 @@ def mean_error(errors, weights = None):
     Thanks so much to the people at Math Stack Exchange for their help:
     http://math.stackexchange.com/q/123276/
 
+    'errors' may also be a two-dimensional NumPy array, where each row holds
+    the errors of one of the values (e.g., a star) and each column those that
+    are averaged together (e.g., the stars observed in an image). The mean is
+    then computed along the first axis, and an array with the error of each
+    column returned: this allows us to compute the error of the artificial
+    comparison star in all the images at once.
+
     Keyword arguments:
     weights - the coefficients of the weighted mean. The i-th weight is
               interpreted to correspond to the i-th error received by the
@@ -160,15 +190,20 @@ def mean_error(errors, weights = None):
               [0.5, 0.5], [1.0, 1.0] and [2.6, 2.6], e.g., are equivalent.
     """
 
+    errors = numpy.asarray(errors)
     if weights is None:
         # All the values contribute equally (and weights sum up to one)
-        weights = [1 / len(errors)] * len(errors)
+        weights = numpy.repeat(1 / len(errors), len(errors))
     elif len(weights) != len(errors):
         raise ValueError("number of weights must equal that of errors")
     else:
         # Normalize the values so that they sum up to one
-        weights = [w / math.fsum(weights) for w in weights]
-    return math.sqrt(math.fsum(((w  ** 2) * (e ** 2) for e, w in zip(errors, weights))))
+        weights = numpy.asarray(weights)
+        weights = weights / numpy.sum(weights)
+
+    # One coefficient per row, broadcast along the rest of dimensions, if any
+    weights = weights.reshape((-1,) + (1,) * (errors.ndim - 1))
+    return numpy.sqrt(numpy.sum(weights ** 2 * errors ** 2, axis = 0))
 
 def mean_snr(snrs, weights = None):
     """ Return the SNR of the arithmetic mean of a series of SNSRs.
@@ -176,7 +211,9 @@ def mean_snr(snrs, weights = None):
     The method returns the signal-to-noise ratio of the arithmetic or weighted
     mean of a series of signal-to-noise ratios. This is internally done by
     converting the SNRs to errors in magnitudes, computing the absolute error
-    and converting the resulting value back to its equivalent SNR.
+    and converting the resulting value back to its equivalent SNR. As with
+    mean_error, 'snrs' may be a two-dimensional NumPy array, in which case
+    the mean is computed along the first axis.
 
     Keyword arguments:
     weights - the coefficients of the weighted mean. The i-th weight is
@@ -193,8 +230,10 @@ def mean_snr(snrs, weights = None):
     # the errors become positive, and as such they would be considered when
     # converting back to SNR.
 
-    errors = [snr_to_error(s)[1] for s in snrs]
-    assert all(e >= 0 for e in errors)
+    if not isinstance(snrs, numpy.ndarray):
+        snrs = list(snrs)  # e.g., a generator
+    errors = snr_to_error(numpy.asarray(snrs))[1]
+    assert numpy.all(errors >= 0)
     error = mean_error(errors, weights = weights)
     return error_to_snr(error)
 
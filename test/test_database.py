@@ -23,17 +23,21 @@ from __future__ import division
 import collections
 import copy
 import itertools
+import math
 import numpy
 import operator
 import os
+import pickle
 import random
 import re
 import sqlite3
 import string
 import tempfile
+import threading
 import time
 
 from test import unittest
+import database
 import passband
 from database import \
   (DBStar,
@@ -48,7 +52,7 @@ from database import \
    UnknownImageError,
    UnknownStarError)
 
-from diffphot import Weights
+from lightcurves import Weights
 from json_parse import CandidateAnnuli
 import test.test_fitsimage
 # https://stackoverflow.com/q/12603541/184363
@@ -181,6 +185,17 @@ class DBStarTest(unittest.TestCase):
                 unix_time_index = star._time_index(unix_time)
                 self.assertEqual(unix_time_index, times_indexes[unix_time])
 
+        # KeyError, also for a star without records
+        pfilter = passband.Passband.random()
+        empty = DBStar.make_star(1, pfilter, [])
+        for star in [DBStarTest.random(), empty]:
+            with self.assertRaises(KeyError):
+                star._time_index(different_runix_time(star._unix_times))
+        self.assertEqual(len(empty._time_indexes_of([])), 0)
+        other = DBStar.make_star(2, pfilter, [(13000, 15.6, 100)])
+        with self.assertRaises(KeyError):
+            empty._trim_to(other)
+
     def test_unix_times(self):
         for _ in xrange(NITERS):
             id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
@@ -284,10 +299,8 @@ class DBStarTest(unittest.TestCase):
                 if unix_time != subset.time(index):
                     break
 
-            # Update the Unix time (a key) in the 'time_indexes' dictionary
-            time_indexes = subset._time_indexes # shorter variable name
-            time_indexes[unix_time] = time_indexes.pop(subset.time(index))
-            subset._phot_info[0][index] = unix_time
+            # Update the Unix time in the array (there is no time axis)
+            subset._times[index] = unix_time
             assert subset.time(index) == unix_time
             self.assertFalse(subset.issubset(original))
 
@@ -381,6 +394,150 @@ class DBStarTest(unittest.TestCase):
             for cstar in complete:
                 self.assertTrue(original.issubset(cstar))
 
+    @classmethod
+    def random_with_time_axis(cls, time_axis, size):
+        """ Return 'size' random DBStars that share the same time axis.
+
+        Each DBStar is observed in a random subset (of at least one image) of
+        the Unix times in 'time_axis'. A two-element tuple is returned: a list
+        with the DBStars and another with their equivalent DBStars without a
+        time axis (i.e., with the same records but no bitmask).
+
+        """
+
+        stars, plain_stars = [], []
+        for _ in xrange(size):
+            id_ = random.randint(cls.MIN_ID, cls.MAX_ID)
+            nrecords = random.randint(1, len(time_axis))
+            unix_times = sorted(random.sample(time_axis, nrecords))
+            rows = [(t, random.uniform(cls.MIN_MAG, cls.MAX_MAG),
+                        random.uniform(cls.MIN_SNR, cls.MAX_SNR))
+                    for t in unix_times]
+            pfilter = passband.Passband('V')
+            stars.append(DBStar.make_star(id_, pfilter, rows, time_axis = time_axis))
+            plain_stars.append(DBStar.make_star(id_, pfilter, rows))
+        return stars, plain_stars
+
+    def test_time_axis(self):
+
+        for _ in xrange(NITERS // 10):
+            time_axis = numpy.array(sorted(runix_times(random.randint(1, 50))))
+            size = random.randint(MIN_NSTARS, MAX_NSTARS)
+            stars, plain_stars = self.random_with_time_axis(time_axis, size)
+            masks = DBStar.observation_masks(stars)
+            self.assertEqual(masks.shape[0], len(stars))
+
+            # The bitwise operations must give the same results that the
+            # comparison of the Unix times of DBStars without time axis.
+            for star, plain_star in zip(stars, plain_stars)[:5]:
+                for other, plain_other in zip(stars, plain_stars):
+                    self.assertEqual(star.issubset(other),
+                                     plain_star.issubset(plain_other))
+
+                complete = star.complete_for(stars)
+                plain_complete = plain_star.complete_for(plain_stars)
+                self.assertEqual(len(complete), len(plain_complete))
+                for cstar, plain_cstar in zip(complete, plain_complete):
+                    self.assertTrue(self.equal(cstar, plain_cstar))
+                    self.assertTrue(cstar._time_axis is time_axis)
+
+                # The precomputed bitmasks give, of course, the same result
+                complete = star.complete_for(stars, masks = masks)
+                self.assertEqual(len(complete), len(plain_complete))
+                for cstar, plain_cstar in zip(complete, plain_complete):
+                    self.assertTrue(self.equal(cstar, plain_cstar))
+
+        # The Unix times of the star must all be in the time axis
+        time_axis = numpy.array(sorted(runix_times(10)))
+        rows = [(different_runix_time(time_axis), 15.6, 100)]
+        with self.assertRaises(ValueError):
+            DBStar.make_star(1, passband.Passband('V'), rows, time_axis = time_axis)
+
+        # DBStars which do not share the same time axis
+        stars = self.random_with_time_axis(time_axis, 2)[0]
+        stars += self.random_with_time_axis(numpy.copy(time_axis), 1)[0]
+        with self.assertRaises(ValueError):
+            DBStar.observation_masks(stars)
+
+    def test_compact_representation(self):
+
+        self.assertEqual(database.axis_index_dtype(1), numpy.uint8)
+        self.assertEqual(database.axis_index_dtype(256), numpy.uint8)
+        self.assertEqual(database.axis_index_dtype(257), numpy.uint16)
+        self.assertEqual(database.axis_index_dtype(65537), numpy.uint32)
+
+        for _ in xrange(NITERS // 10):
+            time_axis = numpy.array(sorted(runix_times(random.randint(1, 300))))
+            stars, plain_stars = self.random_with_time_axis(time_axis, 5)
+            for dtype in database.PRECISIONS.itervalues():
+                for star, plain_star in zip(stars, plain_stars):
+                    rows = zip(*plain_star._phot_info)
+                    star = DBStar.make_star(star.id, star.pfilter, rows,
+                                            dtype = dtype, time_axis = time_axis)
+
+                    # Positions in the time axis, and magnitudes and SNRs in
+                    # the data type of the star; no Unix times or dictionary
+                    self.assertEqual(star._axis_indexes.dtype,
+                                     database.axis_index_dtype(len(time_axis)))
+                    self.assertEqual(star._values.dtype, dtype)
+                    self.assertTrue(star._times is None)
+                    self.assertFalse('_time_indexes' in vars(star))
+
+                    # The same records, through the same interface
+                    self.assertEqual(len(star), len(plain_star))
+                    self.assertTrue(numpy.all(star._unix_times == plain_star._unix_times))
+                    self.assertEqual(star._time_indexes, plain_star._time_indexes)
+                    phot_info = star._phot_info
+                    self.assertEqual(phot_info.dtype, database.phot_info_dtype(dtype))
+                    self.assertTrue(numpy.all(phot_info[0] == plain_star._unix_times))
+                    for index in xrange(len(star)):
+                        unix_time = plain_star.time(index)
+                        self.assertEqual(star.time(index), unix_time)
+                        self.assertEqual(star._time_index(unix_time), index)
+                        self.assertEqual(star.mag(index), dtype(plain_star.mag(index)))
+                        self.assertEqual(star.snr(index), dtype(plain_star.snr(index)))
+
+                    with self.assertRaises(KeyError):
+                        star._time_index(different_runix_time(time_axis))
+
+    def test_covered_for(self):
+
+        for _ in xrange(NITERS // 10):
+            time_axis = numpy.array(sorted(runix_times(random.randint(1, 50))))
+            size = random.randint(MIN_NSTARS, MAX_NSTARS)
+            stars = self.random_with_time_axis(time_axis, size)[0]
+            masks = DBStar.observation_masks(stars)
+            star = random.choice(stars)
+            coverage = 1.0 - random.random() # (0.0, 1.0]
+
+            # The stars that share at least this fraction of the Unix times
+            unix_times = set(star._unix_times)
+            expected = [other.id for other in stars if other is not star and
+                        len(unix_times & set(other._unix_times)) >=
+                        coverage * len(star)]
+
+            for kwargs in ({}, dict(masks = masks)):
+                covered = star.covered_for(stars, coverage, **kwargs)
+                self.assertEqual([other.id for other in covered], expected)
+                # The stars are not trimmed
+                for other in covered:
+                    self.assertTrue(other in stars)
+
+            # A coverage of one is equivalent to DBStar.complete_for
+            covered = star.covered_for(stars, 1.0, masks = masks)
+            complete = star.complete_for(stars, masks = masks)
+            self.assertEqual([other.id for other in covered],
+                             [other.id for other in complete])
+
+        for coverage in (0, -0.5, 1.5):
+            with self.assertRaises(ValueError):
+                star.covered_for(stars, coverage)
+
+        # DBStars which do not share the same time axis
+        others = self.random_with_time_axis(numpy.copy(time_axis), 2)[0]
+        with self.assertRaises(ValueError):
+            star.covered_for(others, 0.5)
+
     def test_make_star(self):
 
         id_ = 1
@@ -877,6 +1034,52 @@ class LightCurveTest(unittest.TestCase):
                 self.assertEqual(nmags,   tuple(p[1] for p in non_noisy_curve))
                 self.assertEqual(nsnrs,   tuple(p[2] for p in non_noisy_curve))
 
+    def test_extend_and_arrays(self):
+
+        for _ in xrange(NITERS):
+            curve1 = self.random()
+            curve2 = LightCurve(*self.random_data())
+            size = random.randint(MIN_NSTARS, MAX_NSTARS)
+            points = list(self.random_points(size))
+            # Some of the signal-to-noise ratios may be missing
+            points = [(t, m, None if random.random() < 0.1 else s)
+                      for t, m, s in points]
+
+            # Adding the points one by one, or all at once in one or more
+            # batches, results in the same light curve, in the same order
+            for point in points:
+                curve1.add(*point)
+            split = random.randint(0, size)
+            for batch in (points[:split], points[split:]):
+                curve2.extend(*zip(*batch) if batch else ([], [], []))
+
+            for curve in (curve1, curve2):
+                self.assertEqual(len(curve), size)
+                self.assertEqual(curve[:], points)
+                self.assertEqual(curve[-1], points[-1])
+                chronological = sorted(points, key = operator.itemgetter(0))
+                self.assertEqual(list(curve), chronological)
+
+                # The chronologically sorted, read-only arrays
+                unix_times, magnitudes, snrs = zip(*chronological)
+                self.assertEqual(curve.unix_times.tolist(), list(unix_times))
+                self.assertEqual(curve.magnitudes.tolist(), list(magnitudes))
+                expected = [numpy.nan if x is None else x for x in snrs]
+                self.assertTrue(numpy.array_equal(
+                    numpy.isnan(curve.snrs), numpy.isnan(expected)))
+                with self.assertRaises(ValueError):
+                    curve.magnitudes[0] = 0
+
+                # Only the points of the curve are pickled
+                copied = pickle.loads(pickle.dumps(curve))
+                self.assertEqual(list(copied), chronological)
+                self.assertEqual(len(copied._unix_times), size)
+
+        with self.assertRaises(IndexError):
+            curve[size]
+        with self.assertRaises(ValueError):
+            curve.extend([1, 2], [3], [4])
+
     @staticmethod
     def assertThatAreEqual(cls, first, second):
         """ Assert that two LightCurves are equal.
@@ -957,6 +1160,176 @@ class LEMONdBTest(unittest.TestCase):
             finally:
                 os.unlink(path)
 
+    def test_profiles(self):
+
+        path = self.random_path()
+        try:
+            db = LEMONdB(path)
+            self.assertEqual(db.profile, 'default')
+            pragmas = set()
+            for profile in database.PRAGMA_PROFILES.itervalues():
+                pragmas.update(pragma for pragma, _ in profile)
+            defaults = dict((pragma, db._get_pragma(pragma)) for pragma in pragmas)
+
+            db.set_profile('bulk-write')
+            self.assertEqual(db.profile, 'bulk-write')
+            self.assertEqual(db._get_pragma('journal_mode'), 'wal')
+            self.assertEqual(db._get_pragma('synchronous'), 2) # FULL
+            self.assertEqual(db._get_pragma('cache_size'), -262144)
+            star_info = self.random_star_info()
+            db.add_star(*star_info)
+            db.commit()
+            self.assertEqual(db.get_star(star_info[0]), tuple(star_info[1:]))
+
+            # Another connection, in read-mostly mode, sees the committed star
+            other = LEMONdB(path, profile = 'read-mostly')
+            self.assertEqual(other._get_pragma('query_only'), 1)
+            self.assertEqual(other.star_ids, [star_info[0]])
+            del other
+
+            # Switching profiles restores the pragmas set by the previous one
+            db.set_profile('read-mostly')
+            self.assertEqual(db._get_pragma('journal_mode'), 'delete')
+            self.assertEqual(db._get_pragma('temp_store'), 2) # MEMORY
+            self.assertEqual(db._get_pragma('query_only'), 1)
+            with self.assertRaises(sqlite3.OperationalError):
+                db.add_star(*self.random_star_info())
+            db.set_profile('default')
+            for pragma, value in defaults.iteritems():
+                self.assertEqual(db._get_pragma(pragma), value)
+            self.assertEqual(db._get_pragma('synchronous'), 2) # FULL
+            db.add_star(*self.random_star_info())
+
+            with self.assertRaises(ValueError):
+                db.set_profile('write-only')
+            with self.assertRaises(ValueError):
+                LEMONdB(path, profile = 'write-only')
+            self.assertEqual(db.profile, 'default')
+        finally:
+            os.unlink(path)
+
+    def test_connection_pool(self):
+
+        path = self.random_path()
+        try:
+            db = LEMONdB(path, profile = 'bulk-write')
+            star_info = self.random_star_info()
+            db.add_star(*star_info)
+            db.commit()
+
+            connections = database.ConnectionPool(path, dtype = numpy.float32)
+            self.assertEqual(len(connections), 0)
+            reader = connections.get()
+            self.assertIs(connections.get(), reader)
+            self.assertEqual(len(connections), 1)
+            self.assertEqual(reader.profile, 'read-mostly')
+            self.assertEqual(reader.dtype, numpy.float32)
+            self.assertEqual(reader.star_ids, [star_info[0]])
+
+            # Each thread gets its own connection
+            results = []
+            def read():
+                other = connections.get()
+                results.append(other is not reader)
+                results.append(other.star_ids)
+                del other
+                connections.close() # from the same thread that opened it
+            thread = threading.Thread(target = read)
+            thread.start()
+            thread.join()
+            self.assertEqual(results, [True, [star_info[0]]])
+            self.assertEqual(len(connections), 1)
+
+            # Only the committed data is seen, without blocking the writer
+            other_info = self.random_star_info()
+            db.add_star(*other_info)
+            self.assertEqual(connections.get().star_ids, [star_info[0]])
+
+            # Connections are not pickled, only the path and data type
+            copy_ = pickle.loads(pickle.dumps(connections))
+            self.assertEqual(copy_.path, path)
+            self.assertEqual(copy_.dtype, numpy.float32)
+            self.assertEqual(len(copy_), 0)
+            connections.close()
+            self.assertEqual(len(connections), 0)
+            self.assertIsNot(connections.get(), reader)
+            # The connection was closed, not only forgotten
+            with self.assertRaises(sqlite3.ProgrammingError):
+                reader.get_star(star_info[0])
+        finally:
+            os.unlink(path)
+
+    def test_lazy_schema(self):
+
+        def schema(db):
+            db._execute("SELECT name FROM sqlite_master")
+            return set(row[0] for row in db._rows)
+
+        path = self.random_path()
+        try:
+            # Opening a database does not create the LAZY_SCHEMA objects,
+            # so it can be read-only, as those of older versions of LEMON
+            db = LEMONdB(path)
+            lazy = set(LEMONdB.LAZY_SCHEMA)
+            self.assertFalse(lazy & schema(db))
+
+            star_ids = range(3)
+            for star_id in star_ids:
+                db.add_star(*LEMONdBTest.random_star_info(id_ = star_id))
+            pfilter = passband.Passband.random()
+            images = sorted(ImageTest.nrandom(3, pfilter = pfilter),
+                            key = operator.attrgetter('unix_time'))
+            for img in images:
+                db.add_image(img)
+                db.add_photometry(0, img.unix_time, pfilter, 15.2, 120)
+            db.commit()
+
+            # Readers work without them, also if they cannot write
+            unix_times = [img.unix_time for img in images]
+            reader = LEMONdB(path, profile = 'read-mostly')
+            self.assertEqual(list(reader.get_curveless_times(pfilter)), unix_times)
+            self.assertEqual(reader.get_light_curve(0, pfilter), None)
+            self.assertEqual(reader.get_processed_stars(pfilter), set())
+            self.assertEqual(reader.pfilters, [pfilter])
+            self.assertEqual(reader._star_pfilters(0), [pfilter])
+            self.assertEqual(len(reader.get_photometry(0, pfilter)), len(images))
+            matrix = reader.get_photometry_matrix(pfilter)
+            self.assertEqual(matrix.observed.sum(), len(images))
+            self.assertFalse(lazy & schema(reader))
+            del reader
+
+            # The index is created when the first light curve is stored,
+            # and forgotten if that is reverted, so that it is created again
+            curve = LightCurveTest.random(pfilter = pfilter, cstars = [1, 2])
+            curve = LightCurveTest.populate(curve, images)
+            mark = db._savepoint()
+            db.add_light_curve(0, curve)
+            self.assertIn('curve_by_image', schema(db))
+            db._rollback_to(mark)
+            db._release(mark)
+            self.assertNotIn('curve_by_image', schema(db))
+            db.add_light_curves([(0, curve)])
+            self.assertIn('curve_by_image', schema(db))
+            self.assertEqual(len(db.get_curveless_times(pfilter)), 0)
+            db.delete_light_curve(1, pfilter) # no curve, nor processed stars
+            self.assertEqual(db.get_processed_stars(pfilter), set([0]))
+            self.assertNotIn('processed_stars', schema(db))
+            db.add_processed_stars([1], pfilter)
+            self.assertIn('processed_stars', schema(db))
+            db.pack()
+            self.assertEqual(schema(db) & lazy, lazy)
+            db.commit()
+
+            reader = LEMONdB(path, profile = 'read-mostly')
+            self.assertEqual(list(reader.get_light_curve(0, pfilter)), list(curve))
+            self.assertEqual(len(reader.get_curveless_times(pfilter)), 0)
+            self.assertEqual(reader.get_processed_stars(pfilter), set([0, 1]))
+            self.assertEqual(reader.pfilters, [pfilter])
+            self.assertEqual(len(reader.get_photometry(0, pfilter)), len(images))
+            del reader
+        finally:
+            os.unlink(path)
+
     def test_add_and_get_candidate_pparams(self):
 
         for _ in xrange(NITERS):
@@ -1330,6 +1703,44 @@ class LEMONdBTest(unittest.TestCase):
             db.add_star(*star_info)
             self.assertEqual(sorted(stars_ids), db.star_ids)
 
+        # The IDs are cached, but the list can be modified by the caller
+        db.star_ids.append(self.MAX_ID + 1)
+        self.assertEqual(sorted(stars_ids), db.star_ids)
+        self.assertEqual(len(db), size)
+        self.assertFalse(db._has_star(self.MAX_ID + 1))
+
+        # The index of each star in the list of IDs
+        for index, id_ in enumerate(db.star_ids):
+            self.assertTrue(db._has_star(id_))
+            self.assertEqual(db._star_index(id_), index)
+        with self.assertRaises(KeyError):
+            db._star_index(self.MAX_ID + 1)
+
+        # Stars whose insertion is rolled back are forgotten
+        mark = db._savepoint()
+        db.add_star(*self.random_star_info(id_ = self.MAX_ID + 1))
+        self.assertTrue(db._has_star(self.MAX_ID + 1))
+        db._rollback_to(mark)
+        self.assertFalse(db._has_star(self.MAX_ID + 1))
+        self.assertEqual(sorted(stars_ids), db.star_ids)
+
+    def test_get_image_id(self):
+        db = LEMONdB(':memory:')
+        pfilter = passband.Passband.random()
+        images = list(ImageTest.nrandom(10, pfilter = pfilter, simult_prob = 0))
+        image_ids = {}
+        for img in images:
+            # The cached IDs of the filter must be updated with each image
+            with self.assertRaises(KeyError):
+                db._get_image_id(img.unix_time, pfilter)
+            db.add_image(img)
+            image_ids[img.unix_time] = db._get_image_id(img.unix_time, pfilter)
+            self.assertEqual(db._get_image_id(numpy.float64(img.unix_time), pfilter),
+                             image_ids[img.unix_time])
+        self.assertEqual(len(set(image_ids.values())), len(images))
+        for img in images:
+            self.assertEqual(db.get_image(img.unix_time, pfilter).path, img.path)
+
     @classmethod
     def random_stars(cls, size, unix_times):
         """ Return a generator which steps through 'size' random DBstars.
@@ -1570,6 +1981,14 @@ class LEMONdBTest(unittest.TestCase):
         self.assertEqual(star2_V.mag(0), 5.8)
         self.assertEqual(star2_V.snr(0), 550)
 
+        # The DBStars in the same filter share the time axis of the images
+        self.assertTrue(star1_B._time_axis is star2_B._time_axis)
+        self.assertTrue(star1_V._time_axis is star2_V._time_axis)
+        self.assertEqual(list(star1_B._time_axis),
+                         [img2.unix_time, img1.unix_time, img4.unix_time])
+        self.assertEqual(list(star1_V._time_axis), [img3.unix_time])
+        self.assertTrue(star2_B.issubset(star1_B))
+
         # LEMONdB.add_photometry raises UnknownStarError if 'star_id' does not
         # match the ID of any of the stars in the database
         star_info = self.random_star_info()
@@ -1627,6 +2046,190 @@ class LEMONdBTest(unittest.TestCase):
         empty_star = db.get_photometry(star_id, johnson_V)
         self.assertEqual(len(empty_star), 0)
 
+    def test_get_photometry_matrix(self):
+
+        for _ in xrange(NITERS // 10):
+            db = LEMONdB(':memory:', dtype = random.choice(database.PRECISIONS.values()))
+            star_ids = random.sample(xrange(self.MIN_ID, self.MAX_ID),
+                                     random.randint(0, 25))
+            for star_id in star_ids:
+                db.add_star(*self.random_star_info(id_ = star_id))
+
+            # Photometry in two filters: only that in the first one is returned
+            pfilter, other = random.sample(passband.Passband.all(), 2)
+            for pfilter_ in (pfilter, other):
+                images = list(ImageTest.nrandom(random.randint(1, 30),
+                                                pfilter = pfilter_))
+                for img in images:
+                    db.add_image(img)
+                for star_id in star_ids:
+                    for img in images:
+                        if random.random() < self.OBSERVED_PROB:
+                            magnitude = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                            snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                            db.add_photometry(star_id, img.unix_time, pfilter_,
+                                              magnitude, snr)
+
+            matrix = db.get_photometry_matrix(pfilter)
+            self.assertEqual(matrix.pfilter, pfilter)
+            self.assertEqual(matrix.star_ids, sorted(star_ids))
+            unix_times = db._get_time_axis(pfilter)
+            self.assertIs(matrix.unix_times, unix_times)
+            self.assertEqual(list(matrix.image_ids),
+                             [db._get_image_id(t, pfilter) for t in unix_times])
+            shape = (len(star_ids), len(unix_times))
+            for array in (matrix.magnitudes, matrix.snrs, matrix.observed):
+                self.assertEqual(array.shape, shape)
+            self.assertEqual(matrix.magnitudes.dtype, numpy.dtype(db.dtype))
+
+            stars = [db.get_photometry(star_id, pfilter) for star_id in db.star_ids]
+            for index, star in enumerate(stars):
+                observed = matrix.observed[index]
+                self.assertEqual(list(unix_times[observed]), list(star._unix_times))
+                numpy.testing.assert_array_equal(matrix.magnitudes[index, observed],
+                                                 star._magnitudes)
+                numpy.testing.assert_array_equal(matrix.snrs[index, observed],
+                                                 star._snrs)
+                self.assertTrue(numpy.all(numpy.isnan(matrix.magnitudes[index, ~observed])))
+
+            # The same DBStars, sharing the time axis, without more queries
+            for star, other_star in zip(stars, matrix.dbstars()):
+                self.assertEqual(other_star.id, star.id)
+                self.assertEqual(other_star.dtype, star.dtype)
+                self.assertEqual(other_star._values.dtype, star._values.dtype)
+                numpy.testing.assert_array_equal(other_star._values, star._values)
+                numpy.testing.assert_array_equal(other_star._axis_indexes,
+                                                 star._axis_indexes)
+                self.assertEqual(other_star._axis_indexes.dtype,
+                                 star._axis_indexes.dtype)
+                numpy.testing.assert_array_equal(other_star._mask, star._mask)
+                self.assertTrue(other_star._shares_time_axis(star))
+
+    def test_get_images_photometry(self):
+
+        for _ in xrange(NITERS // 10):
+            db = LEMONdB(':memory:')
+            star_ids = random.sample(xrange(self.MIN_ID, self.MAX_ID),
+                                     random.randint(0, 25))
+            for star_id in star_ids:
+                db.add_star(*self.random_star_info(id_ = star_id))
+
+            pfilter = passband.Passband.random()
+            images = list(ImageTest.nrandom(random.randint(1, 30),
+                                            pfilter = pfilter))
+            for img in images:
+                db.add_image(img)
+                for star_id in star_ids:
+                    if random.random() < self.OBSERVED_PROB:
+                        magnitude = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                        snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                        db.add_photometry(star_id, img.unix_time, pfilter,
+                                          magnitude, snr)
+
+            # Only the stars observed in some of the images, with their records
+            # in them, whether or not the photometry is packed
+            unix_times = random.sample([img.unix_time for img in images],
+                                       random.randint(0, len(images)))
+            for pack in (False, True):
+                if pack:
+                    db.pack()
+                stars = db.get_images_photometry(pfilter, unix_times)
+                expected = []
+                for star_id in db.star_ids:
+                    star = db.get_photometry(star_id, pfilter)
+                    rows = [row for row in zip(star._unix_times, star._magnitudes,
+                                               star._snrs) if row[0] in unix_times]
+                    if rows:
+                        expected.append((star_id, rows))
+
+                self.assertEqual([star.id for star in stars],
+                                 [x[0] for x in expected])
+                for star, (star_id, rows) in zip(stars, expected):
+                    self.assertEqual(list(zip(star._unix_times, star._magnitudes,
+                                              star._snrs)), rows)
+                    self.assertIs(star._time_axis, db._get_time_axis(pfilter))
+
+            with self.assertRaises(KeyError):
+                db.get_images_photometry(pfilter, [max(unix_times or [0]) + 1])
+
+    def test_add_image_photometry(self):
+
+        db = LEMONdB(':memory:')
+        star_ids = random.sample(xrange(self.MIN_ID, self.MAX_ID), 20)
+        for star_id in star_ids:
+            db.add_star(*self.random_star_info(id_ = star_id))
+        pfilter = passband.Passband.random()
+        img1, img2 = ImageTest.nrandom(2, pfilter = pfilter, simult_prob = 0)
+        db.add_image(img1)
+        db.add_image(img2)
+
+        # The same records as if stored one by one with add_photometry
+        mags = numpy.random.uniform(self.MIN_MAG, self.MAX_MAG, len(star_ids))
+        snrs = numpy.random.uniform(self.MIN_SNR, self.MAX_SNR, len(star_ids))
+        ids = numpy.array(star_ids, dtype = numpy.int32)
+        db.add_image_photometry(ids[:-1], img1.unix_time, pfilter, mags[:-1], snrs[:-1])
+        for index, star_id in enumerate(star_ids[:-1]):
+            star = db.get_photometry(star_id, pfilter)
+            self.assertEqual(len(star), 1)
+            self.assertEqual(star.time(0), img1.unix_time)
+            self.assertEqual(star.mag(0), mags[index])
+            self.assertEqual(star.snr(0), snrs[index])
+        self.assertEqual(len(db.get_photometry(star_ids[-1], pfilter)), 0)
+        db.add_image_photometry([], img1.unix_time, pfilter, [], [])
+
+        with self.assertRaises(ValueError):
+            db.add_image_photometry(star_ids, img2.unix_time, pfilter, mags, snrs[1:])
+        with self.assertRaises(UnknownImageError):
+            unix_time = img1.unix_time + img2.unix_time
+            db.add_image_photometry(star_ids, unix_time, pfilter, mags, snrs)
+
+        # Nothing is stored if any of the records cannot be
+        unknown_id = max(star_ids) + 1
+        with self.assertRaises(UnknownStarError):
+            args = star_ids + [unknown_id], img2.unix_time, pfilter
+            db.add_image_photometry(*args, magnitudes = list(mags) + [10],
+                                    snrs = list(snrs) + [100])
+        with self.assertRaises(DuplicatePhotometryError):
+            db.add_image_photometry(star_ids, img1.unix_time, pfilter, mags, snrs)
+        for star_id in star_ids:
+            star = db.get_photometry(star_id, pfilter)
+            self.assertNotIn(img2.unix_time, list(star._unix_times))
+
+        db.add_image_photometry(star_ids, img2.unix_time, pfilter, mags, snrs)
+        for star_id in star_ids:
+            self.assertIn(img2.unix_time,
+                          list(db.get_photometry(star_id, pfilter)._unix_times))
+
+    def test_add_pm_corrections(self):
+
+        db = LEMONdB(':memory:')
+        for star_id in xrange(1, 5):
+            star_info = self.random_star_info(id_ = star_id)
+            if star_id == 3:
+                star_info[6:8] = [None, None]
+            else:
+                star_info[6:8] = [random.uniform(-10, 10), random.uniform(-10, 10)]
+            db.add_star(*star_info)
+        pfilter = passband.Passband.random()
+        img = ImageTest.random(pfilter = pfilter)
+        db.add_image(img)
+
+        xs = numpy.random.uniform(0, self.XSIZE, 3)
+        ys = numpy.random.uniform(0, self.YSIZE, 3)
+        with self.assertRaises(ValueError):
+            db.add_pm_corrections([1, 2, 3], img.unix_time, pfilter, xs, ys)
+        with self.assertRaises(UnknownStarError):
+            db.add_pm_corrections([1, 2, 5], img.unix_time, pfilter, xs, ys)
+        with self.assertRaises(UnknownImageError):
+            db.add_pm_corrections([1, 2, 4], img.unix_time + 1, pfilter, xs, ys)
+        self.assertEqual(db.get_pm_correction(1, img.unix_time, pfilter), (None, None))
+
+        db.add_pm_corrections([1, 2, 4], img.unix_time, pfilter, xs, ys)
+        for star_id, x, y in zip([1, 2, 4], xs, ys):
+            self.assertEqual(db.get_pm_correction(star_id, img.unix_time, pfilter), (x, y))
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.add_pm_corrections([4], img.unix_time, pfilter, xs[:1], ys[:1])
+
     def test_pfilters_and_star_pfilters(self):
 
         db = LEMONdB(':memory:')
@@ -1882,6 +2485,356 @@ class LEMONdBTest(unittest.TestCase):
         with self.assertRaises(sqlite3.IntegrityError):
             db.get_light_curve(nstar_id, pfilter)
 
+    def test_add_light_curves(self):
+
+        db = LEMONdB(':memory:')
+        nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+        for star_info in LEMONdBTest.random_stars_info(nstars):
+            db.add_star(*star_info)
+
+        images = collections.defaultdict(list)
+        size = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
+        for img in ImageTest.nrandom(size):
+            images[img.pfilter].append(img)
+            db.add_image(img)
+
+        def random_curve(star_id, pfilter):
+            """ Return a random light curve for the star in the filter, with
+            other stars as comparison and a point for each of its images """
+            candidate_cstars = set(db.star_ids) - set([star_id])
+            ncstars = random.randint(1, len(candidate_cstars))
+            cstars = random.sample(candidate_cstars, ncstars)
+            curve = LightCurveTest.random(pfilter = pfilter, cstars = cstars)
+            return LightCurveTest.populate(curve, images[pfilter])
+
+        def tables_status(db):
+            """ Return the rows of the LIGHT_CURVES and CMP_STARS tables """
+            db._execute("SELECT * FROM light_curves ORDER BY id")
+            curves = tuple(db._rows)
+            db._execute("SELECT * FROM cmp_stars ORDER BY id")
+            return curves, tuple(db._rows)
+
+        # Store the curves of half of the stars, in all the filters, at once
+        star_ids = db.star_ids
+        random.shuffle(star_ids)
+        stored_ids, other_ids = star_ids[:nstars // 2], star_ids[nstars // 2:]
+        curves = [(star_id, random_curve(star_id, pfilter))
+                  for pfilter in images.iterkeys() for star_id in stored_ids]
+        db.add_light_curves(curves)
+
+        for star_id, icurve in curves:
+            ocurve = db.get_light_curve(star_id, icurve.pfilter)
+            LightCurveTest.assertThatAreEqual(self, icurve, ocurve)
+
+        # The database is left untouched if any of the curves cannot be stored:
+        # here, the first curve is valid but the second one is a duplicate.
+        pfilter = random.choice(images.keys())
+        new_curve = (other_ids[0], random_curve(other_ids[0], pfilter))
+        duplicate = (stored_ids[0], random_curve(stored_ids[0], pfilter))
+        before_tables = tables_status(db)
+        with self.assertRaises(DuplicateLightCurvePointError):
+            db.add_light_curves([new_curve, duplicate])
+        self.assertEqual(tables_status(db), before_tables)
+
+        # UnknownStarError (a non-existent comparison star)
+        nstar_id = max(db.star_ids) + 1
+        curve = copy.deepcopy(new_curve[1])
+        curve.cstars = curve.cstars[:-1] + [nstar_id]
+        with self.assertRaises(UnknownStarError):
+            db.add_light_curves([(new_curve[0], curve)])
+        self.assertEqual(tables_status(db), before_tables)
+
+        # UnknownImageError (an image not in the database)
+        curve = copy.deepcopy(new_curve[1])
+        img = ImageTest.random(pfilter = pfilter)
+        curve.add(img.unix_time, *LightCurveTest.random_point()[1:])
+        with self.assertRaises(UnknownImageError):
+            db.add_light_curves([new_curve, (new_curve[0], curve)])
+        self.assertEqual(tables_status(db), before_tables)
+
+        # ValueError (the star is among its own comparison stars)
+        curve = copy.deepcopy(new_curve[1])
+        curve.cstars = curve.cstars[:-1] + [new_curve[0]]
+        with self.assertRaises(ValueError):
+            db.add_light_curves([(new_curve[0], curve)])
+        self.assertEqual(tables_status(db), before_tables)
+
+        db.add_light_curves([new_curve]) # works!
+        ocurve = db.get_light_curve(new_curve[0], pfilter)
+        LightCurveTest.assertThatAreEqual(self, new_curve[1], ocurve)
+
+    def test_update_light_curves(self):
+
+        db = LEMONdB(':memory:')
+        star1_id, star2_id, star3_id = range(3)
+        for star_id in (star1_id, star2_id, star3_id):
+            db.add_star(*LEMONdBTest.random_star_info(id_ = star_id))
+
+        pfilter = passband.Passband.random()
+        images = sorted(ImageTest.nrandom(6, pfilter = pfilter),
+                        key = operator.attrgetter('unix_time'))
+        old_images, new_images = images[:4], images[4:]
+        for img in old_images:
+            db.add_image(img)
+
+        # No light curves yet, so none of the images has light curve points
+        unix_times = [img.unix_time for img in old_images]
+        self.assertEqual(list(db.get_curveless_times(pfilter)), unix_times)
+        self.assertEqual(len(db.get_curveless_times(passband.Passband.random())), 0)
+
+        kwargs = dict(pfilter = pfilter, cstars = [star2_id, star3_id])
+        curve = LightCurveTest.random(**kwargs)
+        curve = LightCurveTest.populate(curve, old_images)
+        db.add_light_curve(star1_id, curve)
+        self.assertEqual(len(db.get_curveless_times(pfilter)), 0)
+
+        # Add new images, and extend the light curve over them
+        for img in new_images:
+            db.add_image(img)
+        unix_times = [img.unix_time for img in new_images]
+        self.assertEqual(list(db.get_curveless_times(pfilter)), unix_times)
+
+        new_curve = LightCurve(pfilter, curve.cstars, curve.cweights, curve.cstdevs)
+        new_curve = LightCurveTest.populate(new_curve, new_images)
+        db.add_light_curves([(star1_id, new_curve)], extend = True)
+        self.assertEqual(len(db.get_curveless_times(pfilter)), 0)
+
+        ocurve = db.get_light_curve(star1_id, pfilter)
+        self.assertEqual(list(ocurve), list(curve) + list(new_curve))
+        self.assertEqual(ocurve.cstars, tuple(curve.cstars))
+        with self.assertRaises(DuplicateLightCurvePointError):
+            db.add_light_curves([(star1_id, new_curve)], extend = True)
+
+        # Deleting the light curve leaves the database as if never added
+        db.delete_light_curve(star1_id, pfilter)
+        self.assertEqual(None, db.get_light_curve(star1_id, pfilter))
+        db._execute("SELECT COUNT(*) FROM cmp_stars")
+        self.assertEqual(list(db._rows)[0][0], 0)
+        self.assertEqual(len(db.get_curveless_times(pfilter)), len(images))
+        db.delete_light_curve(star2_id, pfilter) # no light curve: nothing
+        with self.assertRaises(KeyError):
+            db.delete_light_curve(17, pfilter)
+
+    def test_processed_stars(self):
+
+        db = LEMONdB(':memory:')
+        star_ids = range(4)
+        for star_id in star_ids:
+            db.add_star(*LEMONdBTest.random_star_info(id_ = star_id))
+
+        pfilter = passband.Passband.random()
+        images = ImageTest.nrandom(3, pfilter = pfilter)
+        for img in images:
+            db.add_image(img)
+        self.assertEqual(db.get_processed_stars(pfilter), set())
+
+        # Stars with a light curve count as processed, even if not recorded
+        curve = LightCurveTest.random(pfilter = pfilter, cstars = [2, 3])
+        curve = LightCurveTest.populate(curve, images)
+        db.add_light_curve(0, curve)
+        self.assertEqual(db.get_processed_stars(pfilter), set([0]))
+
+        # Recording a star twice has no effect
+        db.add_processed_stars([0, 1], pfilter)
+        db.add_processed_stars([1], pfilter)
+        self.assertEqual(db.get_processed_stars(pfilter), set([0, 1]))
+        while True:
+            other = passband.Passband.random()
+            if other != pfilter:
+                break
+        self.assertEqual(db.get_processed_stars(other), set())
+
+        # Nothing is recorded if any of the stars is not in the database
+        with self.assertRaises(KeyError):
+            db.add_processed_stars([2, 17], pfilter)
+        self.assertEqual(db.get_processed_stars(pfilter), set([0, 1]))
+        with self.assertRaises(KeyError):
+            db.add_processed_stars([2], other)
+
+        # Deleting the light curve also forgets that the star was processed
+        db.delete_light_curve(0, pfilter)
+        self.assertEqual(db.get_processed_stars(pfilter), set([1]))
+
+    def test_photometry_store(self):
+
+        for _ in xrange(NITERS // 10):
+            db = LEMONdB(':memory:', dtype = random.choice(database.PRECISIONS.values()))
+            star_ids = random.sample(xrange(self.MIN_ID, self.MAX_ID),
+                                     random.randint(1, 25))
+            for star_id in star_ids:
+                db.add_star(*LEMONdBTest.random_star_info(id_ = star_id))
+
+            pfilter = passband.Passband.random()
+            images = ImageTest.nrandom(random.randint(1, 50), pfilter = pfilter)
+            for img in images:
+                db.add_image(img)
+            for star_id in star_ids:
+                for img in images:
+                    if random.random() < self.OBSERVED_PROB:
+                        magnitude = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                        snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                        db.add_photometry(star_id, img.unix_time, pfilter,
+                                          magnitude, snr)
+
+            store = database.PhotometryStore(db, pfilter)
+            path = store.path
+            try:
+                self.assertEqual(len(store), len(star_ids))
+                self.assertEqual(store.star_ids, db.star_ids)
+
+                # The same DBStars as those returned by LEMONdB.get_photometry
+                stars = [db.get_photometry(star_id, pfilter) for star_id in db.star_ids]
+                numpy.testing.assert_array_equal(store.masks,
+                                                 DBStar.observation_masks(stars))
+                for copy_ in (store, pickle.loads(pickle.dumps(store))):
+                    for star, stored in zip(stars, copy_):
+                        self.assertEqual(stored.id, star.id)
+                        self.assertEqual(stored.dtype, star.dtype)
+                        self.assertEqual(stored._values.dtype, star._values.dtype)
+                        numpy.testing.assert_array_equal(stored._values, star._values)
+                        self.assertEqual(stored._axis_indexes.dtype,
+                                         star._axis_indexes.dtype)
+                        numpy.testing.assert_array_equal(stored._axis_indexes,
+                                                         star._axis_indexes)
+                        numpy.testing.assert_array_equal(stored._mask, star._mask)
+                        self.assertTrue(stored._shares_time_axis(copy_[0]))
+                    self.assertEqual(copy_[-1].id, db.star_ids[-1])
+                    with self.assertRaises(IndexError):
+                        copy_[len(star_ids)]
+
+                # Only the complete stars are read, and the same are returned
+                star = store[0]
+                expected = star.complete_for(stars, masks = store.masks)
+                complete = star.complete_for(store, masks = store.masks)
+                self.assertEqual([s.id for s in complete], [s.id for s in expected])
+                self.assertIn(star.id, [s.id for s in star.complete_for(store)])
+
+                # Blocks: all the stars, sorted by magnitude, within the limit
+                nbytes = random.randint(1, 2048)
+                indexes = random.sample(xrange(len(store)), random.randint(0, len(store)))
+                blocks = store.blocks(indexes, nbytes)
+                flattened = list(itertools.chain(*blocks))
+                self.assertEqual(sorted(flattened), sorted(indexes))
+                medians = [store.medians[index] for index in flattened
+                           if store.sizes[index]]
+                self.assertEqual(medians, sorted(medians))
+                for block in blocks:
+                    stars = [store[index] for index in block]
+                    nbytes_ = sum(s._values.nbytes + s._axis_indexes.nbytes
+                                  for s in stars)
+                    self.assertTrue(len(block) == 1 or nbytes_ <= nbytes)
+            finally:
+                store.close()
+            self.assertFalse(os.path.exists(path))
+
+    def test_pack_records(self):
+
+        for _ in xrange(NITERS):
+            size = random.randint(0, 100)
+            image_ids = numpy.cumsum(numpy.random.randint(1, 5, size))
+            magnitudes = numpy.random.uniform(self.MIN_MAG, self.MAX_MAG, size)
+            snrs = numpy.random.uniform(self.MIN_SNR, self.MAX_SNR, size)
+            data = database.pack_records(image_ids, magnitudes, snrs)
+            records = database.unpack_records(data)
+            for input_, output in zip((image_ids, magnitudes, snrs), records):
+                self.assertEqual(output.dtype.kind, input_.dtype.kind)
+                numpy.testing.assert_array_equal(output, input_)
+
+    def test_pack_and_unpack(self):
+
+        db = LEMONdB(':memory:')
+        star_ids = range(1, random.randint(3, 15))
+        for star_id in star_ids:
+            db.add_star(*LEMONdBTest.random_star_info(id_ = star_id))
+
+        images = collections.defaultdict(list)
+        for img in ImageTest.nrandom(random.randint(4, 40)):
+            images[img.pfilter].append(img)
+            db.add_image(img)
+
+        for pfilter, pfilter_images in images.iteritems():
+            for star_id in star_ids:
+                for img in pfilter_images:
+                    if random.random() < self.OBSERVED_PROB:
+                        magnitude = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                        snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                        db.add_photometry(star_id, img.unix_time, pfilter,
+                                          magnitude, snr)
+            # The light curve of the first star, with the others as comparison
+            curve = LightCurveTest.random(pfilter = pfilter, cstars = star_ids[1:])
+            db.add_light_curve(star_ids[0], LightCurveTest.populate(curve, pfilter_images))
+
+        def status(db):
+            """ Return all that the LEMONdB returns about the photometry """
+            values = [db.pfilters]
+            for pfilter in images.iterkeys():
+                values.append(list(db.get_curveless_times(pfilter)))
+                matrix = db.get_photometry_matrix(pfilter)
+                for array in (matrix.magnitudes, matrix.snrs): # no NaNs
+                    values.append(numpy.where(matrix.observed, array, 0).tolist())
+                for star_id in star_ids:
+                    star = db.get_photometry(star_id, pfilter)
+                    values.append(list(star._unix_times))
+                    values.append(star._values.tolist())
+                    values.append(db.get_instrumental_magnitudes(star_id, pfilter))
+                    curve = db.get_light_curve(star_id, pfilter)
+                    values.append(curve and list(curve))
+            for star_id in star_ids:
+                values.append(db._star_pfilters(star_id))
+            return values
+
+        def count(table):
+            return db._table_count(table)
+
+        expected = status(db)
+        nphotometry = count('photometry')
+        db.pack()
+        self.assertEqual(count('photometry'), 0)
+        self.assertEqual(count('light_curves'), 0)
+        self.assertEqual(count('packed_light_curves'), len(images))
+        self.assertEqual(status(db), expected)
+
+        # Photometry added to a packed star: unpacked, so duplicates fail
+        pfilter = random.choice(images.keys())
+        img = random.choice(images[pfilter])
+        star_id = random.choice(star_ids)
+        magnitudes = db.get_instrumental_magnitudes(star_id, pfilter)
+        args = (star_id, img.unix_time, pfilter, 15.0, 100.0)
+        if img.unix_time in magnitudes:
+            with self.assertRaises(DuplicatePhotometryError):
+                db.add_photometry(*args)
+        else:
+            db.add_photometry(*args)
+            nphotometry += 1
+            magnitudes[img.unix_time] = (15.0, 100.0)
+            expected = status(db)
+        self.assertEqual(db.get_instrumental_magnitudes(star_id, pfilter),
+                         magnitudes)
+        self.assertEqual(count('photometry'), len(magnitudes))
+        self.assertEqual(status(db), expected)
+
+        # The same with the light curves: no point can be added twice
+        curve = db.get_light_curve(star_ids[0], pfilter)
+        with self.assertRaises(DuplicateLightCurvePointError):
+            db.add_light_curves([(star_ids[0], curve)], extend = True)
+        with self.assertRaises(DuplicateLightCurvePointError):
+            db.add_light_curve(star_ids[0], curve)
+        self.assertEqual(status(db), expected)
+        db.delete_light_curve(star_ids[0], pfilter)
+        self.assertIsNone(db.get_light_curve(star_ids[0], pfilter))
+        self.assertEqual(len(db.get_curveless_times(pfilter)), len(images[pfilter]))
+        db.add_light_curve(star_ids[0], curve)
+        self.assertEqual(status(db), expected)
+
+        db.pack() # again, with some stars already packed
+        self.assertEqual(count('photometry'), 0)
+        self.assertEqual(status(db), expected)
+        db.unpack()
+        self.assertEqual(count('packed_photometry'), 0)
+        self.assertEqual(count('packed_light_curves'), 0)
+        self.assertEqual(count('photometry'), nphotometry)
+        self.assertEqual(status(db), expected)
+
     def test_get_instrumental_magnitudes(self):
 
         db = LEMONdB(':memory:')
@@ -2043,6 +2996,75 @@ class LEMONdBTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             db.get_phase_diagram(nstar_id, pfilter, 65)
 
+    def test_fold_and_bin_phases(self):
+
+        for _ in xrange(NITERS):
+            size = random.randint(1, 50)
+            unix_times = numpy.array(runix_times(size))
+            periods = numpy.random.uniform(60, 86400, (2, 3))
+
+            # All the periods at once, the same as one at a time in Python
+            phases = database.fold_phases(unix_times, periods)
+            self.assertEqual(phases.shape, (2, 3, size))
+            zero_t = unix_times.min()
+            for period, row in zip(periods.ravel(), phases.reshape(-1, size)):
+                for unix_time, phase in zip(unix_times, row):
+                    expected = math.modf((unix_time - zero_t) / period)[0]
+                    self.assertEqual(phase, expected)
+
+            # A scalar period and a different epoch, after some of the times
+            epoch = random.choice(unix_times)
+            phases = database.fold_phases(unix_times, periods[0, 0], epoch = epoch)
+            self.assertEqual(phases.shape, (size,))
+            self.assertTrue(numpy.all((phases >= 0) & (phases < 1)))
+            cycles = (unix_times - epoch) / periods[0, 0] - phases
+            self.assertTrue(numpy.allclose(cycles, numpy.round(cycles)))
+
+            # The phase bins of each period, compared to a loop over them
+            nbins = random.randint(1, 10)
+            magnitudes = numpy.random.uniform(10, 20, size)
+            phases = database.fold_phases(unix_times, periods)
+            summary = database.bin_phases(phases, magnitudes, nbins)
+            self.assertEqual(summary.edges.tolist(),
+                             numpy.linspace(0, 1, nbins + 1).tolist())
+            for attr in ('counts', 'means', 'stdevs'):
+                self.assertEqual(getattr(summary, attr).shape, (2, 3, nbins))
+            for index in numpy.ndindex(2, 3):
+                for bin_ in xrange(nbins):
+                    lower, upper = summary.edges[bin_:bin_ + 2]
+                    inside = (phases[index] >= lower) & (phases[index] < upper)
+                    self.assertEqual(summary.counts[index][bin_], inside.sum())
+                    if inside.any():
+                        mags = magnitudes[inside]
+                        self.assertAlmostEqual(summary.means[index][bin_], mags.mean())
+                        self.assertAlmostEqual(summary.stdevs[index][bin_], mags.std())
+                    else:
+                        self.assertTrue(numpy.isnan(summary.means[index][bin_]))
+                        self.assertTrue(numpy.isnan(summary.stdevs[index][bin_]))
+
+        with self.assertRaises(ValueError):
+            database.fold_phases(unix_times, [3600, 0])
+        with self.assertRaises(ValueError):
+            database.bin_phases(phases, magnitudes, 0)
+
+        # The phase dispersion is minimal at the period of a sinusoid
+        pfilter = passband.Passband.random()
+        curve = LightCurve(pfilter, *LightCurveTest.random_data()[1:])
+        period = 7200
+        unix_times = numpy.sort(numpy.random.uniform(0, 30 * period, 500))
+        magnitudes = 0.5 * numpy.sin(2 * numpy.pi * unix_times / period)
+        curve.extend(unix_times, magnitudes, [100] * len(unix_times))
+        trial_periods = numpy.linspace(period / 2, period * 2, 301)
+        theta = curve.phase_bins(trial_periods, 10).dispersion()
+        self.assertEqual(theta.shape, (301,))
+        self.assertAlmostEqual(trial_periods[theta.argmin()], period)
+        self.assertTrue(theta.min() < 0.1)
+        summary = curve.phase_bins(period, 10)
+        self.assertEqual(summary.counts.sum(), len(curve))
+        self.assertTrue(numpy.array_equal(
+            curve.fold(trial_periods),
+            database.fold_phases(curve.unix_times, trial_periods)))
+
     def test_most_similar_magnitude(self):
 
         # The ID, x- and y-image coordinates, right ascension, declination,
@@ -2497,3 +3519,110 @@ class LEMONdBTest(unittest.TestCase):
         self.assertAlmostEqual(star_id, 1)
         self.assertAlmostEqual(distance, 47.939281840122732)
 
+    def test_angular_separation(self):
+
+        # The same distances as astromatic.Coordinates.distance (astropy),
+        # including points that are very close and almost antipodal.
+        for _ in xrange(NITERS):
+            coords_1 = get_random_coords()
+            coords_2 = get_random_coords()
+            expected = coords_1.distance(coords_2)
+            distance = database.angular_separation(coords_1.ra, coords_1.dec,
+                                                   coords_2.ra, coords_2.dec)
+            self.assertAlmostEqual(distance, expected)
+
+        ra, dec = 73.68192, 12.35219
+        self.assertEqual(database.angular_separation(ra, dec, ra, dec), 0)
+        delta = (dec + 1e-8) - dec # not exactly 1e-8 in floating point
+        distance = database.angular_separation(ra, dec, ra, dec + delta)
+        self.assertAlmostEqual(distance / delta, 1)
+        distance = database.angular_separation(ra, dec, ra + 180, -dec)
+        self.assertAlmostEqual(distance, 180)
+
+        # The coordinates are broadcast against each other
+        ras  = numpy.array([186.612871, 5.166987, 278.064554, 97.69629])
+        decs = numpy.array([31.223544, 31.989942, 6.945753, 58.16264])
+        distances = database.angular_separation(ra, dec, ras, decs)
+        expected = [102.39093634720719, 65.368742708468304,
+                    149.01762956453169, 49.274795088346579]
+        for distance, value in zip(distances, expected):
+            self.assertAlmostEqual(distance, value)
+
+        # The unit vectors of the celestial coordinates
+        vectors = database.celestial_to_cartesian(ras, decs)
+        self.assertEqual(vectors.shape, (4, 3))
+        for norm in numpy.sqrt(numpy.square(vectors).sum(axis = 1)):
+            self.assertAlmostEqual(norm, 1)
+        for vector, value in zip(vectors, expected):
+            cosine = numpy.dot(database.celestial_to_cartesian(ra, dec), vector)
+            self.assertAlmostEqual(numpy.degrees(numpy.arccos(cosine)), value)
+
+    def test_stars_closest_to_world_coords(self):
+
+        db = LEMONdB(':memory:')
+        point = (24.19933, 41.40547)
+        with self.assertRaises(ValueError):
+            db.stars_closest_to_world_coords(*point, k = 3)
+        self.assertEqual(db.stars_within_world_coords(*point, radius = 10), [])
+
+        # Compare the spatial index to computing the distance to all the stars
+        stars = {}
+        for star_id in xrange(1, 301):
+            star_info = list(self.random_star_info(id_ = star_id))
+            coords = get_random_coords()
+            star_info[3:5] = coords.ra, coords.dec
+            db.add_star(*star_info)
+            stars[star_id] = coords
+
+        def brute_force(ra, dec):
+            distances = ((database.angular_separation(ra, dec, c.ra, c.dec), id_)
+                         for id_, c in stars.iteritems())
+            return [(id_, d) for d, id_ in sorted(distances)]
+
+        for _ in xrange(NITERS):
+            coords = get_random_coords()
+            expected = brute_force(coords.ra, coords.dec)
+
+            k = random.randint(1, 10)
+            closest = db.stars_closest_to_world_coords(coords.ra, coords.dec, k)
+            self.assertEqual(len(closest), k)
+            self.assertEqual([x[0] for x in closest], [x[0] for x in expected[:k]])
+            for (_, distance), (_, value) in zip(closest, expected):
+                self.assertAlmostEqual(distance, value)
+            self.assertEqual(db.star_closest_to_world_coords(coords.ra, coords.dec),
+                             closest[0])
+
+            # Cone search: the stars at most 'radius' degrees away
+            radius = random.uniform(0, 30)
+            within = db.stars_within_world_coords(coords.ra, coords.dec, radius)
+            cone = [x for x in expected if x[1] <= radius]
+            self.assertEqual([x[0] for x in within], [x[0] for x in cone])
+            for (_, distance), (_, value) in zip(within, cone):
+                self.assertAlmostEqual(distance, value)
+
+        # The radius of the cone is inclusive, and 180 degrees is the sphere
+        ra, dec = stars[7].ra, stars[7].dec
+        self.assertEqual(db.stars_within_world_coords(ra, dec, 0)[0], (7, 0))
+        everything = db.stars_within_world_coords(ra, dec, 180)
+        self.assertEqual(sorted(x[0] for x in everything), sorted(stars))
+
+        # Asking for more stars than there are returns all of them
+        closest = db.stars_closest_to_world_coords(ra, dec, 1000)
+        self.assertEqual(len(closest), len(stars))
+        self.assertEqual(closest[0], (7, 0))
+
+        with self.assertRaises(ValueError):
+            db.stars_closest_to_world_coords(ra, dec, 0)
+        with self.assertRaises(ValueError):
+            db.stars_within_world_coords(ra, dec, -1)
+
+        # The index is rebuilt when a star is added, or rolled back
+        db._savepoint('add_star')
+        star_info = list(self.random_star_info(id_ = 301))
+        star_info[3:5] = 24.19933, 41.40547
+        db.add_star(*star_info)
+        self.assertEqual(db.star_closest_to_world_coords(*point), (301, 0))
+        db._rollback_to('add_star')
+        db._release('add_star')
+        self.assertNotEqual(db.star_closest_to_world_coords(*point)[0], 301)
+
@@ -24,13 +24,21 @@ import copy
 import functools
 import math
 import numpy
+import os
 import random
 
 from test import unittest
 import passband
+from benchmarks import precision
+import snr
 import test_database
+import database
 from database import DBStar
-from diffphot import Weights, StarSet
+import diffphot
+from diffphot import extend_light_curve
+import lightcurves
+from lightcurves import Weights, StarSet
+import mining
 
 NITERS = 50  # How many times some test cases are run with random data
 
@@ -682,6 +690,42 @@ class StarSetTest(unittest.TestCase):
                     set_.light_curve(weights, dstar)
                 break
 
+    def test_extend_light_curve(self):
+
+        stars = self.rDBStars()
+        star, cstars = stars[0], stars[1:]
+        stars_by_id = dict((s.id, s) for s in stars)
+        weights = Weights.random(len(cstars))
+        weights.values = numpy.array([random.uniform(0.01, 1) for s in cstars])
+        curve = StarSet(cstars).light_curve(weights, star)
+
+        # The light curve as it would have been stored before the last images
+        # were added: with the same comparison stars and weights, but no points
+        ncurve = random.randint(1, len(star) - 1)
+        args = star.pfilter, curve.cstars, curve.cweights, curve.cstdevs
+        stored_curve = database.LightCurve(*args)
+        is_new = star._unix_times >= sorted(star._unix_times)[ncurve]
+        rows = zip(*star._phot_info[:, is_new])
+        new_star = DBStar.make_star(star.id, star.pfilter, rows)
+
+        # The points for the new images are equal to those of the whole curve
+        extended = extend_light_curve(new_star, stored_curve, stars_by_id)
+        self.assertEqual(list(extended.cstars), list(curve.cstars))
+        self.assertEqual(len(extended), len(star) - ncurve)
+        for epoint, point in zip(extended, list(curve)[ncurve:]):
+            for evalue, value in zip(epoint, point):
+                self.assertAlmostEqual(evalue, value)
+
+        # None if a comparison star was not observed in the new images...
+        cstar = random.choice(cstars)
+        rows = zip(*cstar._phot_info[:, ~is_new])
+        stars_by_id[cstar.id] = DBStar.make_star(cstar.id, cstar.pfilter, rows)
+        self.assertEqual(None, extend_light_curve(new_star, stored_curve, stars_by_id))
+
+        # ... or is not among the stars at all
+        del stars_by_id[cstar.id]
+        self.assertEqual(None, extend_light_curve(new_star, stored_curve, stars_by_id))
+
     def test_light_curve_basic_case(self):
 
         cmp_mags = \
@@ -932,6 +976,22 @@ class StarSetTest(unittest.TestCase):
             with self.assertRaises(ValueError):
                 set_.broeg_weights()
 
+    def test_leave_one_out_stdevs(self):
+
+        # The standard deviations computed at once, updating the weighted sum
+        # of all the stars, must be equal to those of the light curves that
+        # StarSet.light_curve returns when each star is excluded in turn.
+        for _ in xrange(NITERS):
+            set_ = self.random_set()[0]
+            weights = Weights.random(len(set_))
+            mags = set_._phot_info[:, 0, :]
+            stdevs = StarSet._leave_one_out_stdevs(mags, weights)
+            self.assertEqual(len(stdevs), len(set_))
+            for index in xrange(len(set_)):
+                kwargs = dict(_exclude_index = index, no_snr = True)
+                curve = set_.light_curve(weights, set_[index], **kwargs)
+                self.assertAlmostEqual(stdevs[index], curve.stdev)
+
     # The small data set used to test StarSet.broeg_weights: the instrumental
     # magnitudes of three stars, observed in three images, whose light curves
     # we have to compute manually to compare them to the output of the method.
@@ -1032,6 +1092,30 @@ class StarSetTest(unittest.TestCase):
         self._assert_broeg_weights(*args, pct = 0.315, max_iters = None)
         self._assert_broeg_weights(*args, pct = None, max_iters = 2)
 
+    def test_broeg_weights_warm_start(self):
+
+        # Starting from the weights to which the algorithm converges, it should
+        # need a single iteration to converge again (to the same weights, as
+        # the change is below the threshold), while stars for which no weight
+        # is given start from their flux-proportional weights.
+
+        set_ = self.random_set(size = random.randint(3, 50))[0]
+        cold = set_.broeg_weights(pct = 0.001)
+        self.assertTrue(set_.iterations >= 1)
+        ncold = set_.iterations
+
+        set_.iterations = 0
+        initial = dict(zip(set_.star_ids, cold))
+        warm = set_.broeg_weights(pct = 0.001, initial = initial)
+        self.assertEqual(set_.iterations, 1)
+        self.assertTrue(cold.absolute_percent_change(warm) < 0.001)
+
+        # An empty dictionary is equivalent to the flux-proportional weights
+        set_.iterations = 0
+        empty = set_.broeg_weights(pct = 0.001, initial = {})
+        self.assertEqual(set_.iterations, ncold)
+        self.assertTrue(numpy.all(numpy.array(empty) == numpy.array(cold)))
+
     def test_worst_fraction_out_of_range(self):
 
         # # Valid fractions are in the range (0, 1]
@@ -1359,6 +1443,253 @@ class StarSetTest(unittest.TestCase):
         self._assert_best(set_, 6, 0.8, [4, 2, 6, 0, 1, 3])
         self._assert_best(set_, 7, 0.8, [4, 2, 6, 0, 1, 3, 5])
 
+    def test_best_random(self):
+
+        def best(set_, n, fraction):
+            """ StarSet.best, discarding stars by deleting them from a copy
+            of the set after each call to StarSet.worst """
+            set_ = copy.deepcopy(set_)
+            while len(set_) > max(n, 3):
+                worst_indexes = set_.worst(fraction)
+                del worst_indexes[(len(set_) - max(n, 3)):]
+                for index in sorted(worst_indexes, reverse = True):
+                    del set_[index]
+            if len(set_) != n:
+                worst_indexes = set_.worst(1.0)
+                del worst_indexes[(len(set_) - n):]
+                for index in sorted(worst_indexes, reverse = True):
+                    del set_[index]
+            return set_
+
+        for _ in xrange(NITERS):
+            set_ = self.random_set()[0]
+            n = random.randint(1, len(set_))
+            fraction = 1.0 - random.random() # (0.0, 1.0]
+            expected = best(set_, n, fraction)
+            returned = set_.best(n, fraction = fraction)
+            self.assertEqual(returned.star_ids, expected.star_ids)
+            self.assertTrue(numpy.all(returned._phot_info == expected._phot_info))
+            self.assertTrue(numpy.all(returned._unix_times == expected._unix_times))
+            # The subset does not share the magnitudes array with the set
+            self.assertFalse(numpy.may_share_memory(returned._phot_info, set_._phot_info))
+
+    def test_best_warm_start(self):
+
+        # The number of stars returned does not depend on the initial weights
+        for _ in xrange(NITERS):
+            set_ = self.random_set()[0]
+            n = random.randint(1, len(set_))
+            initial = dict((id_, random.random()) for id_ in set_.star_ids[::2])
+            returned = set_.best(n, initial = initial)
+            self.assertEqual(len(returned), n)
+            self.assertEqual(returned.iterations, 0)
+            self.assertTrue(set(returned.star_ids) <= set(set_.star_ids))
+
+    def random_gapped(self):
+        """ Return a random DBStar and other DBStars with gaps.
+
+        The method returns a two-element tuple: a DBStar and a list of DBStars
+        that share its time axis, each of them observed in a random subset of
+        (at least two of) the Unix times, so that they are not necessarily
+        complete for the DBStar (see DBStar.covered_for and StarSet.masked),
+        although all of them were observed in at least one of its images.
+
+        """
+
+        stars = self.rDBStars(nrecords = random.randint(*self.NRECORDS_RANGE))
+        time_axis = numpy.array(sorted(stars[0]._unix_times))
+
+        gapped = []
+        for index, star in enumerate(stars):
+            rows = sorted(zip(star._unix_times, star._magnitudes, star._snrs))
+            # The first star, at least in half of the images
+            minimum = len(rows) // 2 if not index else 2
+            nrecords = random.randint(minimum, len(rows))
+            rows = sorted(random.sample(rows, nrecords))
+            args = star.id, star.pfilter, rows
+            gapped.append(DBStar.make_star(*args, time_axis = time_axis))
+        return gapped[0], gapped[0].covered_for(gapped[1:], 1e-9)
+
+    def test_masked(self):
+
+        for _ in xrange(NITERS):
+            star, others = self.random_gapped()
+            if not others:
+                continue
+            set_ = StarSet.masked(star, others)
+            self.assertEqual(set_.star_ids, [other.id for other in others])
+            self.assertEqual(list(set_._unix_times), list(star._unix_times))
+
+            # Each star, only in the images in which it was observed
+            unix_times = set(star._unix_times)
+            for index, other in enumerate(others):
+                shared = [(t, m, s) for t, m, s in
+                          zip(other._unix_times, other._magnitudes, other._snrs)
+                          if t in unix_times]
+                sstar = set_[index]
+                self.assertEqual(sstar.id, other.id)
+                self.assertEqual(list(zip(sstar._unix_times, sstar._magnitudes,
+                                          sstar._snrs)), shared)
+                if set_._observed is not None:
+                    self.assertEqual(set_._observed[index].sum(), len(shared))
+
+            # Deleting a star also deletes its row of the mask
+            if len(set_) > 1:
+                del set_[0]
+                self.assertEqual(set_.star_ids, [other.id for other in others[1:]])
+                if set_._observed is not None:
+                    self.assertEqual(len(set_._observed), len(set_))
+
+            # Without gaps, there is no mask: the same StarSet that the
+            # constructor returns for the complete (trimmed) stars.
+            complete = star.complete_for(others)
+            if complete:
+                set_ = StarSet.masked(star, complete)
+                self.assertTrue(set_._observed is None)
+                expected = StarSet(complete)
+                self.assertEqual(set_.star_ids, expected.star_ids)
+                self.assertTrue(numpy.all(set_._phot_info == expected._phot_info))
+
+        # DBStars that do not share the time axis
+        star, others = self.random_gapped()
+        with self.assertRaises(ValueError):
+            StarSet.masked(star, self.rDBStars())
+        with self.assertRaises(ValueError):
+            StarSet.masked(star, [])
+
+        # A DBStar not observed in any of the images of the star
+        time_axis = star._time_axis
+        rows = [(t, 15.6, 100) for t in time_axis if t not in set(star._unix_times)]
+        if rows:
+            other = DBStar.make_star(0, star.pfilter, rows, time_axis = time_axis)
+            with self.assertRaises(ValueError):
+                StarSet.masked(star, [other])
+
+    def test_masked_leave_one_out_stdevs(self):
+
+        for _ in xrange(NITERS):
+            set_ = self.random_set()[0]
+            mags = set_._phot_info[:, 0, :]
+            weights = Weights.random(len(set_))
+
+            # If all the stars were observed, the result is that of StarSet
+            observed = numpy.ones(mags.shape, dtype = bool)
+            assertSequencesAlmostEqual(self,
+                StarSet._leave_one_out_stdevs(mags, weights, observed),
+                StarSet._leave_one_out_stdevs(mags, weights))
+            assertSequencesAlmostEqual(self,
+                StarSet._flux_proportional_weights(mags, set_.dtype, observed),
+                StarSet._flux_proportional_weights(mags, set_.dtype))
+
+            # With gaps, the comparison star of each star in each image is the
+            # weighted mean of the other stars observed in it, each of them
+            # relative to its mean magnitude over the images where observed.
+            observed = numpy.random.random_sample(mags.shape) < 0.8
+            gapped = numpy.where(observed, mags, numpy.nan)
+            stdevs = StarSet._leave_one_out_stdevs(gapped, weights, observed)
+            means = [mags[x][observed[x]].mean() if observed[x].any() else 0
+                     for x in xrange(len(set_))]
+            offsets = mags - numpy.array(means)[:, numpy.newaxis]
+            for index in xrange(len(set_)):
+                dmags = []
+                for column in xrange(mags.shape[1]):
+                    others = [x for x in xrange(len(set_))
+                              if x != index and observed[x, column]]
+                    if observed[index, column] and others:
+                        cweights = numpy.asarray(weights)[others]
+                        cmag = numpy.average(offsets[others, column], weights = cweights)
+                        dmags.append(offsets[index, column] - cmag)
+                if len(dmags) >= 2:
+                    self.assertAlmostEqual(stdevs[index], numpy.std(dmags))
+                else:
+                    self.assertEqual(stdevs[index], numpy.inf)
+
+    def test_masked_light_curve(self):
+
+        for _ in xrange(NITERS):
+            star, others = self.random_gapped()
+            if not others:
+                continue
+            set_ = StarSet.masked(star, others)
+            weights = set_.broeg_weights()
+            self.assertEqual(len(weights), len(set_))
+            curve = set_.light_curve(weights, star)
+
+            # The comparison stars observed in each image, with their weights
+            # renormalized, and only the images in which there is at least one.
+            # What is averaged is the offset of each star from its mean
+            # magnitude, and the weighted mean of these means is added back.
+            observed = set_._observed
+            if observed is None:
+                observed = numpy.ones((len(set_), set_.nimages), dtype = bool)
+            mags = set_._phot_info[:, 0, :]
+            means = numpy.array([mags[x][observed[x]].mean()
+                                 for x in xrange(len(set_))])
+            level = numpy.average(means, weights = weights)
+            expected = []
+            for column, unix_time in enumerate(star._unix_times):
+                indexes = numpy.flatnonzero(observed[:, column] & (weights > 0))
+                if not len(indexes):
+                    continue
+                cweights = numpy.asarray(weights)[indexes]
+                offsets = mags[indexes, column] - means[indexes]
+                cmag = level + numpy.average(offsets, weights = cweights)
+                csnr = snr.mean_snr(set_._phot_info[indexes, 1, column],
+                                    weights = cweights)
+                dsnr = snr.difference_snr(star._snrs[column], csnr)
+                expected.append((unix_time, star._magnitudes[column] - cmag, dsnr))
+
+            self.assertEqual(len(curve), len(expected))
+            for point, epoint in zip(curve, expected):
+                self.assertEqual(point[0], epoint[0])
+                self.assertAlmostEqual(point[1], epoint[1])
+                self.assertAlmostEqual(point[2], epoint[2])
+
+            # Or, if the SNRs are not needed
+            curve = set_.light_curve(weights, star, no_snr = True)
+            self.assertEqual(len(curve), len(expected))
+
+    def test_masked_gaps_do_not_shift_comparison(self):
+
+        # Constant stars of very different brightness, observed in images with
+        # random zero points, with little noise and random gaps. The level of
+        # the artificial comparison star must not jump in the images in which
+        # some of the comparison stars are missing: the light curve of the
+        # constant star is flat, and the Broeg weights converge as fast as if
+        # there were no gaps.
+        nstars, nimages = 30, 60
+        pfilter = passband.Passband.random()
+        time_axis = numpy.arange(nimages, dtype = float) * 100 + 1e9
+        zero_points = numpy.random.normal(0, 0.2, nimages)
+        means = numpy.random.uniform(10, 18, nstars)
+        noise = numpy.random.normal(0, 0.001, (nstars, nimages))
+        mags = means[:, numpy.newaxis] + zero_points + noise
+        observed = numpy.random.random_sample(mags.shape) < 0.8
+        observed[0] = True
+
+        def make_stars(observed):
+            stars = []
+            for index in xrange(nstars):
+                columns = numpy.flatnonzero(observed[index])
+                rows = [(time_axis[x], mags[index, x], 1000) for x in columns]
+                args = index + 1, pfilter, rows
+                stars.append(DBStar.make_star(*args, time_axis = time_axis))
+            return stars[0], stars[1:]
+
+        star, others = make_stars(observed)
+        set_ = StarSet.masked(star, others)
+        self.assertTrue(set_._observed is not None)
+        weights = set_.broeg_weights()
+        curve = set_.light_curve(weights, star, no_snr = True)
+        self.assertEqual(len(curve), nimages)
+        dmags = numpy.array([point[1] for point in curve])
+        self.assertTrue(dmags.std() < 0.005)
+
+        star, others = make_stars(numpy.ones(mags.shape, dtype = bool))
+        complete = StarSet(others)
+        complete.broeg_weights()
+        self.assertTrue(set_.iterations <= complete.iterations + 2)
+
     def test_best_fraction_out_of_range(self):
 
         # Valid fractions are in the range (0, 1]
@@ -1398,3 +1729,381 @@ class StarSetTest(unittest.TestCase):
         self.assertRaises(ValueError, set_.best, len(set_) + 1)
         self.assertRaises(ValueError, set_.best, len(set_) + 5)
 
+
+class PrecisionTest(unittest.TestCase):
+
+    def test_precisions(self):
+
+        # Light curves computed in lower precisions must use the same
+        # comparison stars as with numpy.longdouble (otherwise, ValueError
+        # is raised by max_deviations) and differ only by rounding errors.
+        campaign = precision.synthetic_campaign(25, 100, seed = 1)
+        reference = precision.light_curves(*campaign, dtype = numpy.longdouble,
+                                           ncstars = 10, ntargets = 5)
+
+        thresholds = {'longdouble' : (0.0, 0.0),
+                      'float64'    : (1e-12, 1e-10),
+                      'float32'    : (1e-3, 1e-4)}
+
+        for name, dtype in database.PRECISIONS.iteritems():
+            curves = precision.light_curves(*campaign, dtype = dtype,
+                                            ncstars = 10, ntargets = 5)
+            max_mag, max_snr = precision.max_deviations(reference, curves)
+            self.assertTrue(max_mag <= thresholds[name][0])
+            self.assertTrue(max_snr <= thresholds[name][1])
+
+
+class EnsembleTest(unittest.TestCase):
+
+    def test_photometry_points(self):
+
+        pfilter = passband.Passband.random()
+        time_axis = numpy.array(sorted(test_database.runix_times(20)))
+        stars = []
+        for star_id in xrange(5):
+            size = random.randint(1, len(time_axis))
+            unix_times = sorted(random.sample(time_axis, size))
+            rows = [(t, random.uniform(10, 15), random.uniform(50, 500)) for t in unix_times]
+            stars.append(DBStar.make_star(star_id, pfilter, rows, time_axis = time_axis))
+
+        rows, columns, mags, snrs = diffphot.photometry_points(stars)
+        self.assertEqual(len(rows), sum(len(star) for star in stars))
+        for index, star in enumerate(stars):
+            points = rows == index
+            self.assertEqual(list(time_axis[columns[points]]), list(star._unix_times))
+            self.assertTrue(numpy.all(mags[points] == star._magnitudes))
+            self.assertTrue(numpy.all(snrs[points] == star._snrs))
+
+        # The DBStars must share the same time axis
+        stars[-1]._time_axis = time_axis.copy()
+        with self.assertRaises(ValueError):
+            diffphot.photometry_points(stars)
+
+    def test_ensemble_photometry(self):
+
+        # Stars with random mean magnitudes, observed in images with random
+        # zero points (that add up to zero) with little noise and gaps
+        nstars, nimages = 40, 30
+        star_means = numpy.random.uniform(10, 18, nstars)
+        zero_points = numpy.random.normal(0, 0.2, nimages)
+        zero_points -= zero_points.mean()
+        errors = numpy.random.uniform(0.001, 0.002, (nstars, nimages))
+        mags = star_means[:, numpy.newaxis] + zero_points
+        mags += numpy.random.normal(0, 1, mags.shape) * errors
+        observed = numpy.random.random(mags.shape) > 0.2
+        observed[:, 0] = True
+
+        # The first star is variable: its magnitudes have a large scatter
+        mags[0] += numpy.random.normal(0, 0.5, nimages)
+
+        # Only the observed points are given to the method
+        def ensemble_photometry(observed):
+            rows, columns = numpy.nonzero(observed)
+            args = rows, columns, mags[observed], errors[observed], mags.shape
+            return rows, diffphot.ensemble_photometry(*args)
+
+        rows, results = ensemble_photometry(observed)
+        omeans, ozero_points, ozp_errors, weights = results
+        self.assertTrue(numpy.allclose(ozero_points, zero_points, atol = 0.005))
+        self.assertTrue(numpy.allclose(omeans[1:], star_means[1:], atol = 0.005))
+        self.assertTrue(numpy.all(ozp_errors > 0))
+        self.assertEqual(len(weights), observed.sum())
+        # The variable star has been given much less weight than the others
+        total_weights = numpy.bincount(rows, weights)
+        self.assertTrue(total_weights[0] < 0.01 * total_weights[1:].min())
+
+        # Images without observations have no zero point
+        observed[:, -1] = False
+        ozero_points, ozp_errors = ensemble_photometry(observed)[1][1:3]
+        self.assertTrue(numpy.isnan(ozero_points[-1]))
+        self.assertTrue(numpy.isnan(ozp_errors[-1]))
+        self.assertTrue(numpy.all(numpy.isfinite(ozero_points[:-1])))
+
+
+class NeighborsTest(unittest.TestCase):
+
+    def test_nearest(self):
+
+        nstars = 100
+        star_ids = random.sample(xrange(1, 9999), nstars)
+        x = numpy.random.uniform(0, 2000, nstars)
+        y = numpy.random.uniform(0, 2000, nstars)
+        mags = numpy.random.uniform(10, 18, nstars)
+        mag_scale = random.uniform(0, 500)
+        neighbors = lightcurves.Neighbors(star_ids, x, y, mags, mag_scale)
+        self.assertEqual(len(neighbors), nstars)
+
+        points = numpy.column_stack((x, y, mags * mag_scale))
+        for _ in xrange(NITERS):
+            index = random.randrange(nstars)
+            k = random.randint(1, nstars + 10)
+            distances = numpy.sqrt(numpy.sum((points - points[index]) ** 2, axis = 1))
+            expected = list(numpy.argsort(distances, kind = 'mergesort')[:k])
+            indexes = neighbors.nearest(star_ids[index], k)
+            self.assertEqual(len(indexes), min(k, nstars))
+            self.assertEqual(indexes[0], index)
+            self.assertTrue(numpy.allclose(distances[indexes], distances[expected]))
+
+    def test_complete_for(self):
+
+        # Stars along a line, one pixel apart: the nearest to the first one
+        # are those with the lowest indexes. Only those with an even index
+        # were observed in all the images; the others miss the first one.
+        pfilter = passband.Passband.random()
+        time_axis = numpy.array(sorted(test_database.runix_times(10)))
+        nstars = 50
+        stars = []
+        for index in xrange(nstars):
+            unix_times = time_axis if index % 2 == 0 else time_axis[1:]
+            rows = [(t, random.uniform(10, 15), random.uniform(50, 500)) for t in unix_times]
+            stars.append(DBStar.make_star(index, pfilter, rows, time_axis = time_axis))
+        masks = DBStar.observation_masks(stars)
+
+        x, y, mags = range(nstars), [0] * nstars, [12] * nstars
+        neighbors = lightcurves.Neighbors(range(nstars), x, y, mags, 0)
+
+        for k in (1, 5, 10, 30):
+            complete = neighbors.complete_for(stars[0], stars, masks, k)
+            expected = [index for index in xrange(2, nstars, 2)][:k]
+            self.assertEqual([star.id for star in complete], expected)
+            for star in complete:
+                self.assertEqual(list(star._unix_times), list(time_axis))
+
+
+class ComputeLightCurveTest(unittest.TestCase):
+
+    @staticmethod
+    def synthetic_db(db, nstars, nimages, pfilter):
+        """ Add a synthetic campaign, without variable stars, to a LEMONdB.
+
+        The last star was observed in only the first five images, so its light
+        curve cannot be computed with the default options of diffphot.
+
+        """
+
+        unix_times, mags, snrs = precision.synthetic_campaign(nstars, nimages)
+        for unix_time in unix_times:
+            img = test_database.ImageTest.random(pfilter = pfilter)
+            db.add_image(img._replace(unix_time = unix_time))
+        for star_id in xrange(nstars):
+            db.add_star(*test_database.LEMONdBTest.random_star_info(id_ = star_id))
+            nobserved = nimages if star_id < nstars - 1 else 5
+            for index in xrange(nobserved):
+                db.add_photometry(star_id, unix_times[index], pfilter,
+                                  mags[star_id, index], snrs[star_id, index])
+
+    def test_compute_light_curve(self):
+
+        nstars, nimages = 30, 25
+        db = database.LEMONdB(':memory:')
+        pfilter = passband.Passband.random()
+        self.synthetic_db(db, nstars, nimages, pfilter)
+
+        options = diffphot.parser.get_default_values()
+        options.ncstars, options.min_cstars = 10, 5
+        star_id = random.randrange(nstars - 1)
+
+        # The same light curve that select_comparison_stars gives
+        all_stars = [db.get_photometry(id_, pfilter) for id_ in db.star_ids]
+        masks = DBStar.observation_masks(all_stars)
+        args = all_stars[star_id], all_stars, masks, options
+        comparison_stars, cweights, _ = lightcurves.select_comparison_stars(*args)
+        expected = comparison_stars.light_curve(cweights, all_stars[star_id])
+
+        self.assertIsNone(db.get_light_curve(star_id, pfilter))
+        curve = lightcurves.compute_light_curve(db, star_id, pfilter, options)
+        self.assertEqual(curve.cstars, expected.cstars)
+        self.assertEqual(list(curve), list(expected))
+
+        # ... which is cached in the database
+        stored = db.get_light_curve(star_id, pfilter)
+        self.assertEqual(list(stored.cstars), list(expected.cstars))
+        self.assertEqual(len(stored), nimages)
+        self.assertIn(star_id, db.get_processed_stars(pfilter))
+        options.ncstars = 15
+        curve = lightcurves.compute_light_curve(db, star_id, pfilter, options)
+        self.assertEqual(list(curve.cstars), list(stored.cstars))
+
+        # Not computed (too few images), but also recorded as processed
+        last_id = nstars - 1
+        self.assertIsNone(lightcurves.compute_light_curve(db, last_id, pfilter))
+        self.assertIn(last_id, db.get_processed_stars(pfilter))
+        self.assertIsNone(db.get_light_curve(last_id, pfilter))
+
+        # Without storing anything
+        other_id = (star_id + 1) % (nstars - 1)
+        curve = lightcurves.compute_light_curve(db, other_id, pfilter, options,
+                                                all_stars = all_stars, store = False)
+        self.assertEqual(len(curve), nimages)
+        self.assertIsNone(db.get_light_curve(other_id, pfilter))
+        self.assertNotIn(other_id, db.get_processed_stars(pfilter))
+
+        with self.assertRaises(KeyError):
+            lightcurves.compute_light_curve(db, nstars, pfilter)
+
+    def test_lazy_light_curve(self):
+
+        nstars, nimages = 30, 25
+        path = test_database.LEMONdBTest.random_path()
+        try:
+            pfilter = passband.Passband.random()
+            db = database.LEMONdB(path)
+            self.synthetic_db(db, nstars, nimages, pfilter)
+            db.commit()
+            del db
+
+            miner = mining.LEMONdBMiner(path, profile = 'read-mostly')
+            star_id = random.randrange(nstars - 1)
+            self.assertIsNone(miner.get_light_curve(star_id, pfilter))
+            curve = miner.lazy_light_curve(star_id, pfilter)
+            args = miner, star_id, pfilter
+            expected = lightcurves.compute_light_curve(*args, store = False)
+            self.assertEqual(list(curve.cstars), list(expected.cstars))
+            self.assertEqual(list(curve), list(expected))
+
+            # Returned from now on by get_light_curve, but not stored
+            self.assertIs(miner.get_light_curve(star_id, pfilter), curve)
+            self.assertIs(miner.lazy_light_curve(star_id, pfilter), curve)
+            db = database.LEMONdB(path, profile = 'read-mostly')
+            self.assertIsNone(db.get_light_curve(star_id, pfilter))
+            self.assertEqual(db.get_processed_stars(pfilter), set())
+
+            # Not computed again if it could not be computed the first time
+            last_id = nstars - 1
+            self.assertIsNone(miner.lazy_light_curve(last_id, pfilter))
+            self.assertIn((last_id, pfilter), miner._lazy_curves)
+            self.assertIsNone(miner.get_light_curve(last_id, pfilter))
+
+            # If the database can be written, the curve is stored there, and
+            # returned by get_light_curve, although it had memoized a None
+            db.close()
+            miner.close()
+            miner = mining.LEMONdBMiner(path)
+            self.assertIsNone(miner.get_light_curve(star_id, pfilter))
+            curve = miner.lazy_light_curve(star_id, pfilter)
+            self.assertEqual(list(curve), list(expected))
+            self.assertNotIn((star_id, pfilter), miner._lazy_curves)
+            self.assertEqual(list(miner.get_light_curve(star_id, pfilter)),
+                             list(expected))
+            self.assertIsNone(miner.lazy_light_curve(last_id, pfilter))
+
+            # ... so later sessions do not have to compute it again
+            miner.close()
+            db = database.LEMONdB(path, profile = 'read-mostly')
+            stored = db.get_light_curve(star_id, pfilter)
+            self.assertEqual(list(stored), list(expected))
+            self.assertEqual(db.get_processed_stars(pfilter),
+                             set([star_id, last_id]))
+            miner = mining.LEMONdBMiner(path, profile = 'read-mostly')
+            self.assertEqual(list(miner.lazy_light_curve(star_id, pfilter)),
+                             list(expected))
+            self.assertEqual(miner._lazy_curves, {})
+        finally:
+            os.unlink(path)
+
+class ParallelLightCurvesTest(unittest.TestCase):
+
+    def test_memoize_groups(self):
+
+        # A group of many stars with the same observations and magnitudes,
+        # which has to be split among the cores, and two stars with a group
+        # of their own: one brighter, and one observed in different images.
+        pfilter = passband.Passband.random()
+        time_axis = numpy.arange(10, dtype = float)
+        def make_star(id_, unix_times, magnitude):
+            rows = [(t, magnitude, 100) for t in unix_times]
+            return DBStar.make_star(id_, pfilter, rows, time_axis = time_axis)
+
+        stars = [make_star(id_, time_axis, 12.1) for id_ in xrange(23)]
+        stars.insert(5, make_star(100, time_axis, 15.2))
+        stars.insert(9, make_star(101, time_axis[::2], 12.1))
+
+        options = diffphot.parser.get_default_values()
+        for ncores in (1, 2, 4, 30):
+            options.ncores = ncores
+            groups = diffphot.memoize_groups(stars, options)
+            keys = [set(diffphot.comparison_key(star, options) for star in group)
+                    for group in groups]
+            self.assertTrue(all(len(x) == 1 for x in keys))
+            ids = sorted(star.id for group in groups for star in group)
+            self.assertEqual(ids, sorted(star.id for star in stars))
+            # Only the large group is split, into chunks of the share of each
+            # core, so that each core gets a similar amount of work
+            size = int(numpy.ceil(len(stars) / ncores))
+            self.assertTrue(all(len(group) <= size for group in groups))
+            large = [group for group in groups if group[0].id < 100]
+            self.assertEqual(len(large), int(numpy.ceil(23 / size)))
+            self.assertEqual(len(groups), len(large) + 2)
+            # Within each group, in the same order as in 'stars'
+            self.assertEqual([star.id for group in large for star in group],
+                             range(23))
+
+    def test_parallel_light_curves(self):
+
+        # A synthetic campaign in a LEMONdB on disk, read by the "workers"
+        nstars, nimages = 20, 15
+        unix_times, mags, snrs = precision.synthetic_campaign(nstars, nimages)
+        path = test_database.LEMONdBTest.random_path()
+        try:
+            db = database.LEMONdB(path)
+            pfilter = passband.Passband.random()
+            for star_id in xrange(nstars):
+                db.add_star(*test_database.LEMONdBTest.random_star_info(id_ = star_id))
+            for index, unix_time in enumerate(unix_times):
+                img = test_database.ImageTest.random(pfilter = pfilter)
+                db.add_image(img._replace(unix_time = unix_time))
+                db.add_image_photometry(range(nstars), unix_time, pfilter,
+                                        mags[:, index], snrs[:, index])
+            db.commit()
+
+            options = diffphot.parser.get_default_values()
+            options.ncstars, options.min_cstars = 8, 4
+            options.nearest = random.choice([0, 12])
+
+            all_stars = db.get_photometry_matrix(pfilter).dbstars()
+            masks = DBStar.observation_masks(all_stars)
+            neighbors = None
+            if options.nearest:
+                neighbors = lightcurves.Neighbors.from_db(db, all_stars,
+                                                          options.nearest_mag_scale)
+
+            # Only the indexes of the stars are sent: the photometry is read
+            # from the database, once, and the same light curves are computed
+            connections = database.ConnectionPool(path, dtype = db.dtype)
+            indexes = random.sample(xrange(nstars), 5)
+            args = indexes, connections, pfilter, None, {}, options
+            diffphot.parallel_light_curves(args)
+            worker_args = connections, pfilter, None, options
+            worker_stars = diffphot.worker_photometry(*worker_args)[0]
+            diffphot.parallel_light_curves(args)
+            self.assertIs(diffphot.worker_photometry(*worker_args)[0], worker_stars)
+            self.assertEqual(len(connections), 1)
+
+            queued = [diffphot.queue.get() for _ in xrange(2 * len(indexes))]
+            star_ids = [all_stars[index].id for index in indexes] * 2
+            self.assertEqual([x[0] for x in queued], star_ids)
+            for index, (star_id, curve, hit, iterations) in zip(indexes * 2, queued):
+                star = all_stars[index]
+                args = star, all_stars, masks, options
+                selection = lightcurves.select_comparison_stars(*args,
+                                                                neighbors = neighbors)
+                expected = selection[0].light_curve(selection[1], star)
+                self.assertEqual(list(curve.cstars), list(expected.cstars))
+                self.assertEqual(list(curve), list(expected))
+            connections.close()
+
+            # Photometry shared by the parent process is not read again
+            shared_args = db, connections, pfilter, all_stars, None, options
+            shared = diffphot.share_photometry(*shared_args)
+            self.assertIs(shared[0], all_stars)
+            self.assertTrue(numpy.all(shared[1] == masks))
+            self.assertIs(diffphot.worker_photometry(*worker_args), shared)
+            self.assertEqual(len(connections), 0)
+            args = indexes, connections, pfilter, None, {}, options
+            diffphot.parallel_light_curves(args)
+            self.assertEqual(len(connections), 0)
+            queued = [diffphot.queue.get() for _ in indexes]
+            self.assertEqual([x[0] for x in queued], star_ids[:len(indexes)])
+        finally:
+            diffphot._worker_photometry.clear()
+            os.unlink(path)
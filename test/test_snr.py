@@ -67,6 +67,14 @@ class SNRTest(unittest.TestCase):
         self.assertRaises(ValueError, snr_to_error, random.random())
         self.assertRaises(ValueError, snr_to_error, 0)
         self.assertRaises(ValueError, snr_to_error, -1.5)
+        self.assertRaises(ValueError, snr_to_error, numpy.nan)
+
+        # Also if any of the elements of an array is, including NaN
+        snrs = numpy.array([100.0, 50.0, 250.0])
+        self.assertEqual(snr_to_error(snrs)[0].shape, snrs.shape)
+        for value in (1, 0.5, -3, numpy.nan):
+            snrs[1] = value
+            self.assertRaises(ValueError, snr_to_error, snrs)
 
     def test_error_to_snr(self):
         for snr, max_error, min_error in self.known_snrs:
@@ -80,6 +88,18 @@ class SNRTest(unittest.TestCase):
             self.assertAlmostEqual(error_to_snr(max_error), snr)
             self.assertAlmostEqual(error_to_snr(min_error), snr)
 
+        # ValueError raised if the error is zero (infinite SNR) or NaN
+        self.assertRaises(ValueError, error_to_snr, 0)
+        self.assertRaises(ValueError, error_to_snr, -0.0)
+        self.assertRaises(ValueError, error_to_snr, numpy.nan)
+
+        # Also if any of the elements of an array is
+        errors = numpy.array([0.01, -0.05, 0.2])
+        self.assertEqual(error_to_snr(errors).shape, errors.shape)
+        for value in (0, numpy.nan):
+            errors[1] = value
+            self.assertRaises(ValueError, error_to_snr, errors)
+
 
     def _random_magnitude_error(self):
         """ Return a random magnitude with the corresponding error """
@@ -381,3 +401,39 @@ class SNRTest(unittest.TestCase):
             back_to_error = snr_to_error(csnr)[1]
             self.assertAlmostEqual(back_to_error, cerror)
 
+    def test_arrays(self):
+
+        # All the functions must also accept NumPy arrays, working element-wise
+        # and returning the same values as when they are called with scalars.
+        # In the case of mean_error and mean_snr, each column is averaged.
+
+        nimages = random.randint(MIN_NERR, MAX_NERR)
+        nstars  = random.randint(MIN_NERR, MAX_NERR)
+        shape = (nstars, nimages)
+        snrs = numpy.random.uniform(MIN_SNR, MAX_SNR, shape)
+        weights = numpy.random.uniform(MIN_WEIGHT, MAX_WEIGHT, nstars)
+
+        max_errors, min_errors = snr_to_error(snrs)
+        self.assertEqual(max_errors.shape, shape)
+        for index, snr in numpy.ndenumerate(snrs):
+            self.assertAlmostEqual(max_errors[index], snr_to_error(snr)[0])
+            self.assertAlmostEqual(min_errors[index], snr_to_error(snr)[1])
+        assertArrayAlmostEqual = numpy.testing.assert_array_almost_equal
+        assertArrayAlmostEqual(error_to_snr(max_errors), snrs)
+        assertArrayAlmostEqual(error_to_snr(min_errors), snrs)
+
+        errors = difference_error(*min_errors)
+        self.assertEqual(errors.shape, (nimages,))
+        csnrs = difference_snr(*snrs)
+        msnrs = mean_snr(snrs, weights = weights)
+        for index in xrange(nimages):
+            column = snrs[:, index]
+            self.assertAlmostEqual(errors[index],
+                                   difference_error(*min_errors[:, index]))
+            self.assertAlmostEqual(csnrs[index], difference_snr(*column))
+            self.assertAlmostEqual(msnrs[index],
+                                   mean_snr(column, weights = weights))
+
+        with self.assertRaises(ValueError):
+            snrs[random.randrange(nstars), random.randrange(nimages)] = 1
+            snr_to_error(snrs)